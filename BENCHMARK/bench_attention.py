@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import tensorflow as tf
+
+from MODEL.model_attention import G_Att_Net, NG_Att_Net
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='per-slide timing of the attention network forward pass, '
+                                                 'per-patch loop versus one batched matmul chain')
+
+    parser.add_argument('-n', '--n_patches',
+                        type=int,
+                        nargs='+',
+                        default=[20000, 100000],
+                        help='number of patches per simulated slide')
+
+    parser.add_argument('-r', '--repeats',
+                        type=int,
+                        default=3,
+                        help='number of timed runs per slide size, the fastest one is reported')
+
+    parser.add_argument('-T', '--net_size',
+                        type=str,
+                        default='big',
+                        help='attention network size, small or big')
+
+    return parser
+
+
+def per_patch_call(att_net, img_features, att_gate):
+    # the patch-by-patch forward pass the attention networks used before the batched one
+    h = list()
+    A = list()
+
+    for i in img_features:
+        c_imf = att_net.att_model()[0](i)
+        h.append(c_imf)
+
+    for j in h:
+        if att_gate:
+            att_v_output = att_net.att_model()[1](j)
+            att_u_output = att_net.att_model()[2](j)
+            att_input = tf.math.multiply(att_v_output, att_u_output)
+            a = att_net.att_model()[3](att_input)
+        else:
+            a = att_net.att_model()[1](j)
+        A.append(a)
+
+    return h, A
+
+
+def time_call(func, repeats):
+    run_times = list()
+    for i in range(repeats):
+        start_time = time.time()
+        h, A = func()
+        # pull the last result back to the host so that asynchronous kernels are finished
+        if isinstance(A, list):
+            A[-1].numpy()
+        else:
+            A.numpy()
+        run_times.append(time.time() - start_time)
+
+    return min(run_times)
+
+
+def main():
+    args = make_arg_parser().parse_args()
+
+    net_shape_dict = {
+        "small": [1024, 512, 256],
+        "big": [1024, 512, 384]
+    }
+    net_shape = net_shape_dict[args.net_size]
+
+    for att_gate in [False, True]:
+        att_net_func = G_Att_Net if att_gate else NG_Att_Net
+        att_net = att_net_func(dim_features=net_shape[0], dim_compress_features=net_shape[1],
+                               n_hidden_units=net_shape[2], n_class=2)
+
+        for n_patches in args.n_patches:
+            img_features = tf.random.uniform((n_patches, net_shape[0]))
+            img_features_list = tf.split(img_features, n_patches)
+
+            # warm up both paths before timing them
+            att_net.call(img_features)
+            per_patch_call(att_net, img_features_list[:10], att_gate)
+
+            loop_time = time_call(lambda: per_patch_call(att_net, img_features_list, att_gate), args.repeats)
+            batch_time = time_call(lambda: att_net.call(img_features), args.repeats)
+
+            template = '{} | {} patches | per-patch loop: {:.3f} s/slide | batched: {:.3f} s/slide | speedup: {:.1f}x'
+            print(template.format(type(att_net).__name__, n_patches, loop_time, batch_time, loop_time / batch_time))
+
+
+if __name__ == '__main__':
+    main()
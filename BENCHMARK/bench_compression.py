@@ -0,0 +1,101 @@
+import argparse
+import os
+import shutil
+import time
+
+import tensorflow as tf
+
+from UTILITY.util import list_slides, read_tfrecord_records, slide_dataset
+
+
+COMPRESSION_SUFFIXES = {'': '.tfrecords', 'GZIP': '.tfrecords.gz', 'ZLIB': '.tfrecords.zz'}
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='on-disk size and slide_dataset read throughput of uncompressed, '
+                                                 'GZIP and ZLIB compressed copies of a sample of slide tfrecords')
+
+    parser.add_argument('-i', '--tf_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the slide tfrecords to sample')
+
+    parser.add_argument('-o', '--work_dir',
+                        type=str,
+                        required=True,
+                        help='scratch directory the compressed copies get written to, removed afterwards')
+
+    parser.add_argument('-n', '--n_slides',
+                        type=int,
+                        default=20,
+                        help='number of slides sampled off tf_dir')
+
+    parser.add_argument('-r', '--repeats',
+                        type=int,
+                        default=3,
+                        help='number of timed passes over the sample per compression, the fastest one is reported')
+
+    parser.add_argument('-b', '--bandwidth_mbs',
+                        type=float,
+                        default=100.0,
+                        help='storage bandwidth in MB/s the projected network-bound throughput gets computed for')
+
+    return parser
+
+
+def write_copies(tf_paths, out_dir, compression):
+    # the records of every sampled tfrecord rewritten as they be, only the compression differs
+    os.makedirs(out_dir, exist_ok=True)
+    sample_names = list()
+    for tf_path in tf_paths:
+        sample_name = os.path.basename(tf_path).split('.tfrecords')[0] + COMPRESSION_SUFFIXES[compression]
+        writer = tf.io.TFRecordWriter(os.path.join(out_dir, sample_name),
+                                      options=tf.io.TFRecordOptions(compression_type=compression))
+        for record in read_tfrecord_records(tf_path=tf_path):
+            writer.write(record)
+        writer.close()
+        sample_names.append(sample_name)
+
+    return sample_names
+
+
+def time_read(data_path, sample_names, repeats):
+    run_times = list()
+    for i in range(repeats):
+        start_time = time.time()
+        for img_features, bag_mask, slide_label, sample_name in slide_dataset(data_path=data_path,
+                                                                              sample_names=sample_names,
+                                                                              imf_norm_op=True):
+            pass
+        run_times.append(time.time() - start_time)
+
+    return min(run_times)
+
+
+def main():
+    args = make_arg_parser().parse_args()
+    tf_paths = [os.path.join(args.tf_dir, sample_name)
+                for sample_name in sorted(list_slides(data_path=args.tf_dir))[:args.n_slides]]
+
+    results = dict()
+    for compression in ['', 'GZIP', 'ZLIB']:
+        out_dir = os.path.join(args.work_dir, compression or 'NONE', '')
+        sample_names = write_copies(tf_paths=tf_paths, out_dir=out_dir, compression=compression)
+        n_bytes = sum(os.path.getsize(os.path.join(out_dir, sample_name)) for sample_name in sample_names)
+        read_time = time_read(data_path=out_dir, sample_names=sample_names, repeats=args.repeats)
+        # the files come out of the page cache here, on network storage a pass takes at least n_bytes / bandwidth
+        network_time = max(read_time, n_bytes / (args.bandwidth_mbs * 2 ** 20))
+        results[compression or 'NONE'] = (n_bytes, read_time, network_time)
+        shutil.rmtree(out_dir)
+
+    ref_bytes, ref_time, ref_network_time = results['NONE']
+    template = '\n{:>5} | {:8.1f} MB ({:.2f}x) | {:.2f} slides/s cached ({:.2f}x) | ' \
+               '{:.2f} slides/s at {:.0f} MB/s ({:.2f}x)'
+    for compression, (n_bytes, read_time, network_time) in results.items():
+        print(template.format(compression, n_bytes / 2 ** 20, n_bytes / ref_bytes,
+                              len(tf_paths) / read_time, ref_time / read_time,
+                              len(tf_paths) / network_time, args.bandwidth_mbs, ref_network_time / network_time))
+
+
+if __name__ == '__main__':
+    main()
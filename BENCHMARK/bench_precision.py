@@ -0,0 +1,110 @@
+import argparse
+import os
+import random
+import time
+
+import tensorflow as tf
+
+from UTILITY.model_main import load_model
+from UTILITY.model_session import TrainingSession
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='train and validate on the same split under every precision policy, '
+                                                 'then report throughput and accuracy deltas against float32')
+
+    parser.add_argument('-t', '--train_data_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the training tfrecords, float32 or float16 stored features')
+
+    parser.add_argument('-v', '--val_data_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the validation tfrecords, float32 or float16 stored features')
+
+    parser.add_argument('-p', '--policies',
+                        type=str,
+                        nargs='+',
+                        default=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                        help='precision policies to compare, float32 be the reference and always runs first')
+
+    parser.add_argument('-E', '--epochs',
+                        type=int,
+                        default=5,
+                        help='number of epochs per policy')
+
+    parser.add_argument('-M', '--m_clam_op',
+                        action='store_true',
+                        help='benchmark the multi-class M_CLAM instead of S_CLAM')
+
+    parser.add_argument('-T', '--net_size',
+                        type=str,
+                        default='big',
+                        help='attention network size, small or big')
+
+    parser.add_argument('-s', '--seed',
+                        type=int,
+                        default=0,
+                        help='seed of the model initialization and the slide shuffling, shared by every policy')
+
+    return parser
+
+
+def run_policy(args, policy):
+    tf.keras.mixed_precision.set_global_policy(policy)
+    tf.random.set_seed(args.seed)
+    random.seed(args.seed)
+
+    c_model = load_model(n_class=2, top_k_percent=0.2, net_size=args.net_size, mut_ex=False, att_gate=True,
+                         att_only=False, mil_ins=True, dropout=False, dropout_rate=0.25)[int(args.m_clam_op)]
+
+    session = TrainingSession(c_model=c_model, train_path=args.train_data_dir, val_path=args.val_data_dir,
+                              imf_norm_op=True, i_wd_op_name='True', b_wd_op_name='True', a_wd_op_name='True',
+                              i_optimizer_name='AdamW', b_optimizer_name='AdamW', a_optimizer_name='AdamW',
+                              i_loss_name='binary_crossentropy', b_loss_name='binary_crossentropy',
+                              mut_ex=False, n_class=2, c1=0.7, c2=0.3,
+                              i_learn_rate=2e-04, b_learn_rate=2e-04, a_learn_rate=2e-04,
+                              i_l2_decay=1e-05, b_l2_decay=1e-05, a_l2_decay=1e-05,
+                              top_k_percent=0.2, batch_size=2000, batch_op=False, compile_op=False,
+                              jit_compile=False, slide_batch_size=1)
+
+    n_train_slides = len(session.train_sample_list)
+    train_time = 0.0
+
+    for epoch in range(args.epochs):
+        start_time = time.time()
+        session.train_epoch()
+        # the first epoch pays for building the optimizer slots, it only counts when it be the only one
+        if epoch > 0 or args.epochs == 1:
+            train_time += time.time() - start_time
+
+    n_timed_epochs = max(args.epochs - 1, 1)
+
+    val_loss, val_ins_loss, val_bag_loss, val_tn, val_fp, val_fn, val_tp, val_sensitivity, val_specificity, \
+    val_acc, val_auc = session.val_epoch()
+
+    return n_train_slides * n_timed_epochs / train_time, float(val_loss), float(val_acc), float(val_auc)
+
+
+def main():
+    args = make_arg_parser().parse_args()
+    args.train_data_dir = os.path.join(args.train_data_dir, '')
+    args.val_data_dir = os.path.join(args.val_data_dir, '')
+
+    policies = ['float32'] + [policy for policy in args.policies if policy != 'float32']
+    results = dict()
+    for policy in policies:
+        results[policy] = run_policy(args, policy)
+
+    ref_throughput, ref_loss, ref_acc, ref_auc = results['float32']
+    template = '\n{:>15} | {:.2f} train slides/s ({:.2f}x) | val loss {:.4f} ({:+.4f}) | val acc {:.2f} ({:+.2f}) | ' \
+               'val auc {:.2f} ({:+.2f})'
+    for policy in policies:
+        throughput, val_loss, val_acc, val_auc = results[policy]
+        print(template.format(policy, throughput, throughput / ref_throughput, val_loss, val_loss - ref_loss,
+                              val_acc, val_acc - ref_acc, val_auc, val_auc - ref_auc))
+
+
+if __name__ == '__main__':
+    main()
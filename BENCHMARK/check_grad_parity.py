@@ -0,0 +1,215 @@
+import argparse
+import sys
+
+import tensorflow as tf
+
+from UTILITY.model_main import load_model
+from UTILITY.util import compute_ins_loss, compute_bag_loss, compute_network_gradients, scale_loss, \
+    unscale_gradients, apply_network_gradients, DynamicLossScale
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='compare the single backward pass gradients of nb_optimize with '
+                                                 'the three separate I_Loss, B_Loss and T_Loss backward passes')
+
+    parser.add_argument('-n', '--n_patches',
+                        type=int,
+                        default=500,
+                        help='number of patches of the simulated slide')
+
+    parser.add_argument('-c', '--c_pairs',
+                        type=float,
+                        nargs='+',
+                        default=[0.7, 0.3, 1.0, 0.0, 0.0, 1.0],
+                        help='flat list of (c1, c2) loss weight pairs to check')
+
+    parser.add_argument('-e', '--tolerance',
+                        type=float,
+                        default=1e-03,
+                        help='largest accepted relative gradient difference per network, c1 and c2 scale the '
+                             'backward pass in float32 so the gradients only match bit for bit with power of two '
+                             'weights like 0.5 and 0.25, otherwise up to rounding')
+
+    parser.add_argument('-m', '--mixed_tolerance',
+                        type=float,
+                        default=5e-02,
+                        help='largest accepted relative gradient difference per network under the mixed_float16 '
+                             'policy, the float16 backward pass of c1 * B_Loss rounds differently from the one of '
+                             'B_Loss, most of all in the softmax of the S_CLAM bag classifier, where the scaled '
+                             'gradients of both classes nearly cancel out')
+
+    parser.add_argument('-p', '--policies',
+                        type=str,
+                        nargs='+',
+                        default=['float32', 'mixed_float16'],
+                        help='mixed precision policies to check, under mixed_float16 the losses get scaled and the '
+                             'gradients unscaled by a DynamicLossScale the way nb_optimize does it')
+
+    parser.add_argument('-s', '--seed',
+                        type=int,
+                        default=0,
+                        help='seed of the model initialization and the simulated slide')
+
+    return parser
+
+
+def forward(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex):
+    att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
+    Y_prob, Y_hat, Y_true, predict_slide_label = c_model.call(img_features, slide_label)
+
+    I_Loss = compute_ins_loss(i_loss_func=i_loss_func, ins_labels=ins_labels, ins_logits=ins_logits,
+                              n_class=2, mut_ex=mut_ex)
+    B_Loss = compute_bag_loss(b_loss_func=b_loss_func, Y_true=Y_true, Y_prob=Y_prob)
+    T_Loss = c1 * B_Loss + c2 * I_Loss
+
+    return I_Loss, B_Loss, T_Loss
+
+
+def three_tape_gradients(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex,
+                         loss_scale):
+    # the gradient computation nb_optimize used before the single backward pass, every loss scaled and its gradients
+    # unscaled on its own
+    a_net, i_net, b_net = c_model.networks()
+
+    with tf.GradientTape() as i_tape, tf.GradientTape() as b_tape, tf.GradientTape() as a_tape:
+        I_Loss, B_Loss, T_Loss = forward(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex)
+        I_Loss = scale_loss(loss_scale=loss_scale, loss=I_Loss)
+        B_Loss = scale_loss(loss_scale=loss_scale, loss=B_Loss)
+        T_Loss = scale_loss(loss_scale=loss_scale, loss=T_Loss)
+
+    i_grad = unscale_gradients(loss_scale=loss_scale, grads=i_tape.gradient(I_Loss, i_net.trainable_weights))
+    b_grad = unscale_gradients(loss_scale=loss_scale, grads=b_tape.gradient(B_Loss, b_net.trainable_weights))
+    a_grad = unscale_gradients(loss_scale=loss_scale, grads=a_tape.gradient(T_Loss, a_net.trainable_weights))
+
+    return a_grad, i_grad, b_grad
+
+
+def one_tape_gradients(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex, loss_scale):
+    # the gradient computation of nb_optimize, all three losses scaled and unscaled by the one loss scale
+    a_net, i_net, b_net = c_model.networks()
+
+    with tf.GradientTape(persistent=(c1 == 0 or c2 == 0)) as tape:
+        I_Loss, B_Loss, T_Loss = forward(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex)
+        I_Loss = scale_loss(loss_scale=loss_scale, loss=I_Loss)
+        B_Loss = scale_loss(loss_scale=loss_scale, loss=B_Loss)
+        T_Loss = scale_loss(loss_scale=loss_scale, loss=T_Loss)
+
+    grads = compute_network_gradients(tape=tape, I_Loss=I_Loss, B_Loss=B_Loss, T_Loss=T_Loss, c1=c1, c2=c2,
+                                      a_net=a_net, i_net=i_net, b_net=b_net)
+
+    return [unscale_gradients(loss_scale=loss_scale, grads=grad) for grad in grads]
+
+
+def overflow_skips_step(c_model, grads):
+    # under the shared loss scale, an overflow in the instance classifier gradients alone has to skip the step of all
+    # three networks, count it in the iterations of all three optimizers and halve the loss scale, see
+    # apply_network_gradients
+    a_net, i_net, b_net = c_model.networks()
+    optimizers = [tf.keras.optimizers.Adam() for i in range(3)]
+    loss_scale = DynamicLossScale()
+    a_grad, i_grad, b_grad = grads
+    i_grad = [grad * float('inf') for grad in i_grad]
+
+    weights = a_net.trainable_weights + i_net.trainable_weights + b_net.trainable_weights
+    weights_before = [tf.identity(weight) for weight in weights]
+    loss_scale_before = float(loss_scale.loss_scale)
+    apply_network_gradients(a_optimizer=optimizers[0], i_optimizer=optimizers[1], b_optimizer=optimizers[2],
+                            a_grad=a_grad, i_grad=i_grad, b_grad=b_grad, a_net=a_net, i_net=i_net, b_net=b_net,
+                            loss_scale=loss_scale)
+
+    unchanged = all(bool(tf.math.reduce_all(weight == weight_before))
+                    for weight, weight_before in zip(weights, weights_before))
+    counted = all(int(optimizer.iterations) == 1 for optimizer in optimizers)
+
+    return unchanged and counted and float(loss_scale.loss_scale) == loss_scale_before / 2
+
+
+def relative_difference(grads, ref_grads):
+    diff = tf.math.add_n([tf.math.reduce_sum(tf.math.square(g - r)) for g, r in zip(grads, ref_grads)])
+    norm = tf.math.add_n([tf.math.reduce_sum(tf.math.square(r)) for r in ref_grads])
+
+    difference = float(tf.math.sqrt(diff / tf.math.maximum(norm, 1e-30)))
+
+    # overflown gradients fail the check instead of slipping through the max as nan
+    return difference if difference == difference else float('inf')
+
+
+def all_finite(grads):
+    return all(bool(tf.math.reduce_all(tf.math.is_finite(g))) for net_grads in grads for g in net_grads)
+
+
+def gradient_pair(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex, policy):
+    """
+    Gradients of the three separate backward passes and of the single one, the returned loss scale be None under
+    float32. Under mixed_float16, both run under one loss scale, halved from the 2 ** 15 a DynamicLossScale starts
+    from until neither gradient computation overflows, the scale the DynamicLossScale of a training run settles on
+    by skipping the overflowing steps.
+    """
+    loss_scale = 2 ** 15 if policy == 'mixed_float16' else None
+    while True:
+        dynamic_loss_scale = None if loss_scale is None else DynamicLossScale(initial_scale=loss_scale)
+        ref_grads = three_tape_gradients(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2,
+                                         mut_ex, dynamic_loss_scale)
+        grads = one_tape_gradients(c_model, img_features, slide_label, i_loss_func, b_loss_func, c1, c2, mut_ex,
+                                   dynamic_loss_scale)
+        if loss_scale is None or loss_scale <= 1 or (all_finite(ref_grads) and all_finite(grads)):
+            return ref_grads, grads, loss_scale
+        loss_scale = loss_scale / 2
+
+
+def main():
+    args = make_arg_parser().parse_args()
+    c_pairs = list(zip(args.c_pairs[0::2], args.c_pairs[1::2]))
+
+    i_loss_func = tf.keras.losses.binary_crossentropy
+    b_loss_func = tf.keras.losses.binary_crossentropy
+
+    passed = True
+    for policy in args.policies:
+        # the policy has to be set before the models get built, as in UTILITY/model_main.py
+        tf.keras.mixed_precision.set_global_policy(policy)
+        tolerance = args.mixed_tolerance if policy == 'mixed_float16' else args.tolerance
+
+        tf.random.set_seed(args.seed)
+        # l2 normalized like get_data_from_tf does with imf_norm_op, raw features saturate the bag loss, and handed
+        # over in the compute dtype of the policy like slide_dataset does
+        img_features = tf.math.l2_normalize(tf.random.uniform((args.n_patches, 1024)), axis=-1)
+        img_features = tf.cast(img_features, tf.keras.mixed_precision.global_policy().compute_dtype)
+
+        max_diff = 0.0
+        skips = []
+        for m_clam_op in [False, True]:
+            for att_gate in [False, True]:
+                for mut_ex in [False, True]:
+                    c_model = load_model(n_class=2, top_k_percent=0.2, net_size='big', mut_ex=mut_ex,
+                                         att_gate=att_gate, att_only=False, mil_ins=True, dropout=False,
+                                         dropout_rate=0.25)[int(m_clam_op)]
+                    for slide_label in [0, 1]:
+                        for c1, c2 in c_pairs:
+                            ref_grads, grads, loss_scale = gradient_pair(c_model, img_features, slide_label,
+                                                                         i_loss_func, b_loss_func, c1, c2, mut_ex,
+                                                                         policy)
+                            diffs = [relative_difference(g, r) for g, r in zip(grads, ref_grads)]
+                            max_diff = max([max_diff] + diffs)
+
+                            template = '{} | {} | att_gate {} | mut_ex {} | label {} | c1 {} c2 {} | loss scale {} ' \
+                                       '| relative gradient difference a_net {:.2e}, i_net {:.2e}, b_net {:.2e}'
+                            print(template.format(policy, type(c_model).__name__, att_gate, mut_ex, slide_label,
+                                                  c1, c2, loss_scale, *diffs))
+                    if policy == 'mixed_float16':
+                        skips.append(overflow_skips_step(c_model, grads))
+
+        print('\n{} largest relative gradient difference: {:.2e}, tolerance: {:.0e}'.format(policy, max_diff,
+                                                                                            tolerance))
+        passed = passed and max_diff <= tolerance
+        if policy == 'mixed_float16':
+            print('{} overflow skips the step of all three networks: {} of {} models\n'.format(policy, sum(skips),
+                                                                                              len(skips)))
+            passed = passed and all(skips)
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
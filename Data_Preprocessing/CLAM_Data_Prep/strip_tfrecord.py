@@ -0,0 +1,138 @@
+import tensorflow as tf
+import os
+import re
+import argparse
+
+
+def argument_parse():
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description='strip existing tfrecords down to the feature-only format of '
+                                                 'tfrecord_from_wsi.py --feature_only True')
+    parser.add_argument("-i", "--tf_input", help="input tf dir", required="True")
+    parser.add_argument("-o", "--tf_output", help="output tf dir", required="True")
+    parser.add_argument("-l", "--level", help="level the patches were extracted at, stored as patch_level for "
+                                              "fetch_patch in tfrecord_from_wsi.py", default=None)
+    return parser
+
+
+'''TF2 helper functions for TF Records'''
+
+
+def _bytes_feature(value):
+    """Returns a bytes_list from a string / byte."""
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    """Returns an int64_list from a bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _int64_list_feature(value):
+    """Returns an int64_list from a list of bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+'''level 0 patch coordinates out of the image_name of tfrecord_from_wsi.py'''
+
+
+def image_name_coords(image_name):
+    """
+    Args:
+        image_name:  samp_x_x1_x2_y_y1_y2_mean_std_bytes.jpg
+    :return: coords:  [x1, y1, x2, y2], or [-1, -1, -1, -1] for an image_name without coordinates
+    """
+    xy = re.findall(r'_x_(\d+)_(\d+)_y_(\d+)_(\d+)_', image_name)
+    if len(xy) == 0:
+        return [-1, -1, -1, -1]
+    x1, x2, y1, y2 = [int(i) for i in xy[-1]]
+
+    return [x1, y1, x2, y2]
+
+
+'''sidecar record index of a tfrecord, one "offset size" line per record, see load_tfrecord_index in UTILITY/util.py'''
+
+
+def _write_tfrecord_index(tf_file, record_sizes):
+    """Writes the byte offset and size of every record of tf_file, each record be framed with 16 bytes. The offsets of
+    a compressed tf_file be offsets into its uncompressed record stream."""
+    offset = 0
+    with open(tf_file + '.index', 'w') as f:
+        for record_size in record_sizes:
+            f.write(str(offset) + ' ' + str(record_size) + '\n')
+            offset = offset + record_size
+
+
+'''compression of a tfrecord out of its file name suffix, the stripped tfrecord keeps it'''
+
+TFRECORD_COMPRESSIONS = {'.gz': 'GZIP', '.zz': 'ZLIB'}
+
+
+def _compression_type(tf_file):
+    """Returns the compression_type of a tfrecord, '' for the uncompressed .tfrecords."""
+    return TFRECORD_COMPRESSIONS.get(os.path.splitext(tf_file)[1], '')
+
+
+'''stripping a tfrecord down to its feature vectors, labels and patch coordinates'''
+
+
+def strip_tfrecord(tf_input_file, tf_output_file, patch_level=None):
+    compression = _compression_type(tf_input_file)
+    writer = tf.io.TFRecordWriter(tf_output_file, options=tf.io.TFRecordOptions(compression_type=compression))
+    record_sizes = []
+    for tfrecord_value in tf.data.TFRecordDataset(tf_input_file, compression_type=compression):
+        input_feature = tf.train.Example.FromString(tfrecord_value.numpy()).features.feature
+        if 'coords' in input_feature:
+            coords = list(input_feature['coords'].int64_list.value)
+        else:
+            coords = image_name_coords(input_feature['image_name'].bytes_list.value[0].decode('utf8'))
+
+        feature = {'label': _int64_feature(input_feature['label'].int64_list.value[0]),
+                   'coords': _int64_list_feature(coords),
+                   'image_feature': _bytes_feature(input_feature['image_feature'].bytes_list.value[0])}
+        for k in ['feature_schema', 'feature_dtype', 'feature_dim']:
+            if k in input_feature:
+                feature[k] = input_feature[k]
+        if patch_level is not None:
+            feature['patch_level'] = _int64_feature(patch_level)
+        elif 'patch_level' in input_feature:
+            feature['patch_level'] = input_feature['patch_level']
+
+        Example = tf.train.Example(features=tf.train.Features(feature=feature))
+        Serialized = Example.SerializeToString()
+        writer.write(Serialized)
+        record_sizes.append(len(Serialized) + 16)
+    writer.close()
+    _write_tfrecord_index(tf_output_file, record_sizes)
+
+
+def main():
+    '''reading the config filename'''
+    parser = argument_parse()
+    arg = parser.parse_args()
+    '''printing the config param'''
+    print("Entered Input TF Directory " + arg.tf_input)
+    print("Entered Output TF Directory " + arg.tf_output)
+    print("Entered Level " + str(arg.level))
+
+    patch_level = None if arg.level is None else int(arg.level)
+    os.makedirs(arg.tf_output, exist_ok=True)
+
+    input_bytes = 0
+    output_bytes = 0
+    for tf_file in sorted(os.listdir(arg.tf_input)):
+        if tf_file.endswith('.index'):
+            continue
+        tf_input_file = os.path.join(arg.tf_input, tf_file)
+        tf_output_file = os.path.join(arg.tf_output, tf_file)
+        strip_tfrecord(tf_input_file, tf_output_file, patch_level)
+
+        input_bytes = input_bytes + os.path.getsize(tf_input_file)
+        output_bytes = output_bytes + os.path.getsize(tf_output_file)
+        print(tf_file, os.path.getsize(tf_input_file), os.path.getsize(tf_output_file))
+
+    print("Stripped " + str(input_bytes) + " bytes down to " + str(output_bytes) + " bytes")
+
+
+if __name__ == "__main__":
+    main()
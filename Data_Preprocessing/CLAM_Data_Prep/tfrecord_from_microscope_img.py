@@ -32,19 +32,51 @@ def argument_parse():
     parser.add_argument("-f", "--patch_file", help="Patch file", required="True")
     parser.add_argument("-s", "--sample", help="input file", required="True")
     parser.add_argument("-o", "--tf_output", help="output tf dir", required="True")
+    parser.add_argument("--feature_dtype", help="dtype of the stored feature vectors, float32 or float16",
+                        choices=["float32", "float16"], default="float32")
+    parser.add_argument("--compression", help="compression of the written tfrecord, GZIP writes .tfrecords.gz, ZLIB "
+                                              ".tfrecords.zz", choices=["None", "GZIP", "ZLIB"], default="None")
+    parser.add_argument("--batch_size", help="number of images per forward pass of the feature extraction",
+                        default="64")
     return parser
 
 
+'''one OpenSlide handle, thumbnail and tissue mask of the slide, shared by the stages working on a slide'''
+
+
+class SlideContext(object):
+    """
+    Opens the slide once for create_binary_mask_new, calc_patches_cord, create_summary_img and create_tfrecord, and
+    keeps its level_dimensions and level_downsamples tables. toplevel be [thumbnail width, thumbnail height, divisor],
+    the thumbnail gets built by the first get_thumbnail and cached for the later stages, binary_img be the boolean
+    tissue mask of the thumbnail once create_binary_mask_new ran.
+    """
+
+    def __init__(self, svs_file):
+        self.svs_file = svs_file
+        self.OSobj = openslide.OpenSlide(svs_file)
+        self.level_dimensions = self.OSobj.level_dimensions
+        self.level_downsamples = self.OSobj.level_downsamples
+        divisor = int(self.level_dimensions[0][0] / 500)
+        self.toplevel = [int(self.level_dimensions[0][0] / divisor), int(self.level_dimensions[0][1] / divisor),
+                         divisor]
+        self.thumbnail = None
+        self.binary_img = None
+
+    def get_thumbnail(self):
+        if self.thumbnail is None:
+            self.thumbnail = self.OSobj.get_thumbnail((self.toplevel[0], self.toplevel[1]))
+        return self.thumbnail
+
+    def close(self):
+        self.OSobj.close()
+
+
 '''creating binary mask to inspect areas with tissue and performance of threshold'''
 
 
-def create_binary_mask_new(rgb2hed_thresh, svs_file, patch_dir, samp):
-    OSobj = openslide.OpenSlide(svs_file)
-    divisor = int(OSobj.level_dimensions[0][0] / 500)
-    patch_sub_size_x = int(OSobj.level_dimensions[0][0] / divisor)
-    patch_sub_size_y = int(OSobj.level_dimensions[0][1] / divisor)
-    img = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
-    toplevel = [patch_sub_size_x, patch_sub_size_y, divisor]
+def create_binary_mask_new(rgb2hed_thresh, slide, patch_dir, samp):
+    img = slide.get_thumbnail()
     img = img.convert('RGB')
     np_img = np.array(img)
     img.save(patch_dir + '/' + samp + "_original.png", "png")
@@ -63,63 +95,56 @@ def create_binary_mask_new(rgb2hed_thresh, svs_file, patch_dir, samp):
     idx = np.sum(binary_img)
     mask_area = idx / (binary_img.size)
     print(mask_area)
-    idx = np.where(binary_img == 1)
-    list_binary_img = []
-    for i in range(0, len(idx[0]), 1):
-        x = idx[1][i]
-        y = idx[0][i]
-        list_binary_img.append(str(x) + ' ' + str(y))
-
-    # return np.array(binary_img)
-    return list_binary_img, toplevel
+    '''the mask stays a boolean array on the slide context, calc_patches_cord sums it up per patch'''
+    slide.binary_img = binary_img == 1
+    return slide.binary_img
 
 
 '''extracting patch coordinates for requested level based on threshold'''
 
 
-def calc_patches_cord(list_binary_img, patch_level, svs_file, patch_dir, samp, patch_size, threshold_area_percent,
-                      toplevel):
-    patch_start_x_list = []
-    patch_stop_x_list = []
-    patch_start_y_list = []
-    patch_stop_y_list = []
-    OSobj = openslide.OpenSlide(svs_file)
+def calc_patches_cord(slide, patch_level, patch_dir, samp, patch_size, threshold_area_percent):
+    binary_img = slide.binary_img
+    toplevel = slide.toplevel
     minx = 0
     miny = 0
-    if patch_level > len(OSobj.level_dimensions) - 1:
-        print("not enough levels " + str(patch_level) + " " + str(len(OSobj.level_dimensions) - 1))
+    if patch_level > len(slide.level_dimensions) - 1:
+        print("not enough levels " + str(patch_level) + " " + str(len(slide.level_dimensions) - 1))
         sys.exit(0)
-    maxx = OSobj.level_dimensions[patch_level][0]
-    maxy = OSobj.level_dimensions[patch_level][1]
-    start_x = minx
-    total_num_patches = 0
-    selected_num_patches = 0
+    maxx = slide.level_dimensions[patch_level][0]
+    maxy = slide.level_dimensions[patch_level][1]
 
     '''creating sub patches'''
-    '''Iterating through x coordinate'''
-    while start_x + patch_size < maxx:
-        '''Iterating through y coordinate'''
-        start_y = miny
-        while start_y + patch_size < maxy:
-            current_x = int((start_x * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            current_y = int((start_y * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            tmp_x = start_x + int(patch_size)
-            tmp_y = start_y + int(patch_size)
-            current_x_stop = int((tmp_x * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            current_y_stop = int((tmp_y * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            total_num_patches = total_num_patches + 1
-            flag_list = [1 for i in range(current_x, current_x_stop + 1) for j in range(current_y, current_y_stop + 1)
-                         if str(i) + ' ' + str(j) in list_binary_img]
-            if tmp_x <= maxx and tmp_y <= maxy and (len(flag_list) / (
-                    (current_y_stop + 1 - current_y) * (current_x_stop + 1 - current_x))) > threshold_area_percent:
-                patch_start_x_list.append(start_x)
-                patch_start_y_list.append(start_y)
-                patch_stop_x_list.append(tmp_x)
-                patch_stop_y_list.append(tmp_y)
-                selected_num_patches = selected_num_patches + 1
-
-            start_y = tmp_y
-        start_x = tmp_x
+    '''the whole grid at once, x outer and y inner, every patch starting where the one before stopped'''
+    start_x, start_y = np.meshgrid(np.arange(minx, maxx - patch_size, patch_size),
+                                   np.arange(miny, maxy - patch_size, patch_size), indexing='ij')
+    start_x = start_x.ravel()
+    start_y = start_y.ravel()
+    tmp_x = start_x + int(patch_size)
+    tmp_y = start_y + int(patch_size)
+    current_x = ((start_x * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_y = ((start_y * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_x_stop = ((tmp_x * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_y_stop = ((tmp_y * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    total_num_patches = len(start_x)
+
+    '''tissue pixels of the inclusive thumbnail box of every patch, out of a summed-area table of the mask'''
+    height, width = binary_img.shape
+    tissue_sum = np.zeros((height + 1, width + 1), dtype=np.int64)
+    tissue_sum[1:, 1:] = np.cumsum(np.cumsum(binary_img, axis=0, dtype=np.int64), axis=1)
+    x0 = np.minimum(current_x, width)
+    x1 = np.minimum(current_x_stop + 1, width)
+    y0 = np.minimum(current_y, height)
+    y1 = np.minimum(current_y_stop + 1, height)
+    tissue_count = tissue_sum[y1, x1] - tissue_sum[y0, x1] - tissue_sum[y1, x0] + tissue_sum[y0, x0]
+    box_area = (current_y_stop + 1 - current_y) * (current_x_stop + 1 - current_x)
+
+    selected = (tmp_x <= maxx) & (tmp_y <= maxy) & (tissue_count / box_area > threshold_area_percent)
+    patch_start_x_list = start_x[selected].tolist()
+    patch_stop_x_list = tmp_x[selected].tolist()
+    patch_start_y_list = start_y[selected].tolist()
+    patch_stop_y_list = tmp_y[selected].tolist()
+    selected_num_patches = len(patch_start_x_list)
     print(selected_num_patches, total_num_patches)
     return patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list
 
@@ -128,23 +153,19 @@ def calc_patches_cord(list_binary_img, patch_level, svs_file, patch_dir, samp, p
 
 
 def create_summary_img(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                       toplevel, patch_level, svs_file):
-
-    OSobj = openslide.OpenSlide(svs_file)
+                       slide, patch_level):
+    toplevel = slide.toplevel
     poly_included = []
     poly_excluded = []
     name = ""
     for i in range(0, len(patch_stop_x_list), 1):
-        x1 = int((patch_start_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        x2 = int((patch_stop_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y1 = int((patch_start_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y2 = int((patch_stop_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
+        x1 = int((patch_start_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        x2 = int((patch_stop_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y1 = int((patch_start_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y2 = int((patch_stop_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
         poly_included.append(Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]))
 
-    patch_sub_size_x = toplevel[0]
-    patch_sub_size_y = toplevel[1]
-
-    img_patch = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
+    img_patch = slide.get_thumbnail()
     np_img = np.array(img_patch)
     patch_sub_size_y = np_img.shape[0]
     patch_sub_size_x = np_img.shape[1]
@@ -184,29 +205,61 @@ def patch_feature_extraction_resnet(input_shape=(512, 512, 3)):
     return res50, adaptive_mean_spatial_layer
 
 
-def patch_feature_extraction(image_string, res50, adaptive_mean_spatial_layer, input_shape=(512, 512, 3)):
+def patch_feature_extractor(res50, adaptive_mean_spatial_layer):
     """
     Args:
-        image_string:  bytes(PIL_image)
-    :return: features:  Feature Vectors, float32
+        res50, adaptive_mean_spatial_layer:  the outputs of patch_feature_extraction_resnet
+    :return: extract:  one compiled forward pass from a (B, H, W, 3) uint8 batch of patches to their (B, 1024)
+             float32 feature vectors, the resnet50 preprocessing, the per image standardization and the adaptive
+             mean-spatial pooling all in-graph, traced once for every batch size and patch size
     """
 
-    image_tensor = tf.io.decode_image(image_string)
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.uint8)])
+    def extract(image_batch):
+        image_patch = tf.keras.applications.resnet50.preprocess_input(tf.cast(image_batch, tf.float32))
+        image_patch = tf.image.per_image_standardization(image_patch)
+        return adaptive_mean_spatial_layer(res50(image_patch, training=False))
+
+    return extract
+
 
-    image_np = np.array(image_tensor)
+def patch_feature_extraction(image_batch, extract, feature_dtype='float32'):
+    """
+    Args:
+        image_batch:  list of (H, W, 3) uint8 numpy patches, all of the same size
+        extract:  the compiled forward pass of patch_feature_extractor
+        feature_dtype:  float32, or float16 to halve the stored feature bytes
+    :return: features:  list of Feature Vectors in the order of image_batch, raw little-endian feature_dtype bytes,
+             see _feature_schema
+    """
 
-    image_batch = np.expand_dims(image_np, axis=0)
+    features = extract(np.stack(image_batch))
+    features = tf.cast(features, feature_dtype).numpy().astype(np.dtype(feature_dtype).newbyteorder('<'))
 
-    image_patch = tf.keras.applications.resnet50.preprocess_input(image_batch.copy())
+    return [feature.tobytes() for feature in features]
 
-    ## Return the feature vectors
-    image_patch = tf.image.per_image_standardization(image_patch).numpy()
-    predicts = res50.predict(image_patch)
-    features = adaptive_mean_spatial_layer(predicts)
-    features = tf.io.serialize_tensor(features)
-    img_features = features.numpy()
 
-    return img_features
+'''writing a batch of patches, their feature vectors extracted in one forward pass'''
+
+
+def write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes):
+    """
+    Args:
+        patch_batch:  list of (feature, image_np), the tfrecord features of a patch still without its image_feature
+                      and its (H, W, 3) uint8 numpy patch, in patch order; emptied once written
+        record_sizes:  the sizes of the written records get appended, see _write_tfrecord_index
+    """
+    if len(patch_batch) == 0:
+        return
+    image_features = patch_feature_extraction([image_np for feature, image_np in patch_batch], extract, feature_dtype)
+    for (feature, image_np), image_feature in zip(patch_batch, image_features):
+        feature['image_feature'] = _bytes_feature(image_feature)
+        feature.update(_feature_schema(image_feature, feature_dtype))
+        Example = tf.train.Example(features=tf.train.Features(feature=feature))
+        Serialized = Example.SerializeToString()
+        writer.write(Serialized)
+        record_sizes.append(len(Serialized) + 16)
+    del patch_batch[:]
 
 
 '''TF2 helper functions for TF Records'''
@@ -233,10 +286,42 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
-def create_tfrecord_img(patch_file, sample, tf_output):
-    writer = tf.io.TFRecordWriter(os.path.join(tf_output, sample + '.tfrecords'))
+'''record schema of the image_feature, 2 be raw little-endian bytes, 1 the tf.io.serialize_tensor of old tfrecords'''
+
+
+def _feature_schema(image_feature, feature_dtype):
+    """Returns the schema version, dtype and dimension features of a raw image_feature."""
+    return {'feature_schema': _int64_feature(2),
+            'feature_dtype': _bytes_feature(feature_dtype.encode('utf8')),
+            'feature_dim': _int64_feature(len(image_feature) // np.dtype(feature_dtype).itemsize)}
+
+
+'''sidecar record index of a tfrecord, one "offset size" line per record, see load_tfrecord_index in UTILITY/util.py'''
+
+
+def _write_tfrecord_index(tf_file, record_sizes):
+    """Writes the byte offset and size of every record of tf_file, each record be framed with 16 bytes. The offsets of
+    a compressed tf_file be offsets into its uncompressed record stream."""
+    offset = 0
+    with open(tf_file + '.index', 'w') as f:
+        for record_size in record_sizes:
+            f.write(str(offset) + ' ' + str(record_size) + '\n')
+            offset = offset + record_size
+
+
+'''file name suffix of a compressed tfrecord, see tfrecord_compression in UTILITY/util.py'''
+
+TFRECORD_SUFFIXES = {'': '.tfrecords', 'GZIP': '.tfrecords.gz', 'ZLIB': '.tfrecords.zz'}
+
+
+def create_tfrecord_img(patch_file, sample, tf_output, feature_dtype='float32', compression='', batch_size=64):
+    tf_file = os.path.join(tf_output, sample + TFRECORD_SUFFIXES[compression])
+    writer = tf.io.TFRecordWriter(tf_file, options=tf.io.TFRecordOptions(compression_type=compression))
+    record_sizes = []
     fobj = open(patch_file)
     res50, adaptive_mean_spatial_layer = patch_feature_extraction_resnet()
+    extract = patch_feature_extractor(res50, adaptive_mean_spatial_layer)
+    patch_batch = []
     for file in fobj:
         file = file.strip()
         print(file)
@@ -249,8 +334,7 @@ def create_tfrecord_img(patch_file, sample, tf_output):
         image_string = open(file, 'rb').read()
 
         patch_size = 256
-        image_feature = patch_feature_extraction(image_string, res50, adaptive_mean_spatial_layer,
-                                                 (patch_size, patch_size, 3))
+        image_np = tf.io.decode_image(image_string, channels=3).numpy()
         image_format = 'jpeg'
         '''writing tfrecord'''
         feature = {'height': _int64_feature(patch_size),
@@ -259,33 +343,42 @@ def create_tfrecord_img(patch_file, sample, tf_output):
                    'label': _int64_feature(mut_type),
                    'image/format': _bytes_feature(image_format.encode('utf8')),
                    'image_name': _bytes_feature(image_name.encode('utf8')),
-                   'image/encoded': _bytes_feature(image_string),
-                   'image_feature': _bytes_feature(image_feature)}
-
-        Example = tf.train.Example(features=tf.train.Features(feature=feature))
-        Serialized = Example.SerializeToString()
-        writer.write(Serialized)
+                   'image/encoded': _bytes_feature(image_string)}
+
+        '''the feature vectors get extracted batch_size images at a time, a batch only holds images of one size'''
+        if len(patch_batch) > 0 and patch_batch[0][1].shape != image_np.shape:
+            write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes)
+        patch_batch.append((feature, image_np))
+        if len(patch_batch) == batch_size:
+            write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes)
+    write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes)
     fobj.close()
+    writer.close()
+    _write_tfrecord_index(tf_file, record_sizes)
 
 
 '''extracting patches and creating tfrecords'''
 
 
 def create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                    patch_level, svs_file, toplevel, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
-                    patch_byte_cutoff):
+                    patch_level, slide, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
+                    patch_byte_cutoff, feature_dtype='float32', compression='', batch_size=64, keep_patches=False):
 
-    writer = tf.io.TFRecordWriter(os.path.join(tf_output, samp + '.tfrecords'))
+    tf_file = os.path.join(tf_output, samp + TFRECORD_SUFFIXES[compression])
+    writer = tf.io.TFRecordWriter(tf_file, options=tf.io.TFRecordOptions(compression_type=compression))
+    record_sizes = []
 
-    OSobj = openslide.OpenSlide(svs_file)
+    toplevel = slide.toplevel
     poly_included = []
     res50, adaptive_mean_spatial_layer = patch_feature_extraction_resnet()
+    extract = patch_feature_extractor(res50, adaptive_mean_spatial_layer)
+    patch_batch = []
     for i in range(0, len(patch_start_x_list), 1):
-        x1 = int(patch_start_x_list[i] * OSobj.level_downsamples[patch_level])
-        x2 = int(patch_stop_x_list[i] * OSobj.level_downsamples[patch_level])
-        y1 = int(patch_start_y_list[i] * OSobj.level_downsamples[patch_level])
-        y2 = int(patch_stop_y_list[i] * OSobj.level_downsamples[patch_level])
-        img = OSobj.read_region((x1, y1), patch_level, (patch_size, patch_size))
+        x1 = int(patch_start_x_list[i] * slide.level_downsamples[patch_level])
+        x2 = int(patch_stop_x_list[i] * slide.level_downsamples[patch_level])
+        y1 = int(patch_start_y_list[i] * slide.level_downsamples[patch_level])
+        y2 = int(patch_stop_y_list[i] * slide.level_downsamples[patch_level])
+        img = slide.OSobj.read_region((x1, y1), patch_level, (patch_size, patch_size))
         img = img.convert('RGB')
 
         '''Change to grey scale'''
@@ -296,14 +389,16 @@ def create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, p
         patch_std = round(np.std(np_grey), 2)
         height = patch_size
         width = patch_size
+        '''encoding the patch once in memory, the size in its image_name be the size of that JPEG'''
         imgByteArr = io.BytesIO()
-        img.save(imgByteArr, format='PNG')
-        size_bytes = imgByteArr.tell()
+        img.save(imgByteArr, format='JPEG')
+        image_string = imgByteArr.getvalue()
+        size_bytes = len(image_string)
         image_name = samp + "_x_" + str(x1) + "_" + str(x2) + "_y_" + str(y1) + "_" + str(y2) + '_' + str(
             patch_mean) + '_' + str(patch_std) + '_' + str(size_bytes) + ".jpg"
-        img.save(patch_dir + '/' + image_name, format='JPEG')
-        image_string = open(patch_dir + '/' + image_name, 'rb').read()
-        image_feature = patch_feature_extraction(img, res50, adaptive_mean_spatial_layer, (patch_size, patch_size, 3))
+        if keep_patches:
+            with open(os.path.join(patch_dir, image_name), 'wb') as patch_file:
+                patch_file.write(image_string)
         image_format = 'jpeg'
         '''writing tfrecord'''
         feature = {'height': _int64_feature(patch_size),
@@ -312,22 +407,22 @@ def create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, p
                    'label': _int64_feature(mut_type),
                    'image/format': _bytes_feature(image_format.encode('utf8')),
                    'image_name': _bytes_feature(image_name.encode('utf8')),
-                   'image/encoded': _bytes_feature(image_string),
-                   'image_feature': _bytes_feature(image_feature)}
-        os.remove(patch_dir + '/' + image_name)
-        Example = tf.train.Example(features=tf.train.Features(feature=feature))
-        Serialized = Example.SerializeToString()
-        writer.write(Serialized)
+                   'image/encoded': _bytes_feature(image_string)}
+        '''the feature vectors get extracted batch_size patches at a time, written in patch order'''
+        patch_batch.append((feature, np.array(img)))
+        if len(patch_batch) == batch_size:
+            write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes)
         '''preparing the summary thumbnail'''
-        x1 = int((patch_start_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        x2 = int((patch_stop_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y1 = int((patch_start_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y2 = int((patch_stop_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
+        x1 = int((patch_start_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        x2 = int((patch_stop_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y1 = int((patch_start_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y2 = int((patch_stop_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
         poly_included.append(Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]))
+    write_patch_batch(writer, patch_batch, extract, feature_dtype, record_sizes)
+    writer.close()
+    _write_tfrecord_index(tf_file, record_sizes)
 
-    patch_sub_size_x = toplevel[0]
-    patch_sub_size_y = toplevel[1]
-    img_patch = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
+    img_patch = slide.get_thumbnail()
 
     np_img = np.array(img_patch)
     patch_sub_size_y = np_img.shape[0]
@@ -361,11 +456,15 @@ def main():
     print("Entered Patch Filename " + arg.patch_file)
     print("Entered Sample " + arg.sample)
     print("Entered Output TF Directory " + arg.tf_output)
+    print("Entered feature dtype " + arg.feature_dtype)
+    print("Entered compression " + arg.compression)
+    print("Entered batch size " + arg.batch_size)
 
     patch_file = str(arg.patch_file)
     sample = str(arg.sample)
     tf_output = str(arg.tf_output)
-    create_tfrecord_img(patch_file, sample, tf_output)
+    compression = "" if arg.compression == "None" else arg.compression
+    create_tfrecord_img(patch_file, sample, tf_output, arg.feature_dtype, compression, int(arg.batch_size))
 
 
 if __name__ == "__main__":
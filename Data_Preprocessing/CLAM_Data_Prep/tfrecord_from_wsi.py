@@ -3,6 +3,11 @@ import tensorflow as tf
 import os
 import argparse
 import sys
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
 import numpy as np
 from PIL import Image
 import io
@@ -46,20 +51,59 @@ def argument_parse():
     parser.add_argument("-m", "--threshold_mean", help="background Threshold mean cutoff", default="245")
     parser.add_argument("-d", "--threshold_std", help="background Threshold std cutoff", default="0")
     parser.add_argument("-z", "--patch_byte_cutoff", help="patch_byte_cutoff", default="0")
+    parser.add_argument("--feature_dtype", help="dtype of the stored feature vectors, float32 or float16",
+                        choices=["float32", "float16"], default="float32")
+    parser.add_argument("--feature_only", help="store only the feature vector, the label and the numeric patch "
+                                               "coordinates, without the JPEG patch, see fetch_patch",
+                        choices=["True", "False"], default="False")
+    parser.add_argument("--compression", help="compression of the written tfrecord, GZIP writes .tfrecords.gz, ZLIB "
+                                              ".tfrecords.zz", choices=["None", "GZIP", "ZLIB"], default="None")
+    parser.add_argument("--batch_size", help="number of patches per forward pass of the feature extraction",
+                        default="64")
+    parser.add_argument("--n_readers", help="number of reader threads, each with its own OpenSlide handle",
+                        default="4")
+    parser.add_argument("--queue_size", help="most patches read ahead of the feature extraction", default="256")
+    parser.add_argument("--keep_patches", help="also write every patch as a JPEG into the patch dir",
+                        choices=["True", "False"], default="False")
     return parser
 
 
-'''creating binary mask to inspect areas with tissue and performance of threshold'''
+'''one OpenSlide handle, thumbnail and tissue mask of the slide, shared by all the stages of main'''
 
 
-def create_binary_mask_new(rgb2lab_thresh, svs_file, patch_dir, samp):
-    OSobj = openslide.OpenSlide(svs_file)
+class SlideContext(object):
+    """
+    Opens the slide once for create_binary_mask_new, calc_patches_cord, create_summary_img and create_tfrecord, and
+    keeps its level_dimensions and level_downsamples tables. toplevel be [thumbnail width, thumbnail height, divisor],
+    the thumbnail gets built by the first get_thumbnail and cached for the later stages, binary_img be the boolean
+    tissue mask of the thumbnail once create_binary_mask_new ran.
+    """
+
+    def __init__(self, svs_file):
+        self.svs_file = svs_file
+        self.OSobj = openslide.OpenSlide(svs_file)
+        self.level_dimensions = self.OSobj.level_dimensions
+        self.level_downsamples = self.OSobj.level_downsamples
+        divisor = int(self.level_dimensions[0][0] / 500)
+        self.toplevel = [int(self.level_dimensions[0][0] / divisor), int(self.level_dimensions[0][1] / divisor),
+                         divisor]
+        self.thumbnail = None
+        self.binary_img = None
+
+    def get_thumbnail(self):
+        if self.thumbnail is None:
+            self.thumbnail = self.OSobj.get_thumbnail((self.toplevel[0], self.toplevel[1]))
+        return self.thumbnail
+
+    def close(self):
+        self.OSobj.close()
+
 
-    divisor = int(OSobj.level_dimensions[0][0] / 500)
-    patch_sub_size_x = int(OSobj.level_dimensions[0][0] / divisor)
-    patch_sub_size_y = int(OSobj.level_dimensions[0][1] / divisor)
-    img = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
-    toplevel = [patch_sub_size_x, patch_sub_size_y, divisor]
+'''creating binary mask to inspect areas with tissue and performance of threshold'''
+
+
+def create_binary_mask_new(rgb2lab_thresh, slide, patch_dir, samp):
+    img = slide.get_thumbnail()
     img = img.convert('RGB')
     np_img = np.array(img)
 
@@ -79,63 +123,56 @@ def create_binary_mask_new(rgb2lab_thresh, svs_file, patch_dir, samp):
     idx = np.sum(binary_img)
     mask_area = idx / (binary_img.size)
     print(mask_area)
-    idx = np.where(binary_img == 1)
-    list_binary_img = []
-    for i in range(0, len(idx[0]), 1):
-        x = idx[1][i]
-        y = idx[0][i]
-        list_binary_img.append(str(x) + ' ' + str(y))
-
-    # return np.array(binary_img)
-    return list_binary_img, toplevel
+    '''the mask stays a boolean array on the slide context, calc_patches_cord sums it up per patch'''
+    slide.binary_img = binary_img == 1
+    return slide.binary_img
 
 
 '''extracting patch coordinates for requested level based on threshold'''
 
 
-def calc_patches_cord(list_binary_img, patch_level, svs_file, patch_dir, samp, patch_size, threshold_area_percent,
-                      toplevel):
-    patch_start_x_list = []
-    patch_stop_x_list = []
-    patch_start_y_list = []
-    patch_stop_y_list = []
-    OSobj = openslide.OpenSlide(svs_file)
+def calc_patches_cord(slide, patch_level, patch_dir, samp, patch_size, threshold_area_percent):
+    binary_img = slide.binary_img
+    toplevel = slide.toplevel
     minx = 0
     miny = 0
-    if patch_level > len(OSobj.level_dimensions) - 1:
-        print("not enough levels " + str(patch_level) + " " + str(len(OSobj.level_dimensions) - 1))
+    if patch_level > len(slide.level_dimensions) - 1:
+        print("not enough levels " + str(patch_level) + " " + str(len(slide.level_dimensions) - 1))
         sys.exit(0)
-    maxx = OSobj.level_dimensions[patch_level][0]
-    maxy = OSobj.level_dimensions[patch_level][1]
-    start_x = minx
-    total_num_patches = 0
-    selected_num_patches = 0
+    maxx = slide.level_dimensions[patch_level][0]
+    maxy = slide.level_dimensions[patch_level][1]
 
     '''creating sub patches'''
-    '''Iterating through x coordinate'''
-    while start_x + patch_size < maxx:
-        '''Iterating through y coordinate'''
-        start_y = miny
-        while start_y + patch_size < maxy:
-            current_x = int((start_x * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            current_y = int((start_y * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            tmp_x = start_x + int(patch_size)
-            tmp_y = start_y + int(patch_size)
-            current_x_stop = int((tmp_x * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            current_y_stop = int((tmp_y * OSobj.level_downsamples[patch_level]) / toplevel[2])
-            total_num_patches = total_num_patches + 1
-            flag_list = [1 for i in range(current_x, current_x_stop + 1) for j in range(current_y, current_y_stop + 1)
-                         if str(i) + ' ' + str(j) in list_binary_img]
-            if tmp_x <= maxx and tmp_y <= maxy and (len(flag_list) / (
-                    (current_y_stop + 1 - current_y) * (current_x_stop + 1 - current_x))) > threshold_area_percent:
-                patch_start_x_list.append(start_x)
-                patch_start_y_list.append(start_y)
-                patch_stop_x_list.append(tmp_x)
-                patch_stop_y_list.append(tmp_y)
-                selected_num_patches = selected_num_patches + 1
-
-            start_y = tmp_y
-        start_x = tmp_x
+    '''the whole grid at once, x outer and y inner, every patch starting where the one before stopped'''
+    start_x, start_y = np.meshgrid(np.arange(minx, maxx - patch_size, patch_size),
+                                   np.arange(miny, maxy - patch_size, patch_size), indexing='ij')
+    start_x = start_x.ravel()
+    start_y = start_y.ravel()
+    tmp_x = start_x + int(patch_size)
+    tmp_y = start_y + int(patch_size)
+    current_x = ((start_x * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_y = ((start_y * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_x_stop = ((tmp_x * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    current_y_stop = ((tmp_y * slide.level_downsamples[patch_level]) / toplevel[2]).astype(np.int64)
+    total_num_patches = len(start_x)
+
+    '''tissue pixels of the inclusive thumbnail box of every patch, out of a summed-area table of the mask'''
+    height, width = binary_img.shape
+    tissue_sum = np.zeros((height + 1, width + 1), dtype=np.int64)
+    tissue_sum[1:, 1:] = np.cumsum(np.cumsum(binary_img, axis=0, dtype=np.int64), axis=1)
+    x0 = np.minimum(current_x, width)
+    x1 = np.minimum(current_x_stop + 1, width)
+    y0 = np.minimum(current_y, height)
+    y1 = np.minimum(current_y_stop + 1, height)
+    tissue_count = tissue_sum[y1, x1] - tissue_sum[y0, x1] - tissue_sum[y1, x0] + tissue_sum[y0, x0]
+    box_area = (current_y_stop + 1 - current_y) * (current_x_stop + 1 - current_x)
+
+    selected = (tmp_x <= maxx) & (tmp_y <= maxy) & (tissue_count / box_area > threshold_area_percent)
+    patch_start_x_list = start_x[selected].tolist()
+    patch_stop_x_list = tmp_x[selected].tolist()
+    patch_start_y_list = start_y[selected].tolist()
+    patch_stop_y_list = tmp_y[selected].tolist()
+    selected_num_patches = len(patch_start_x_list)
     print(selected_num_patches, total_num_patches)
     return patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list
 
@@ -144,23 +181,19 @@ def calc_patches_cord(list_binary_img, patch_level, svs_file, patch_dir, samp, p
 
 
 def create_summary_img(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                       toplevel, patch_level, svs_file):
-
-    OSobj = openslide.OpenSlide(svs_file)
+                       slide, patch_level):
+    toplevel = slide.toplevel
     poly_included = []
     poly_excluded = []
     name = ""
     for i in range(0, len(patch_stop_x_list), 1):
-        x1 = int((patch_start_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        x2 = int((patch_stop_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y1 = int((patch_start_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y2 = int((patch_stop_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
+        x1 = int((patch_start_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        x2 = int((patch_stop_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y1 = int((patch_start_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y2 = int((patch_stop_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
         poly_included.append(Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]))
 
-    patch_sub_size_x = toplevel[0]
-    patch_sub_size_y = toplevel[1]
-
-    img_patch = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
+    img_patch = slide.get_thumbnail()
     np_img = np.array(img_patch)
     patch_sub_size_y = np_img.shape[0]
     patch_sub_size_x = np_img.shape[1]
@@ -200,25 +233,155 @@ def patch_feature_extraction_resnet(input_shape=(256, 256, 3)):
     return res50, adaptive_mean_spatial_layer
 
 
-def patch_feature_extraction(image_string, res50, adaptive_mean_spatial_layer, input_shape=(256, 256, 3)):
+def patch_feature_extractor(res50, adaptive_mean_spatial_layer):
+    """
+    Args:
+        res50, adaptive_mean_spatial_layer:  the outputs of patch_feature_extraction_resnet
+    :return: extract:  one compiled forward pass from a (B, H, W, 3) uint8 batch of patches to their (B, 1024)
+             float32 feature vectors, the resnet50 preprocessing, the per image standardization and the adaptive
+             mean-spatial pooling all in-graph, traced once for every batch size and patch size
+    """
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.uint8)])
+    def extract(image_batch):
+        image_patch = tf.keras.applications.resnet50.preprocess_input(tf.cast(image_batch, tf.float32))
+        image_patch = tf.image.per_image_standardization(image_patch)
+        return adaptive_mean_spatial_layer(res50(image_patch, training=False))
+
+    return extract
+
+
+def patch_feature_extraction(image_batch, extract, feature_dtype='float32'):
+    """
+    Args:
+        image_batch:  list of (H, W, 3) uint8 numpy patches, all of the same size
+        extract:  the compiled forward pass of patch_feature_extractor
+        feature_dtype:  float32, or float16 to halve the stored feature bytes
+    :return: features:  list of Feature Vectors in the order of image_batch, raw little-endian feature_dtype bytes,
+             see _feature_schema
+    """
+
+    features = extract(np.stack(image_batch))
+    features = tf.cast(features, feature_dtype).numpy().astype(np.dtype(feature_dtype).newbyteorder('<'))
+
+    return [feature.tobytes() for feature in features]
+
+
+'''writing the records of a batch of patches, in patch order'''
+
+
+def write_patch_records(writer, patch_batch, image_features, feature_dtype, record_sizes):
+    """
+    Args:
+        patch_batch:  list of (feature, image_np), the tfrecord features of a patch still without its image_feature
+                      and its (H, W, 3) uint8 numpy patch, in patch order
+        image_features:  the feature vectors of patch_batch, see patch_feature_extraction
+        record_sizes:  the sizes of the written records get appended, see _write_tfrecord_index
+    """
+    for (feature, image_np), image_feature in zip(patch_batch, image_features):
+        feature['image_feature'] = _bytes_feature(image_feature)
+        feature.update(_feature_schema(image_feature, feature_dtype))
+        Example = tf.train.Example(features=tf.train.Features(feature=feature))
+        Serialized = Example.SerializeToString()
+        writer.write(Serialized)
+        record_sizes.append(len(Serialized) + 16)
+
+
+'''reading a patch and building its tfrecord features, run by the reader threads of create_tfrecord'''
+
+
+def read_patch(OSobj, coords, patch_level, patch_size, samp, patch_dir, mut_type, feature_only, keep_patches=False):
+    """
+    Args:
+        OSobj:  the OpenSlide handle of the calling reader thread
+        coords:  the (x1, y1, x2, y2) level 0 box of the patch
+        keep_patches:  also write the JPEG of the patch into patch_dir as image_name, patch_dir be left alone otherwise
+    :return: (feature, image_np):  the tfrecord features of the patch without its image_feature, and the patch
+    """
+    x1, y1, x2, y2 = coords
+    img = OSobj.read_region((x1, y1), patch_level, (patch_size, patch_size))
+    img = img.convert('RGB')
+
+    if not feature_only or keep_patches:
+        '''Change to grey scale'''
+        grey_img = img.convert('L')
+        '''Convert the image into numpy array'''
+        np_grey = np.array(grey_img)
+        patch_mean = round(np.mean(np_grey), 2)
+        patch_std = round(np.std(np_grey), 2)
+        '''encoding the patch once in memory, the size in its image_name be the size of that JPEG'''
+        imgByteArr = io.BytesIO()
+        img.save(imgByteArr, format='JPEG')
+        image_string = imgByteArr.getvalue()
+        size_bytes = len(image_string)
+        image_name = samp + "_x_" + str(x1) + "_" + str(x2) + "_y_" + str(y1) + "_" + str(y2) + '_' + str(
+            patch_mean) + '_' + str(patch_std) + '_' + str(size_bytes) + ".jpg"
+        if keep_patches:
+            with open(os.path.join(patch_dir, image_name), 'wb') as patch_file:
+                patch_file.write(image_string)
+
+    if feature_only:
+        '''writing feature-only tfrecord, the patch itself can be re-read from the slide with fetch_patch'''
+        feature = {'label': _int64_feature(mut_type),
+                   'coords': _int64_list_feature([x1, y1, x2, y2]),
+                   'patch_level': _int64_feature(patch_level)}
+    else:
+        image_format = 'jpeg'
+        '''writing tfrecord'''
+        feature = {'height': _int64_feature(patch_size),
+                   'width': _int64_feature(patch_size),
+                   'depth': _int64_feature(3),
+                   'label': _int64_feature(mut_type),
+                   'image/format': _bytes_feature(image_format.encode('utf8')),
+                   'image_name': _bytes_feature(image_name.encode('utf8')),
+                   'image/encoded': _bytes_feature(image_string)}
+
+    return feature, np.array(img)
+
+
+'''bounded, ordered queue between the reader threads and the feature extraction'''
+
+
+def ordered_reads(pool, read, items, queue_size):
     """
     Args:
-        image_string:  bytes(PIL_image)
-    :return: features:  Feature Vectors, float32
+        pool:  the concurrent.futures.ThreadPoolExecutor of the reader threads
+        read:  the function reading one item
+        queue_size:  the most reads in flight or done but not yet taken, the readers wait once it be reached
+    :return: the results of read over items, in the order of items
     """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(read, item))
+        if len(pending) >= queue_size:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
 
-    image_np = np.array(image_string)
+'''per-stage throughput counters of create_tfrecord'''
 
-    image_batch = np.expand_dims(image_np, axis=0)
-    image_patch = tf.keras.applications.resnet50.preprocess_input(image_batch.copy())
-    image_patch = tf.image.per_image_standardization(image_patch).numpy()
-    ## Return the feature vectors
-    predicts = res50.predict(image_patch)
-    features = adaptive_mean_spatial_layer(predicts)
-    features = tf.io.serialize_tensor(features)
-    img_features = features.numpy()
 
-    return img_features
+def count_stage(stage_stats, stage, n_patches, start_time, lock):
+    """Adds n_patches and the time since start_time to the counters of stage."""
+    with lock:
+        stage_stats[stage]['patches'] += n_patches
+        stage_stats[stage]['busy'] += time.time() - start_time
+
+
+def report_stage_stats(stage_stats, wall_time):
+    """
+    Prints the patches and busy time of every stage, and the patches/s the stage could sustain on its own over its
+    threads. The stage with the lowest capacity be the bottleneck, the other stages spend their time waiting on it.
+    """
+    capacities = {}
+    for stage, stats in stage_stats.items():
+        capacities[stage] = stats['patches'] / max(stats['busy'], 1e-9) * stats['threads']
+        print("Stage %8s: %d patches, %.1f s busy over %d thread(s), %.1f patches/s capacity" % (
+            stage, stats['patches'], stats['busy'], stats['threads'], capacities[stage]))
+    n_patches = stage_stats['write']['patches']
+    print("Wrote %d patches in %.1f s, %.1f patches/s, bottleneck %s" % (
+        n_patches, wall_time, n_patches / max(wall_time, 1e-9), min(capacities, key=capacities.get)))
 
 
 '''TF2 helper functions for TF Records'''
@@ -245,66 +408,173 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
+'''record schema of the image_feature, 2 be raw little-endian bytes, 1 the tf.io.serialize_tensor of old tfrecords'''
+
+
+def _feature_schema(image_feature, feature_dtype):
+    """Returns the schema version, dtype and dimension features of a raw image_feature."""
+    return {'feature_schema': _int64_feature(2),
+            'feature_dtype': _bytes_feature(feature_dtype.encode('utf8')),
+            'feature_dim': _int64_feature(len(image_feature) // np.dtype(feature_dtype).itemsize)}
+
+
+'''sidecar record index of a tfrecord, one "offset size" line per record, see load_tfrecord_index in UTILITY/util.py'''
+
+
+def _write_tfrecord_index(tf_file, record_sizes):
+    """Writes the byte offset and size of every record of tf_file, each record be framed with 16 bytes. The offsets of
+    a compressed tf_file be offsets into its uncompressed record stream."""
+    offset = 0
+    with open(tf_file + '.index', 'w') as f:
+        for record_size in record_sizes:
+            f.write(str(offset) + ' ' + str(record_size) + '\n')
+            offset = offset + record_size
+
+
+'''file name suffix of a compressed tfrecord, see tfrecord_compression in UTILITY/util.py'''
+
+TFRECORD_SUFFIXES = {'': '.tfrecords', 'GZIP': '.tfrecords.gz', 'ZLIB': '.tfrecords.zz'}
+
+
+def _int64_list_feature(value):
+    """Returns an int64_list from a list of bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+'''re-reading a patch of a feature-only tfrecord from its slide'''
+
+
+def fetch_patch(svs_file, coords, patch_level):
+    """
+    Args:
+        svs_file:  the slide the tfrecord was created from
+        coords:  the (x1, y1, x2, y2) level 0 box of the patch, the coords feature of a feature-only tfrecord
+        patch_level:  the level the patch was extracted at, the patch_level feature of a feature-only tfrecord
+    :return: img:  the RGB PIL image of the patch, as create_tfrecord read it
+    """
+    OSobj = openslide.OpenSlide(svs_file)
+    x1, y1, x2, y2 = [int(i) for i in coords]
+    patch_size = int(round((x2 - x1) / OSobj.level_downsamples[patch_level]))
+    img = OSobj.read_region((x1, y1), patch_level, (patch_size, patch_size))
+    img = img.convert('RGB')
+    OSobj.close()
+
+    return img
+
+
 '''extracting patches and creating tfrecords'''
 
 
 def create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                    patch_level, svs_file, toplevel, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
-                    patch_byte_cutoff):
+                    patch_level, slide, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
+                    patch_byte_cutoff, feature_dtype='float32', feature_only=False, compression='', batch_size=64,
+                    n_readers=4, queue_size=256, keep_patches=False):
+    """
+    Three stages connected by bounded queues: n_readers threads with an OpenSlide handle each read the patches and
+    build their tfrecord features, the calling thread extracts the feature vectors batch_size patches at a time, and
+    a single writer thread writes the records in patch order. At most queue_size patches wait between the readers and
+    the extraction, and queue_size // batch_size batches between the extraction and the writer, a stage running
+    ahead blocks until the next one catches up. The patches get JPEG encoded in memory, patch_dir only gets a copy of
+    them with keep_patches.
+    """
 
-    writer = tf.io.TFRecordWriter(os.path.join(tf_output, samp + '.tfrecords'))
+    tf_file = os.path.join(tf_output, samp + TFRECORD_SUFFIXES[compression])
+    writer = tf.io.TFRecordWriter(tf_file, options=tf.io.TFRecordOptions(compression_type=compression))
+    record_sizes = []
 
-    OSobj = openslide.OpenSlide(svs_file)
+    toplevel = slide.toplevel
     poly_included = []
     res50, adaptive_mean_spatial_layer = patch_feature_extraction_resnet()
-    for i in range(0, len(patch_start_x_list), 1):
-        x1 = int(patch_start_x_list[i] * OSobj.level_downsamples[patch_level])
-        x2 = int(patch_stop_x_list[i] * OSobj.level_downsamples[patch_level])
-        y1 = int(patch_start_y_list[i] * OSobj.level_downsamples[patch_level])
-        y2 = int(patch_stop_y_list[i] * OSobj.level_downsamples[patch_level])
-        img = OSobj.read_region((x1, y1), patch_level, (patch_size, patch_size))
-        img = img.convert('RGB')
+    extract = patch_feature_extractor(res50, adaptive_mean_spatial_layer)
 
-        '''Change to grey scale'''
-        grey_img = img.convert('L')
-        '''Convert the image into numpy array'''
-        np_grey = np.array(grey_img)
-        patch_mean = round(np.mean(np_grey), 2)
-        patch_std = round(np.std(np_grey), 2)
-        height = patch_size
-        width = patch_size
-        imgByteArr = io.BytesIO()
-        img.save(imgByteArr, format='PNG')
-        size_bytes = imgByteArr.tell()
-        image_name = samp + "_x_" + str(x1) + "_" + str(x2) + "_y_" + str(y1) + "_" + str(y2) + '_' + str(
-            patch_mean) + '_' + str(patch_std) + '_' + str(size_bytes) + ".jpg"
-        img.save(patch_dir + '/' + image_name, format='JPEG')
-        image_string = open(patch_dir + '/' + image_name, 'rb').read()
-        image_feature = patch_feature_extraction(img, res50, adaptive_mean_spatial_layer, (patch_size, patch_size, 3))
-        image_format = 'jpeg'
-        '''writing tfrecord'''
-        feature = {'height': _int64_feature(patch_size),
-                   'width': _int64_feature(patch_size),
-                   'depth': _int64_feature(3),
-                   'label': _int64_feature(mut_type),
-                   'image/format': _bytes_feature(image_format.encode('utf8')),
-                   'image_name': _bytes_feature(image_name.encode('utf8')),
-                   'image/encoded': _bytes_feature(image_string),
-                   'image_feature': _bytes_feature(image_feature)}
-        os.remove(patch_dir + '/' + image_name)
-        Example = tf.train.Example(features=tf.train.Features(feature=feature))
-        Serialized = Example.SerializeToString()
-        writer.write(Serialized)
-        '''preparing the summary thumbnail'''
-        x1 = int((patch_start_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        x2 = int((patch_stop_x_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y1 = int((patch_start_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
-        y2 = int((patch_stop_y_list[i] * OSobj.level_downsamples[patch_level]) / toplevel[2])
+    patch_coords = []
+    for i in range(0, len(patch_start_x_list), 1):
+        x1 = int(patch_start_x_list[i] * slide.level_downsamples[patch_level])
+        x2 = int(patch_stop_x_list[i] * slide.level_downsamples[patch_level])
+        y1 = int(patch_start_y_list[i] * slide.level_downsamples[patch_level])
+        y2 = int(patch_stop_y_list[i] * slide.level_downsamples[patch_level])
+        patch_coords.append((x1, y1, x2, y2))
+
+    stage_stats = {'read': {'patches': 0, 'busy': 0.0, 'threads': n_readers},
+                   'extract': {'patches': 0, 'busy': 0.0, 'threads': 1},
+                   'write': {'patches': 0, 'busy': 0.0, 'threads': 1}}
+    stats_lock = threading.Lock()
+    start_time = time.time()
+
+    '''reader threads, each opening its own OpenSlide handle on its first patch'''
+    reader_local = threading.local()
+    reader_handles = []
+
+    def _read(coords):
+        read_start = time.time()
+        if not hasattr(reader_local, 'OSobj'):
+            reader_local.OSobj = openslide.OpenSlide(slide.svs_file)
+            with stats_lock:
+                reader_handles.append(reader_local.OSobj)
+        patch = read_patch(reader_local.OSobj, coords, patch_level, patch_size, samp, patch_dir, mut_type,
+                           feature_only, keep_patches)
+        count_stage(stage_stats, 'read', 1, read_start, stats_lock)
+        return patch
+
+    '''single writer thread, its errors get raised again by the calling thread'''
+    write_queue = queue.Queue(maxsize=max(queue_size // batch_size, 1))
+    write_errors = []
+
+    def _write():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            if len(write_errors) > 0:
+                continue
+            write_start = time.time()
+            try:
+                write_patch_records(writer, item[0], item[1], feature_dtype, record_sizes)
+            except Exception as e:
+                write_errors.append(e)
+            count_stage(stage_stats, 'write', len(item[0]), write_start, stats_lock)
+
+    def _extract(patch_batch):
+        if len(write_errors) > 0:
+            raise write_errors[0]
+        extract_start = time.time()
+        image_features = patch_feature_extraction([image_np for feature, image_np in patch_batch], extract,
+                                                  feature_dtype)
+        count_stage(stage_stats, 'extract', len(patch_batch), extract_start, stats_lock)
+        write_queue.put((patch_batch, image_features))
+
+    writer_thread = threading.Thread(target=_write)
+    writer_thread.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_readers) as pool:
+            patch_batch = []
+            for patch in ordered_reads(pool, _read, patch_coords, queue_size):
+                patch_batch.append(patch)
+                if len(patch_batch) == batch_size:
+                    _extract(patch_batch)
+                    patch_batch = []
+            if len(patch_batch) > 0:
+                _extract(patch_batch)
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+        for reader_OSobj in reader_handles:
+            reader_OSobj.close()
+    if len(write_errors) > 0:
+        raise write_errors[0]
+    writer.close()
+    _write_tfrecord_index(tf_file, record_sizes)
+    report_stage_stats(stage_stats, time.time() - start_time)
+
+    '''preparing the summary thumbnail'''
+    for i in range(0, len(patch_start_x_list), 1):
+        x1 = int((patch_start_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        x2 = int((patch_stop_x_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y1 = int((patch_start_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
+        y2 = int((patch_stop_y_list[i] * slide.level_downsamples[patch_level]) / toplevel[2])
         poly_included.append(Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]))
 
-    patch_sub_size_x = toplevel[0]
-    patch_sub_size_y = toplevel[1]
-    img_patch = OSobj.get_thumbnail((patch_sub_size_x, patch_sub_size_y))
+    img_patch = slide.get_thumbnail()
 
     np_img = np.array(img_patch)
     patch_sub_size_y = np_img.shape[0]
@@ -344,6 +614,13 @@ def main():
     print("Entered patch_byte_cutoff " + arg.patch_byte_cutoff)
     print("Entered RGB2labthreshold Threshold std cutoff " + arg.rgb2hed_thresh)
     print("Entered mut type " + arg.mut_type)
+    print("Entered feature dtype " + arg.feature_dtype)
+    print("Entered feature only " + arg.feature_only)
+    print("Entered compression " + arg.compression)
+    print("Entered batch size " + arg.batch_size)
+    print("Entered reader threads " + arg.n_readers)
+    print("Entered queue size " + arg.queue_size)
+    print("Entered keep patches " + arg.keep_patches)
     patch_sub_size = int(arg.patch_size)
     rgb2hed_thresh = arg.rgb2hed_thresh
     patch_dir = arg.patch_dir
@@ -361,24 +638,25 @@ def main():
 
     '''Reading TCGA file'''
     samp = os.path.basename(svs_file)
-
-    '''creating binary mask to inspect areas with tissue and performance of threshold'''
-    list_binary_img, toplevel = create_binary_mask_new(rgb2hed_thresh, svs_file, patch_dir, samp)
-    '''extracting patch coordinates for requested level based on threshold'''
-    patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list = calc_patches_cord(list_binary_img,
-                                                                                                     patch_level,
-                                                                                                     svs_file,
-                                                                                                     patch_dir, samp,
-                                                                                                     patch_size,
-                                                                                                     threshold_area_percent,
-                                                                                                     toplevel)
-    '''creating summary image of toplevel with over lay of selected patches'''
-    create_summary_img(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                       toplevel, patch_level, svs_file)
-    '''extracting patches and creating tfrecords'''
-    create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
-                    patch_level, svs_file, toplevel, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
-                    patch_byte_cutoff)
+    '''opening the slide once, its thumbnail and tissue mask get shared by all the stages below'''
+    slide = SlideContext(svs_file)
+    try:
+        '''creating binary mask to inspect areas with tissue and performance of threshold'''
+        create_binary_mask_new(rgb2hed_thresh, slide, patch_dir, samp)
+        '''extracting patch coordinates for requested level based on threshold'''
+        patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list = calc_patches_cord(
+            slide, patch_level, patch_dir, samp, patch_size, threshold_area_percent)
+        '''creating summary image of toplevel with over lay of selected patches'''
+        create_summary_img(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp,
+                           patch_dir, slide, patch_level)
+        '''extracting patches and creating tfrecords'''
+        create_tfrecord(patch_start_x_list, patch_stop_x_list, patch_start_y_list, patch_stop_y_list, samp, patch_dir,
+                        patch_level, slide, tf_output, patch_size, mut_type, threshold_mean, threshold_std,
+                        patch_byte_cutoff, arg.feature_dtype, arg.feature_only == "True",
+                        "" if arg.compression == "None" else arg.compression, int(arg.batch_size),
+                        int(arg.n_readers), int(arg.queue_size), arg.keep_patches == "True")
+    finally:
+        slide.close()
 
 
 if __name__ == "__main__":
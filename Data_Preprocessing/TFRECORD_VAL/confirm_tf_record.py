@@ -7,9 +7,11 @@ import numpy as np
 import os
 tf_files=os.listdir(tfrecord_dir)
 for i in tf_files:
-	if 'tfrecord' in i:
+	if 'tfrecord' in i and not i.endswith('.index'):
 		tfrecord=tfrecord_dir+'/'+i
-		for example in tf.compat.v1.python_io.tf_record_iterator(tfrecord):
+		# .tfrecords.gz and .tfrecords.zz be GZIP and ZLIB compressed
+		compression={'.gz':'GZIP','.zz':'ZLIB'}.get(os.path.splitext(i)[1],'')
+		for example in tf.compat.v1.python_io.tf_record_iterator(tfrecord, options=tf.io.TFRecordOptions(compression_type=compression)):
 			result = tf.train.Example.FromString(example)
 			z1=100
 			z2="NA"
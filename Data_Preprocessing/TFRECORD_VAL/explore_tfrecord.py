@@ -4,12 +4,16 @@ tcga_dir = '/path/'
 
 import tensorflow as tf
 import io
+import os
 from PIL import Image
 import numpy as np
 
 
 def _examine_tfrecord(tfrecord):
-    for example in tf.compat.v1.python_io.tf_record_iterator(tfrecord):
+    # .tfrecords.gz and .tfrecords.zz be GZIP and ZLIB compressed
+    compression = {'.gz': 'GZIP', '.zz': 'ZLIB'}.get(os.path.splitext(tfrecord)[1], '')
+    options = tf.io.TFRecordOptions(compression_type=compression)
+    for example in tf.compat.v1.python_io.tf_record_iterator(tfrecord, options=options):
         result = tf.train.Example.FromString(example)
         for k, v in result.features.feature.items():
             if k == 'image/encoded':
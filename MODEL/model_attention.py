@@ -58,16 +58,26 @@ class NG_Att_Net(tf.keras.Model):
         return attention_model
 
     def call(self, img_features):
-        h = list()
-        A = list()
+        """
+        Args:
+            img_features -> stacked instance-level feature vectors of one bag, shape be (N, 1024), or a padded
+                            multi-slide batch of shape (B, N, 1024); a list of N (1, 1024) feature vectors is still
+                            accepted, in which case h and A come back as lists
+        """
+        if isinstance(img_features, (list, tuple)):
+            h, A = self.call(tf.concat(img_features, axis=0))
+            return tf.split(h, len(img_features)), tf.split(A, len(img_features))
+
+        if img_features.shape.rank == 3:
+            # the B slides run through the networks as one (B * N, 1024) bag
+            n_slides = tf.shape(img_features)[0]
+            h, A = self.call(tf.reshape(img_features, (-1, img_features.shape[-1])))
+            return tf.reshape(h, (n_slides, -1, h.shape[-1])), tf.reshape(A, (n_slides, -1, A.shape[-1]))
+
+        att_model = self.att_model()
+        h = att_model[0](img_features)  # shape be (N, 512)
+        A = att_model[1](h)  # shape be (N, n_class)
 
-        for i in img_features:
-            c_imf = self.att_model()[0](i)
-            h.append(c_imf)
-
-        for j in h:
-            a = self.att_model()[1](j)
-            A.append(a)
         return h, A
 
 
@@ -148,18 +158,28 @@ class G_Att_Net(tf.keras.Model):
         return attention_model
 
     def call(self, img_features):
-        h = list()
-        A = list()
-
-        for i in img_features:
-            c_imf = self.att_model()[0](i)
-            h.append(c_imf)
+        """
+        Args:
+            img_features -> stacked instance-level feature vectors of one bag, shape be (N, 1024), or a padded
+                            multi-slide batch of shape (B, N, 1024); a list of N (1, 1024) feature vectors is still
+                            accepted, in which case h and A come back as lists
+        """
+        if isinstance(img_features, (list, tuple)):
+            h, A = self.call(tf.concat(img_features, axis=0))
+            return tf.split(h, len(img_features)), tf.split(A, len(img_features))
+
+        if img_features.shape.rank == 3:
+            # the B slides run through the networks as one (B * N, 1024) bag
+            n_slides = tf.shape(img_features)[0]
+            h, A = self.call(tf.reshape(img_features, (-1, img_features.shape[-1])))
+            return tf.reshape(h, (n_slides, -1, h.shape[-1])), tf.reshape(A, (n_slides, -1, A.shape[-1]))
+
+        att_model = self.att_model()
+        h = att_model[0](img_features)  # shape be (N, 512)
+
+        att_v_output = att_model[1](h)
+        att_u_output = att_model[2](h)
+        att_input = tf.math.multiply(att_v_output, att_u_output)
+        A = att_model[3](att_input)  # shape be (N, n_class)
 
-        for j in h:
-            att_v_output = self.att_model()[1](j)
-            att_u_output = self.att_model()[2](j)
-            att_input = tf.math.multiply(att_v_output, att_u_output)
-            a = self.att_model()[3](att_input)
-            A.append(a)
-
-        return h, A
\ No newline at end of file
+        return h, A
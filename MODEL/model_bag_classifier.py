@@ -1,5 +1,17 @@
 import tensorflow as tf
-import numpy as np
+
+
+def slide_batch_inputs(A, h, bag_label, bag_mask, n_class, dim_compress_features):
+    # lift the inputs of a single slide to a batch of one, (B, N, ...) inputs of a multi-slide batch pass as they be
+    slide_batch = not isinstance(h, (list, tuple)) and h.shape.rank == 3
+    if not slide_batch:
+        A = tf.reshape(A, (1, -1, n_class))  # shape be (1,N,2)
+        h = tf.reshape(h, (1, -1, dim_compress_features))  # shape be (1,N,512)
+        bag_label = tf.reshape(bag_label, (1,))
+        if bag_mask is not None:
+            bag_mask = tf.reshape(bag_mask, (1, -1))
+
+    return A, h, bag_label, bag_mask, slide_batch
 
 
 class S_Bag(tf.keras.Model):
@@ -18,27 +30,41 @@ class S_Bag(tf.keras.Model):
     def bag_classifier(self):
         return self.s_bag_model
 
-    def h_slide(self, A, h):
-        # compute the slide-level representation aggregated per the attention score distribution for the mth class
-        SAR = list()
-        for i in range(len(A)):
-            sar = tf.linalg.matmul(tf.transpose(A[i]), h[i])  # shape be (2,512)
-            SAR.append(sar)
-        slide_agg_rep = tf.math.add_n(SAR)  # return h_[slide,m], shape be (2,512)
+    def h_slide(self, A, h, bag_mask=None):
+        # compute the slide-level representation aggregated per the attention score distribution for the mth class,
+        # A and h be (B, N, 2) and (B, N, 512), see call
+        # aggregate in float32 (the dtype of the softmax-ed A), a float16 sum over a whole slide may overflow
+        h = tf.cast(h, A.dtype)
+        if bag_mask is not None:
+            A = A * tf.expand_dims(bag_mask, axis=-1)  # padded instances of a padded bag add nothing
+        slide_agg_rep = tf.linalg.matmul(A, h, transpose_a=True)  # return h_[slide,m], shape be (B,2,512)
 
         return slide_agg_rep
 
-    def call(self, bag_label, A, h):
-        slide_agg_rep = self.h_slide(A, h)
+    def call(self, bag_label, A, h, bag_mask=None):
+        """
+        Args:
+            bag_label -> ground-truth slide label, or the (B,) slide labels of a multi-slide batch
+            A -> (N, n_class) softmax-ed attention scores, or (B, N, n_class) for a padded multi-slide batch
+            h -> (N, 512) compressed instance-level feature vectors, or (B, N, 512)
+            bag_mask -> optional (N,) or (B, N) validity mask of padded bags, 1 for real instances and 0 for padding
+        predict_slide_label be a scalar for a single slide and (B,) for a multi-slide batch, the other outputs always
+        carry a leading slide axis, which be 1 for a single slide as before
+        """
+        A, h, bag_label, bag_mask, slide_batch = slide_batch_inputs(A, h, bag_label, bag_mask,
+                                                                    self.n_class, self.dim_compress_features)
+
+        slide_agg_rep = self.h_slide(A, h, bag_mask)
         bag_classifier = self.bag_classifier()
-        slide_score_unnorm = bag_classifier(slide_agg_rep)
-        slide_score_unnorm = tf.reshape(slide_score_unnorm, (1, self.n_class))
-        Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][-1]
-        Y_prob = tf.math.softmax(
-            tf.reshape(slide_score_unnorm, (1, self.n_class)))  # shape be (1,2), predictions for each of the classes
-        predict_slide_label = np.argmax(Y_prob.numpy())
+        slide_score_unnorm = tf.cast(bag_classifier(slide_agg_rep), tf.float32)
+        slide_score_unnorm = tf.reshape(slide_score_unnorm, (-1, self.n_class))
+        Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][:, -1]
+        Y_prob = tf.math.softmax(slide_score_unnorm)  # shape be (B,2), predictions for each of the classes
+        predict_slide_label = tf.math.argmax(Y_prob, axis=-1)
+        if not slide_batch:
+            predict_slide_label = predict_slide_label[0]
 
-        Y_true = tf.one_hot([bag_label], 2)
+        Y_true = tf.one_hot(bag_label, 2)
 
         return slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true
 
@@ -61,44 +87,39 @@ class M_Bag(tf.keras.Model):
     def bag_classifier(self):
         return self.m_bag_models
 
-    def h_slide(self, A, h):
-        # compute the slide-level representation aggregated per the attention score distribution for the mth class
-        SAR = list()
-        for i in range(len(A)):
-            sar = tf.linalg.matmul(tf.transpose(A[i]), h[i])  # shape be (2,512)
-            SAR.append(sar)
-
-        SAR_Branch = list()
-        for i in range(self.n_class):
-            sar_branch = list()
-            for j in range(len(SAR)):
-                sar_c = tf.reshape(SAR[j][i], (1, self.dim_compress_features))
-                sar_branch.append(sar_c)
-            SAR_Branch.append(sar_branch)
-
-        slide_agg_rep = list()
-        for k in range(self.n_class):
-            slide_agg_rep.append(tf.math.add_n(SAR_Branch[k]))
+    def h_slide(self, A, h, bag_mask=None):
+        # compute the slide-level representation aggregated per the attention score distribution for the mth class,
+        # row m of the result be the branch fed into the mth bag classifier, A and h be (B, N, 2) and (B, N, 512)
+        # aggregate in float32 (the dtype of the softmax-ed A), a float16 sum over a whole slide may overflow
+        h = tf.cast(h, A.dtype)
+        if bag_mask is not None:
+            A = A * tf.expand_dims(bag_mask, axis=-1)  # padded instances of a padded bag add nothing
+        slide_agg_rep = tf.linalg.matmul(A, h, transpose_a=True)  # shape be (B,2,512)
 
         return slide_agg_rep
 
-    def call(self, bag_label, A, h):
-        slide_agg_rep = self.h_slide(A, h)
+    def call(self, bag_label, A, h, bag_mask=None):
+        """
+        Args and outputs as S_Bag.call
+        """
+        A, h, bag_label, bag_mask, slide_batch = slide_batch_inputs(A, h, bag_label, bag_mask,
+                                                                    self.n_class, self.dim_compress_features)
 
-        # return s_[slide,m] (slide-level prediction scores)
-        ssus = list()
-        for i in range(self.n_class):
-            bag_classifier = self.bag_classifier()[i]
-            ssu = bag_classifier(slide_agg_rep[i])
-            ssus.append(ssu[0][0])
+        slide_agg_rep = self.h_slide(A, h, bag_mask)
 
-        slide_score_unnorm = tf.convert_to_tensor(ssus)
-        slide_score_unnorm = tf.reshape(slide_score_unnorm, (1, self.n_class))
+        # return s_[slide,m] (slide-level prediction scores), every linear class head scored in one batched einsum
+        bag_layers = [bag_classifier.layers[-1] for bag_classifier in self.bag_classifier()]
+        bag_kernels = tf.stack([bag_layer.kernel for bag_layer in bag_layers])  # shape be (2,512,1)
+        bag_biases = tf.stack([bag_layer.bias for bag_layer in bag_layers])  # shape be (2,1)
+        slide_score_unnorm = tf.einsum('bmd,mdo->bmo', slide_agg_rep, bag_kernels) + bag_biases
+        slide_score_unnorm = tf.reshape(slide_score_unnorm, (-1, self.n_class))
 
-        Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][-1]
+        Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][:, -1]
         Y_prob = tf.math.softmax(slide_score_unnorm)
-        predict_slide_label = np.argmax(Y_prob.numpy())
+        predict_slide_label = tf.math.argmax(Y_prob, axis=-1)
+        if not slide_batch:
+            predict_slide_label = predict_slide_label[0]
 
-        Y_true = tf.one_hot([bag_label], 2)
+        Y_true = tf.one_hot(bag_label, 2)
 
-        return slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true
\ No newline at end of file
+        return slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true
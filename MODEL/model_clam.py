@@ -65,24 +65,32 @@ class S_CLAM(tf.keras.Model):
 
         return clam_model
 
-    def call(self, img_features, slide_label):
+    def call(self, img_features, slide_label, bag_mask=None):
         """
         Args:
-            img_features -> original 1024-dimensional instance-level feature vectors
-            slide_label -> ground-truth slide label, could be 0 or 1 for binary classification
+            img_features -> original 1024-dimensional instance-level feature vectors, or a padded (B, N, 1024)
+                            multi-slide batch
+            slide_label -> ground-truth slide label, could be 0 or 1 for binary classification, (B,) for a batch
+            bag_mask -> optional validity mask when img_features be a padded bag, 1 for real instances, 0 for padding,
+                        (B, N) for a multi-slide batch
         """
 
+        # stack the bag once, every network below works on the (N, 1024) tensor, or on the (B, N, 1024) batch
+        if isinstance(img_features, (list, tuple)):
+            img_features = tf.concat(img_features, axis=0)
+
         h, A = self.att_net.call(img_features)
         att_score = A  # output from attention network
-        A = tf.math.softmax(A)  # softmax on attention scores
+        A = tf.math.softmax(tf.cast(A, tf.float32))  # softmax on attention scores, kept in float32 under any policy
 
         if self.att_only:
             return att_score
 
         if self.mil_ins:
-            ins_labels, ins_logits_unnorm, ins_logits = self.ins_net.call(slide_label, h, A)
+            ins_labels, ins_logits_unnorm, ins_logits = self.ins_net.call(slide_label, h, A, bag_mask)
 
-        slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true = self.bag_net.call(slide_label, A, h)
+        slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true = self.bag_net.call(slide_label, A, h,
+                                                                                           bag_mask)
 
         return att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
                Y_prob, Y_hat, Y_true, predict_slide_label
@@ -148,24 +156,32 @@ class M_CLAM(tf.keras.Model):
 
         return clam_model
 
-    def call(self, img_features, slide_label):
+    def call(self, img_features, slide_label, bag_mask=None):
         """
         Args:
-            img_features -> original 1024-dimensional instance-level feature vectors
-            slide_label -> ground-truth slide label, could be 0 or 1 for binary classification
+            img_features -> original 1024-dimensional instance-level feature vectors, or a padded (B, N, 1024)
+                            multi-slide batch
+            slide_label -> ground-truth slide label, could be 0 or 1 for binary classification, (B,) for a batch
+            bag_mask -> optional validity mask when img_features be a padded bag, 1 for real instances, 0 for padding,
+                        (B, N) for a multi-slide batch
         """
 
+        # stack the bag once, every network below works on the (N, 1024) tensor, or on the (B, N, 1024) batch
+        if isinstance(img_features, (list, tuple)):
+            img_features = tf.concat(img_features, axis=0)
+
         h, A = self.att_net.call(img_features)
         att_score = A  # output from attention network
-        A = tf.math.softmax(A)  # softmax on attention scores
+        A = tf.math.softmax(tf.cast(A, tf.float32))  # softmax on attention scores, kept in float32 under any policy
 
         if self.att_only:
             return att_score
 
         if self.mil_ins:
-            ins_labels, ins_logits_unnorm, ins_logits = self.ins_net.call(slide_label, h, A)
+            ins_labels, ins_logits_unnorm, ins_logits = self.ins_net.call(slide_label, h, A, bag_mask)
 
-        slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true = self.bag_net.call(slide_label, A, h)
+        slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true = self.bag_net.call(slide_label, A, h,
+                                                                                           bag_mask)
 
         return att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
                Y_prob, Y_hat, Y_true, predict_slide_label
\ No newline at end of file
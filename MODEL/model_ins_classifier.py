@@ -24,111 +24,141 @@ class Ins(tf.keras.Model):
         return self.ins_model
 
     @staticmethod
-    def generate_pos_labels(n_pos_sample):
-        return tf.fill(dims=[n_pos_sample, ], value=1)
+    def generate_pos_labels(n_pos_sample, n_slides=1):
+        return tf.fill(dims=[n_slides, n_pos_sample], value=1)
 
     @staticmethod
-    def generate_neg_labels(n_neg_sample):
-        return tf.fill(dims=[n_neg_sample, ], value=0)
-
-    def in_call(self, n_ins, ins_classifier, h, A_I):
-        pos_label = self.generate_pos_labels(n_ins)
-        neg_label = self.generate_neg_labels(n_ins)
-        ins_label_in = tf.concat(values=[pos_label, neg_label], axis=0)
-        A_I = tf.reshape(tf.convert_to_tensor(A_I), (1, len(A_I)))
-
-        top_pos_ids = tf.math.top_k(A_I, n_ins)[1][-1]
-        pos_index = list()
-        for i in top_pos_ids:
-            pos_index.append(i)
-
-        pos_index = tf.convert_to_tensor(pos_index)
-        top_pos = list()
-        for i in pos_index:
-            top_pos.append(h[i])
-
-        top_neg_ids = tf.math.top_k(-A_I, n_ins)[1][-1]
-        neg_index = list()
-        for i in top_neg_ids:
-            neg_index.append(i)
-
-        neg_index = tf.convert_to_tensor(neg_index)
-        top_neg = list()
-        for i in neg_index:
-            top_neg.append(h[i])
-
-        ins_in = tf.concat(values=[top_pos, top_neg], axis=0)
-        logits_unnorm_in = list()
-        logits_in = list()
-
-        for i in range(self.n_class * n_ins):
-            ins_score_unnorm_in = ins_classifier(ins_in[i])
-            logit_in = tf.math.softmax(ins_score_unnorm_in)
-            logits_unnorm_in.append(ins_score_unnorm_in)
-            logits_in.append(logit_in)
+    def generate_neg_labels(n_neg_sample, n_slides=1):
+        return tf.fill(dims=[n_slides, n_neg_sample], value=0)
+
+    @staticmethod
+    def ignore_labels(ins_label, n_ins):
+        # candidates ranked past the per-slide n_ins only pad the fixed-size selection of a padded bag, label -1 makes
+        # the instance loss ignore them
+        return tf.where(tf.range(tf.shape(ins_label)[-1]) < tf.expand_dims(n_ins, axis=-1), ins_label, -1)
+
+    def top_k_count(self, n_samples):
+        n_ins = self.top_k_percent * tf.cast(n_samples, tf.float64)
+        n_ins = tf.cast(n_ins, tf.int32)
+        # if n_ins computed above is less than 0, make n_ins be default be 8
+        n_ins = tf.where(tf.math.equal(n_ins, 0), 8, n_ins)
+
+        return n_ins
+
+    def ins_logits(self, ins_classifier, ins):
+        # score the (B, k, 512) selected instances as one (B * k, 512) batch, the logits be kept in float32
+        logits_unnorm = ins_classifier(tf.reshape(ins, (-1, self.dim_compress_features)))
+        logits_unnorm = tf.reshape(tf.cast(logits_unnorm, tf.float32), (tf.shape(ins)[0], -1, self.n_class))
+        logits = tf.math.softmax(logits_unnorm)
+
+        return logits_unnorm, logits
+
+    def in_call(self, n_ins, ins_classifier, h, A_I, bag_mask=None, n_cand=None):
+        # h be (B, N, 512), A_I be (B, N), and n_ins the number of top k instances, per slide (B,) for padded bags
+        if bag_mask is None:
+            n_cand = n_ins
+            pos_score = A_I
+            neg_score = -A_I
+        else:
+            # padded instances rank below every real one for both the highest and the lowest attention scores
+            pos_score = tf.where(bag_mask > 0, A_I, float('-inf'))
+            neg_score = tf.where(bag_mask > 0, -A_I, float('-inf'))
+
+        n_slides = tf.shape(h)[0]
+        pos_label = self.generate_pos_labels(n_cand, n_slides)
+        neg_label = self.generate_neg_labels(n_cand, n_slides)
+        if bag_mask is not None:
+            pos_label = self.ignore_labels(pos_label, n_ins)
+            neg_label = self.ignore_labels(neg_label, n_ins)
+        ins_label_in = tf.concat(values=[pos_label, neg_label], axis=-1)
+
+        # top k instances w/ highest and lowest attention scores, gathered from the stacked h in one go
+        top_pos_ids = tf.math.top_k(pos_score, n_cand)[1]
+        top_neg_ids = tf.math.top_k(neg_score, n_cand)[1]
+        ins_in = tf.gather(h, tf.concat(values=[top_pos_ids, top_neg_ids], axis=-1),
+                           batch_dims=1)  # shape be (B, 2k, 512)
+
+        logits_unnorm_in, logits_in = self.ins_logits(ins_classifier, ins_in)  # shape be (B, 2k, n_class)
 
         return ins_label_in, logits_unnorm_in, logits_in
 
-    def out_call(self, n_ins, ins_classifier, h, A_O):
-        # get compressed 512-dimensional instance-level feature vectors for following use, denoted by h
-        A_O = tf.reshape(tf.convert_to_tensor(A_O), (1, len(A_O)))
-        top_pos_ids = tf.math.top_k(A_O, n_ins)[1][-1]
-        pos_index = list()
-        for i in top_pos_ids:
-            pos_index.append(i)
+    def out_call(self, n_ins, ins_classifier, h, A_O, bag_mask=None, n_cand=None):
+        if bag_mask is None:
+            n_cand = n_ins
+            pos_score = A_O
+        else:
+            pos_score = tf.where(bag_mask > 0, A_O, float('-inf'))
 
-        pos_index = tf.convert_to_tensor(pos_index)
-        top_pos = list()
-        for i in pos_index:
-            top_pos.append(h[i])
+        # get compressed 512-dimensional instance-level feature vectors for following use, denoted by h
+        top_pos_ids = tf.math.top_k(pos_score, n_cand)[1]
+        top_pos = tf.gather(h, top_pos_ids, batch_dims=1)  # shape be (B, k, 512)
 
         # mutually-exclusive -> top k instances w/ highest attention scores ==> false pos = neg
-        pos_ins_labels_out = self.generate_neg_labels(n_ins)
+        pos_ins_labels_out = self.generate_neg_labels(n_cand, tf.shape(h)[0])
+        if bag_mask is not None:
+            pos_ins_labels_out = self.ignore_labels(pos_ins_labels_out, n_ins)
         ins_label_out = pos_ins_labels_out
 
-        logits_unnorm_out = list()
-        logits_out = list()
-
-        for i in range(n_ins):
-            ins_score_unnorm_out = ins_classifier(top_pos[i])
-            logit_out = tf.math.softmax(ins_score_unnorm_out)
-            logits_unnorm_out.append(ins_score_unnorm_out)
-            logits_out.append(logit_out)
+        logits_unnorm_out, logits_out = self.ins_logits(ins_classifier, top_pos)  # shape be (B, k, n_class)
 
         return ins_label_out, logits_unnorm_out, logits_out
 
-    def call(self, bag_label, h, A):
-        n_ins = self.top_k_percent * len(h)
-        n_ins = int(n_ins)
-        # if n_ins computed above is less than 0, make n_ins be default be 8
-        if n_ins == 0:
-            n_ins += 8
+    def call(self, bag_label, h, A, bag_mask=None):
+        """
+        Args:
+            bag_label -> ground-truth slide label, or the (B,) slide labels of a multi-slide batch
+            h -> stacked (N, 512) compressed instance-level feature vectors, a list of (1, 512) ones gets stacked, or
+                 the (B, N, 512) ones of a padded multi-slide batch
+            A -> stacked (N, n_class) attention scores, a list of (1, n_class) ones gets stacked, or (B, N, n_class)
+            bag_mask -> optional (N,) or (B, N) validity mask of padded bags, 1 for real instances and 0 for padding
+        The outputs of a multi-slide batch carry a leading B axis, the ones of a single slide do not
+        """
+        slide_batch = not isinstance(h, (list, tuple)) and h.shape.rank == 3
+        if not slide_batch:
+            # a single slide be a batch of one
+            h = tf.reshape(h, (1, -1, self.dim_compress_features))
+            A = tf.reshape(A, (1, -1, self.n_class))
+            bag_label = tf.reshape(bag_label, (1,))
+            if bag_mask is not None:
+                bag_mask = tf.reshape(bag_mask, (1, -1))
+
+        # n_ins and the class branches are computed with tensor ops so that the same code runs eagerly and inside
+        # a tf.function, where neither the bag size nor bag_label be known while tracing
+        if bag_mask is None:
+            n_ins = self.top_k_count(tf.shape(h)[1])
+            n_cand = n_ins
+        else:
+            # n_ins follows the real instances of every slide, while the number of selected candidates follows the
+            # padded length so that it stays a constant for XLA. n_cand has to cover the n_ins of every slide, and a
+            # slide with few real instances falls back to 8 of them in top_k_count, so n_cand never goes below 8
+            n_valid = tf.cast(tf.math.reduce_sum(bag_mask, axis=-1), tf.int32)
+            n_ins = tf.math.minimum(self.top_k_count(n_valid), n_valid)
+            n_samples = h.shape[1] if h.shape[1] is not None else tf.shape(h)[1]
+            n_cand = tf.math.minimum(tf.math.maximum(self.top_k_count(n_samples), 8), n_samples)
 
-        for i in range(self.n_class):
-            ins_classifier = self.ins_classifier()[i]
-            if i == bag_label:
-                A_I = list()
-                for j in range(len(A)):
-                    a_i = A[j][0][i]
-                    A_I.append(a_i)
-                ins_label_in, logits_unnorm_in, logits_in = self.in_call(n_ins, ins_classifier, h, A_I)
-            else:
-                if self.mut_ex:
-                    A_O = list()
-                    for j in range(len(A)):
-                        a_o = A[j][0][i]
-                        A_O.append(a_o)
-                    ins_label_out, logits_unnorm_out, logits_out = self.out_call(n_ins, ins_classifier, h, A_O)
-                else:
-                    continue
+        # every class shares the same instance classifier model, see __init__
+        ins_classifier = self.ins_classifier()[0]
+
+        A_I = tf.gather(A, bag_label, axis=2, batch_dims=1)
+        ins_label_in, logits_unnorm_in, logits_in = self.in_call(n_ins, ins_classifier, h, A_I,
+                                                                 bag_mask=bag_mask, n_cand=n_cand)
 
         if self.mut_ex:
-            ins_labels = tf.concat(values=[ins_label_in, ins_label_out], axis=0)
-            ins_logits_unnorm = logits_unnorm_in + logits_unnorm_out
-            ins_logits = logits_in + logits_out
+            # the out-of-class branch be the last class other than bag_label
+            out_class = tf.where(tf.math.equal(bag_label, self.n_class - 1), self.n_class - 2, self.n_class - 1)
+            A_O = tf.gather(A, out_class, axis=2, batch_dims=1)
+            ins_label_out, logits_unnorm_out, logits_out = self.out_call(n_ins, ins_classifier, h, A_O,
+                                                                         bag_mask=bag_mask, n_cand=n_cand)
+
+            ins_labels = tf.concat(values=[ins_label_in, ins_label_out], axis=1)
+            ins_logits_unnorm = tf.concat(values=[logits_unnorm_in, logits_unnorm_out], axis=1)
+            ins_logits = tf.concat(values=[logits_in, logits_out], axis=1)
         else:
             ins_labels = ins_label_in
             ins_logits_unnorm = logits_unnorm_in
             ins_logits = logits_in
 
-        return ins_labels, ins_logits_unnorm, ins_logits
\ No newline at end of file
+        if not slide_batch:
+            return ins_labels[0], ins_logits_unnorm[0], ins_logits[0]
+
+        return ins_labels, ins_logits_unnorm, ins_logits
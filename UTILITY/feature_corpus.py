@@ -0,0 +1,97 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from UTILITY.util import read_tfrecord_records, read_tfrecord_features, read_tfrecord_coords, \
+    tfrecord_feature_dtype, feature_corpus_paths, is_feature_corpus, list_slides
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='pack the per-slide tfrecords of a data directory into one '
+                                                 'contiguous feature corpus with an offset index, usable as train, '
+                                                 'validation or test data directory in place of the tfrecords')
+
+    parser.add_argument('-i', '--tf_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the slide tfrecords to pack')
+
+    parser.add_argument('-o', '--corpus_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the packed feature corpus, created if missing')
+
+    parser.add_argument('-y', '--feature_dtype',
+                        type=str,
+                        default=None,
+                        choices=['float32', 'float16'],
+                        help='dtype of the packed features, default be the dtype the first tfrecord was stored in')
+
+    return parser
+
+
+def pack_feature_corpus(tf_dir, corpus_dir, feature_dtype=None):
+    """
+    Pack the tfrecords of tf_dir into the feature corpus of corpus_dir, see FeatureCorpus in UTILITY/util.py. A first
+    pass counts the patches of every slide, the second one decodes the slides one by one straight into the memory-
+    mapped feature and coordinate files, so packing never holds more than one slide in memory. The index gets written
+    last, a corpus_dir without it be an unfinished corpus and gets read as a plain directory.
+    """
+    if is_feature_corpus(data_path=corpus_dir):
+        raise ValueError('{} holds a feature corpus already'.format(corpus_dir))
+
+    sample_names = sorted(list_slides(data_path=tf_dir))
+    tf_paths = [os.path.join(tf_dir, sample_name) for sample_name in sample_names]
+
+    if feature_dtype is None:
+        feature_dtype = tfrecord_feature_dtype(tf_path=tf_paths[0]).name
+    n_patches = [sum(1 for record in read_tfrecord_records(tf_path=tf_path)) for tf_path in tf_paths]
+    n_dim = read_tfrecord_features(tf_path=tf_paths[0])[0].shape[-1]
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    feature_path, coords_path, index_path = feature_corpus_paths(corpus_path=corpus_dir)
+    features = np.lib.format.open_memmap(feature_path, mode='w+', dtype=feature_dtype, shape=(sum(n_patches), n_dim))
+    coords = np.lib.format.open_memmap(coords_path, mode='w+', dtype=np.int64, shape=(sum(n_patches), 4))
+
+    slide_labels = list()
+    offsets = np.concatenate([[0], np.cumsum(n_patches)[:-1]]).astype(np.int64)
+    for tf_path, offset, n in zip(tf_paths, offsets, n_patches):
+        img_features, slide_label = read_tfrecord_features(tf_path=tf_path)
+        features[offset:offset + n] = img_features
+        coords[offset:offset + n] = read_tfrecord_coords(tf_path=tf_path)
+        slide_labels.append(slide_label)
+        print('>', end="", flush=True)
+
+    features.flush()
+    coords.flush()
+    del features, coords
+
+    corpus_index = pd.DataFrame({'slide_id': sample_names,
+                                 'label': slide_labels,
+                                 'offset': offsets,
+                                 'n_patches': n_patches,
+                                 'coords_offset': offsets},
+                                columns=['slide_id', 'label', 'offset', 'n_patches', 'coords_offset'])
+    corpus_index.to_csv(index_path + '.tmp', sep='\t', index=False)
+    os.replace(index_path + '.tmp', index_path)
+
+    return len(sample_names), sum(n_patches)
+
+
+def main():
+    args = make_arg_parser().parse_args()
+
+    start_time = time.time()
+    n_slides, n_patches = pack_feature_corpus(tf_dir=args.tf_dir,
+                                              corpus_dir=args.corpus_dir,
+                                              feature_dtype=args.feature_dtype)
+
+    print('\n Packed {} slides, {} patches into {}, --- {:.1f} s ---'.format(n_slides, n_patches, args.corpus_dir,
+                                                                             time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 import tensorflow as tf
+import os
 import time
 
 from MODEL.model_clam import S_CLAM, M_CLAM
-from UTILITY.model_train import train_step
-from UTILITY.model_val import val_step
+from UTILITY.model_session import TrainingSession
 from UTILITY.model_test import test_step
-from UTILITY.util import model_save, restore_model, tf_shut_up, str_to_bool
+from UTILITY.util import model_save, restore_model, tf_shut_up, str_to_bool, warm_feature_cache
 
 
 def train_val(train_log, val_log, train_path, val_path, imf_norm_op, c_model,
@@ -14,83 +14,103 @@ def train_val(train_log, val_log, train_path, val_path, imf_norm_op, c_model,
               i_loss_name, b_loss_name, mut_ex, n_class, c1, c2,
               i_learn_rate, b_learn_rate, a_learn_rate,
               i_l2_decay, b_l2_decay, a_l2_decay, top_k_percent,
-              batch_size, batch_op, epochs):
+              batch_size, batch_op, compile_op, jit_compile, slide_batch_size, epochs,
+              checkpoint_dir=None, checkpoint_epochs=1, checkpoint_minutes=0, resume=False,
+              num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None,
+              bag_cache_bytes=0):
 
     train_summary_writer = tf.summary.create_file_writer(train_log)
     val_summary_writer = tf.summary.create_file_writer(val_log)
 
-    for epoch in range(epochs):
+    # built once for the whole run, the optimizer state and the compiled steps carry over from epoch to epoch
+    session = TrainingSession(c_model=c_model,
+                              train_path=train_path,
+                              val_path=val_path,
+                              imf_norm_op=imf_norm_op,
+                              i_wd_op_name=i_wd_op_name,
+                              b_wd_op_name=b_wd_op_name,
+                              a_wd_op_name=a_wd_op_name,
+                              i_optimizer_name=i_optimizer_name,
+                              b_optimizer_name=b_optimizer_name,
+                              a_optimizer_name=a_optimizer_name,
+                              i_loss_name=i_loss_name,
+                              b_loss_name=b_loss_name,
+                              mut_ex=mut_ex,
+                              n_class=n_class,
+                              c1=c1,
+                              c2=c2,
+                              i_learn_rate=i_learn_rate,
+                              b_learn_rate=b_learn_rate,
+                              a_learn_rate=a_learn_rate,
+                              i_l2_decay=i_l2_decay,
+                              b_l2_decay=b_l2_decay,
+                              a_l2_decay=a_l2_decay,
+                              top_k_percent=top_k_percent,
+                              batch_size=batch_size,
+                              batch_op=batch_op,
+                              compile_op=compile_op,
+                              jit_compile=jit_compile,
+                              slide_batch_size=slide_batch_size,
+                              checkpoint_dir=checkpoint_dir,
+                              checkpoint_epochs=checkpoint_epochs,
+                              checkpoint_minutes=checkpoint_minutes,
+                              num_parallel_reads=num_parallel_reads,
+                              prefetch_slides=prefetch_slides,
+                              feature_cache_dir=feature_cache_dir,
+                              bag_cache_bytes=bag_cache_bytes)
+
+    start_epoch = 0
+    if resume:
+        start_epoch = session.restore()
+
+    for epoch in range(start_epoch, epochs):
         # Training Step
         start_time = time.time()
 
         train_loss, train_ins_loss, train_bag_loss, train_tn, train_fp, train_fn, train_tp, \
-        train_sensitivity, train_specificity, \
-        train_acc, train_auc = train_step(c_model=c_model,
-                                          train_path=train_path,
-                                          imf_norm_op=imf_norm_op,
-                                          i_wd_op_name=i_wd_op_name,
-                                          b_wd_op_name=b_wd_op_name,
-                                          a_wd_op_name=a_wd_op_name,
-                                          i_optimizer_name=i_optimizer_name,
-                                          b_optimizer_name=b_optimizer_name,
-                                          a_optimizer_name=a_optimizer_name,
-                                          i_loss_name=i_loss_name,
-                                          b_loss_name=b_loss_name,
-                                          mut_ex=mut_ex,
-                                          n_class=n_class,
-                                          c1=c1,
-                                          c2=c2,
-                                          i_learn_rate=i_learn_rate,
-                                          b_learn_rate=b_learn_rate,
-                                          a_learn_rate=a_learn_rate,
-                                          i_l2_decay=i_l2_decay,
-                                          b_l2_decay=b_l2_decay,
-                                          a_l2_decay=a_l2_decay,
-                                          top_k_percent=top_k_percent,
-                                          batch_size=batch_size,
-                                          batch_op=batch_op)
+        train_sensitivity, train_specificity, train_acc, train_auc = session.train_epoch()
+
+        tb_step = int(session.tb_step)
 
         with train_summary_writer.as_default():
-            tf.summary.scalar('Total Loss', float(train_loss), step=epoch)
-            tf.summary.scalar('Instance Loss', float(train_ins_loss), step=epoch)
-            tf.summary.scalar('Bag Loss', float(train_bag_loss), step=epoch)
-            tf.summary.scalar('Accuracy', float(train_acc), step=epoch)
-            tf.summary.scalar('AUC', float(train_auc), step=epoch)
-            tf.summary.scalar('Sensitivity', float(train_sensitivity), step=epoch)
-            tf.summary.scalar('Specificity', float(train_specificity), step=epoch)
-            tf.summary.histogram('True Positive', int(train_tp), step=epoch)
-            tf.summary.histogram('False Positive', int(train_fp), step=epoch)
-            tf.summary.histogram('True Negative', int(train_tn), step=epoch)
-            tf.summary.histogram('False Negative', int(train_fn), step=epoch)
+            tf.summary.scalar('Total Loss', float(train_loss), step=tb_step)
+            tf.summary.scalar('Instance Loss', float(train_ins_loss), step=tb_step)
+            tf.summary.scalar('Bag Loss', float(train_bag_loss), step=tb_step)
+            tf.summary.scalar('Accuracy', float(train_acc), step=tb_step)
+            tf.summary.scalar('AUC', float(train_auc), step=tb_step)
+            tf.summary.scalar('Sensitivity', float(train_sensitivity), step=tb_step)
+            tf.summary.scalar('Specificity', float(train_specificity), step=tb_step)
+            tf.summary.histogram('True Positive', int(train_tp), step=tb_step)
+            tf.summary.histogram('False Positive', int(train_fp), step=tb_step)
+            tf.summary.histogram('True Negative', int(train_tn), step=tb_step)
+            tf.summary.histogram('False Negative', int(train_fn), step=tb_step)
 
         # Validation Step
         val_loss, val_ins_loss, val_bag_loss, val_tn, val_fp, val_fn, val_tp, \
         val_sensitivity, val_specificity, \
-        val_acc, val_auc = val_step(c_model=c_model,
-                                    val_path=val_path,
-                                    imf_norm_op=imf_norm_op,
-                                    i_loss_name=i_loss_name,
-                                    b_loss_name=b_loss_name,
-                                    mut_ex=mut_ex,
-                                    n_class=n_class,
-                                    c1=c1,
-                                    c2=c2,
-                                    top_k_percent=top_k_percent,
-                                    batch_size=batch_size,
-                                    batch_op=batch_op)
+        val_acc, val_auc = session.val_epoch()
 
         with val_summary_writer.as_default():
-            tf.summary.scalar('Total Loss', float(val_loss), step=epoch)
-            tf.summary.scalar('Instance Loss', float(val_ins_loss), step=epoch)
-            tf.summary.scalar('Bag Loss', float(val_bag_loss), step=epoch)
-            tf.summary.scalar('Accuracy', float(val_acc), step=epoch)
-            tf.summary.scalar('AUC', float(val_auc), step=epoch)
-            tf.summary.scalar('Sensitivity', float(val_sensitivity), step=epoch)
-            tf.summary.scalar('Specificity', float(val_specificity), step=epoch)
-            tf.summary.histogram('True Positive', int(val_tp), step=epoch)
-            tf.summary.histogram('False Positive', int(val_fp), step=epoch)
-            tf.summary.histogram('True Negative', int(val_tn), step=epoch)
-            tf.summary.histogram('False Negative', int(val_fn), step=epoch)
+            tf.summary.scalar('Total Loss', float(val_loss), step=tb_step)
+            tf.summary.scalar('Instance Loss', float(val_ins_loss), step=tb_step)
+            tf.summary.scalar('Bag Loss', float(val_bag_loss), step=tb_step)
+            tf.summary.scalar('Accuracy', float(val_acc), step=tb_step)
+            tf.summary.scalar('AUC', float(val_auc), step=tb_step)
+            tf.summary.scalar('Sensitivity', float(val_sensitivity), step=tb_step)
+            tf.summary.scalar('Specificity', float(val_specificity), step=tb_step)
+            tf.summary.histogram('True Positive', int(val_tp), step=tb_step)
+            tf.summary.histogram('False Positive', int(val_fp), step=tb_step)
+            tf.summary.histogram('True Negative', int(val_tn), step=tb_step)
+            tf.summary.histogram('False Negative', int(val_fn), step=tb_step)
+
+        if session.bag_cache is not None:
+            with train_summary_writer.as_default():
+                tf.summary.scalar('Bag Cache Hits', session.bag_cache.hits, step=tb_step)
+                tf.summary.scalar('Bag Cache Misses', session.bag_cache.misses, step=tb_step)
+                tf.summary.scalar('Bag Cache Evictions', session.bag_cache.evictions, step=tb_step)
+                tf.summary.scalar('Bag Cache MB', session.bag_cache.n_bytes / 2 ** 20, step=tb_step)
+
+        session.end_epoch(force_checkpoint=(epoch == epochs - 1))
 
         epoch_run_time = time.time() - start_time
 
@@ -116,8 +136,10 @@ def clam_optimize(train_log, val_log, train_path, val_path, imf_norm_op, c_model
                   i_optimizer_name, b_optimizer_name, a_optimizer_name,
                   i_loss_name, b_loss_name, mut_ex, n_class, c1, c2,
                   i_learn_rate, b_learn_rate, a_learn_rate, i_l2_decay, b_l2_decay,
-                  a_l2_decay, top_k_percent, batch_size, batch_op,
-                  c_model_dir, m_clam_op, att_gate, epochs):
+                  a_l2_decay, top_k_percent, batch_size, batch_op, compile_op,
+                  jit_compile, slide_batch_size, c_model_dir, m_clam_op, att_gate, epochs,
+                  checkpoint_dir, checkpoint_epochs, checkpoint_minutes, resume,
+                  num_parallel_reads, prefetch_slides, feature_cache_dir, bag_cache_bytes):
 
     train_val(train_log=train_log,
               val_log=val_log,
@@ -146,7 +168,18 @@ def clam_optimize(train_log, val_log, train_path, val_path, imf_norm_op, c_model
               top_k_percent=top_k_percent,
               batch_size=batch_size,
               batch_op=batch_op,
-              epochs=epochs)
+              compile_op=compile_op,
+              jit_compile=jit_compile,
+              slide_batch_size=slide_batch_size,
+              epochs=epochs,
+              checkpoint_dir=checkpoint_dir,
+              checkpoint_epochs=checkpoint_epochs,
+              checkpoint_minutes=checkpoint_minutes,
+              resume=resume,
+              num_parallel_reads=num_parallel_reads,
+              prefetch_slides=prefetch_slides,
+              feature_cache_dir=feature_cache_dir,
+              bag_cache_bytes=bag_cache_bytes)
 
     model_save(c_model=c_model,
                c_model_dir=c_model_dir,
@@ -156,7 +189,8 @@ def clam_optimize(train_log, val_log, train_path, val_path, imf_norm_op, c_model
 
 def clam_test(n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex, test_path,
               result_path, result_file_name, c_model_dir,
-              dim_compress_features, imf_norm_op, m_clam_op, n_test_steps):
+              dim_compress_features, imf_norm_op, m_clam_op, n_test_steps, jit_compile,
+              num_parallel_reads, prefetch_slides, feature_cache_dir):
 
     c_trained_model = restore_model(c_model_dir=c_model_dir,
                                     n_class=n_class,
@@ -176,7 +210,11 @@ def clam_test(n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex, test_
               test_path=test_path,
               result_path=result_path,
               result_file_name=result_file_name,
-              n_test_steps=n_test_steps)
+              n_test_steps=n_test_steps,
+              jit_compile=jit_compile,
+              num_parallel_reads=num_parallel_reads,
+              prefetch_slides=prefetch_slides,
+              feature_cache_dir=feature_cache_dir)
 
 def load_model(n_class, top_k_percent, net_size, mut_ex, att_gate, att_only,
                mil_ins, dropout, dropout_rate):
@@ -215,11 +253,14 @@ def clam(train_log, val_log, train_path, val_path, test_path,
               i_loss_name, b_loss_name, mut_ex_name, n_class, c1, c2,
               i_learn_rate, b_learn_rate, a_learn_rate,
               i_l2_decay, b_l2_decay, a_l2_decay,
-              top_k_percent, batch_size, batch_op_name,
-              c_model_dir, att_only_name, mil_ins_name, att_gate_name,
+              top_k_percent, batch_size, batch_op_name, compile_op_name, jit_compile_name,
+              slide_batch_size, precision_policy, c_model_dir, att_only_name, mil_ins_name, att_gate_name,
               epochs, n_test_steps, no_warn_op_name,
               i_wd_op_name, b_wd_op_name, a_wd_op_name,
-              m_clam_op_name, is_training_name):
+              m_clam_op_name, is_training_name,
+              checkpoint_dir, checkpoint_epochs, checkpoint_minutes, resume_op_name,
+              num_parallel_reads, prefetch_slides, feature_cache_dir, warm_cache_workers,
+              bag_cache_gb):
 
     str_bool_dic = str_to_bool()
 
@@ -227,12 +268,28 @@ def clam(train_log, val_log, train_path, val_path, test_path,
     dropout = str_bool_dic[dropout_name]
     mut_ex = str_bool_dic[mut_ex_name]
     batch_op = str_bool_dic[batch_op_name]
+    compile_op = str_bool_dic[compile_op_name]
+    jit_compile = str_bool_dic[jit_compile_name]
     att_only = str_bool_dic[att_only_name]
     mil_ins = str_bool_dic[mil_ins_name]
     att_gate = str_bool_dic[att_gate_name]
     no_warn_op = str_bool_dic[no_warn_op_name]
     m_clam_op = str_bool_dic[m_clam_op_name]
     is_training = str_bool_dic[is_training_name]
+    resume = str_bool_dic[resume_op_name]
+
+    # checkpoints default to a folder next to the saved sub-network models
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join(c_model_dir, 'Checkpoint')
+
+    # the policy has to be set before any model gets built or restored, float32 be the default full precision one
+    tf.keras.mixed_precision.set_global_policy(precision_policy)
+
+    # decode the slides of this run into the feature cache with a process pool, instead of one by one on first read
+    if feature_cache_dir is not None and warm_cache_workers > 0:
+        warm_feature_cache(data_paths=[train_path, val_path] if is_training else [test_path],
+                           feature_cache_dir=feature_cache_dir,
+                           n_workers=warm_cache_workers)
 
     if is_training:
         c_model = load_model(n_class=n_class,
@@ -275,10 +332,21 @@ def clam(train_log, val_log, train_path, val_path, test_path,
                       a_l2_decay=a_l2_decay,
                       top_k_percent=top_k_percent,
                       batch_size=batch_size, batch_op=batch_op,
+                      compile_op=compile_op,
+                      jit_compile=jit_compile,
+                      slide_batch_size=slide_batch_size,
                       c_model_dir=c_model_dir,
                       m_clam_op=m_clam_op,
                       att_gate=att_gate,
-                      epochs=epochs)
+                      epochs=epochs,
+                      checkpoint_dir=checkpoint_dir,
+                      checkpoint_epochs=checkpoint_epochs,
+                      checkpoint_minutes=checkpoint_minutes,
+                      resume=resume,
+                      num_parallel_reads=num_parallel_reads,
+                      prefetch_slides=prefetch_slides,
+                      feature_cache_dir=feature_cache_dir,
+                      bag_cache_bytes=int(bag_cache_gb * 2 ** 30))
     else:
         clam_test(n_class=n_class,
                   top_k_percent=top_k_percent,
@@ -293,16 +361,24 @@ def clam(train_log, val_log, train_path, val_path, test_path,
                   dim_compress_features=dim_compress_features,
                   imf_norm_op=imf_norm_op,
                   m_clam_op=m_clam_op,
-                  n_test_steps=n_test_steps)
+                  n_test_steps=n_test_steps,
+                  jit_compile=jit_compile,
+                  num_parallel_reads=num_parallel_reads,
+                  prefetch_slides=prefetch_slides,
+                  feature_cache_dir=feature_cache_dir)
 
 
 def clam_main(train_log, val_log, train_path, val_path, test_path, result_path, result_file_name,
               imf_norm_op_name, dim_compress_features, net_size, dropout_name, dropout_rate,
               i_optimizer_name, b_optimizer_name, a_optimizer_name, i_loss_name, b_loss_name,
               mut_ex_name, n_class, c1, c2, i_learn_rate, b_learn_rate, a_learn_rate,
-              i_l2_decay, b_l2_decay, a_l2_decay, top_k_percent, batch_size, batch_op_name,
-              c_model_dir, att_only_name, mil_ins_name, att_gate_name, epochs, n_test_steps, no_warn_op_name,
-              i_wd_op_name, b_wd_op_name, a_wd_op_name, m_clam_op_name, is_training_name, m_gpu_op_name):
+              i_l2_decay, b_l2_decay, a_l2_decay, top_k_percent, batch_size, batch_op_name, compile_op_name,
+              jit_compile_name, slide_batch_size, precision_policy, c_model_dir, att_only_name, mil_ins_name,
+              att_gate_name, epochs, n_test_steps, no_warn_op_name,
+              i_wd_op_name, b_wd_op_name, a_wd_op_name, m_clam_op_name, is_training_name, m_gpu_op_name,
+              checkpoint_dir=None, checkpoint_epochs=1, checkpoint_minutes=0, resume_op_name='False',
+              num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None, warm_cache_workers=0,
+              bag_cache_gb=0):
 
     str_bool_dic = str_to_bool()
     m_gpu = str_bool_dic[m_gpu_op_name]
@@ -342,6 +418,10 @@ def clam_main(train_log, val_log, train_path, val_path, test_path, result_path,
                          top_k_percent=top_k_percent,
                          batch_size=batch_size,
                          batch_op_name=batch_op_name,
+                         compile_op_name=compile_op_name,
+                         jit_compile_name=jit_compile_name,
+                         slide_batch_size=slide_batch_size,
+                         precision_policy=precision_policy,
                          c_model_dir=c_model_dir,
                          att_only_name=att_only_name,
                          mil_ins_name=mil_ins_name,
@@ -353,7 +433,16 @@ def clam_main(train_log, val_log, train_path, val_path, test_path, result_path,
                          b_wd_op_name=b_wd_op_name,
                          a_wd_op_name=a_wd_op_name,
                          m_clam_op_name=m_clam_op_name,
-                         is_training_name=is_training_name)
+                         is_training_name=is_training_name,
+                         checkpoint_dir=checkpoint_dir,
+                         checkpoint_epochs=checkpoint_epochs,
+                         checkpoint_minutes=checkpoint_minutes,
+                         resume_op_name=resume_op_name,
+                         num_parallel_reads=num_parallel_reads,
+                         prefetch_slides=prefetch_slides,
+                         feature_cache_dir=feature_cache_dir,
+                         warm_cache_workers=warm_cache_workers,
+                         bag_cache_gb=bag_cache_gb)
     else:
         clam(train_log=train_log,
                   val_log=val_log,
@@ -385,6 +474,10 @@ def clam_main(train_log, val_log, train_path, val_path, test_path, result_path,
                   top_k_percent=top_k_percent,
                   batch_size=batch_size,
                   batch_op_name=batch_op_name,
+                  compile_op_name=compile_op_name,
+                  jit_compile_name=jit_compile_name,
+                  slide_batch_size=slide_batch_size,
+                  precision_policy=precision_policy,
                   c_model_dir=c_model_dir,
                   att_only_name=att_only_name,
                   mil_ins_name=mil_ins_name,
@@ -396,4 +489,13 @@ def clam_main(train_log, val_log, train_path, val_path, test_path, result_path,
                   b_wd_op_name=b_wd_op_name,
                   a_wd_op_name=a_wd_op_name,
                   m_clam_op_name=m_clam_op_name,
-                  is_training_name=is_training_name)
+                  is_training_name=is_training_name,
+                  checkpoint_dir=checkpoint_dir,
+                  checkpoint_epochs=checkpoint_epochs,
+                  checkpoint_minutes=checkpoint_minutes,
+                  resume_op_name=resume_op_name,
+                  num_parallel_reads=num_parallel_reads,
+                  prefetch_slides=prefetch_slides,
+                  feature_cache_dir=feature_cache_dir,
+                  warm_cache_workers=warm_cache_workers,
+                  bag_cache_gb=bag_cache_gb)
@@ -0,0 +1,209 @@
+import random
+import time
+
+import tensorflow as tf
+
+from UTILITY.model_train import train_step, compiled_optimize
+from UTILITY.model_val import val_step, compiled_val
+from UTILITY.util import load_optimizers, load_loss_scale, load_loss_func, list_slides, BagCache
+
+
+class TrainingSession(object):
+    """
+    Everything a train_val run needs across its epochs: the model, the three optimizers, the loss functions, the
+    compiled train and val steps and the slide lists of the training and validation folders with the settings of
+    their slide_dataset pipelines, and the BagCache keeping decoded slides in RAM. All of it gets built
+    once, so the optimizers keep their moment estimates and slot variables from one epoch to the next and the
+    compiled steps keep their traces, the same as in a single continuous training loop.
+    With a checkpoint_dir, a tf.train.CheckpointManager keeps the variables of the model and the optimizers (slots
+    and the mixed_float16 loss scale included), the epoch counter, the TensorBoard step and the state of the random
+    generator seeding the slide shuffles, so that restore() picks a preempted run up where its latest checkpoint
+    left it.
+    """
+
+    def __init__(self, c_model, train_path, val_path, imf_norm_op,
+                 i_wd_op_name, b_wd_op_name, a_wd_op_name,
+                 i_optimizer_name, b_optimizer_name, a_optimizer_name,
+                 i_loss_name, b_loss_name, mut_ex, n_class, c1, c2,
+                 i_learn_rate, b_learn_rate, a_learn_rate,
+                 i_l2_decay, b_l2_decay, a_l2_decay, top_k_percent,
+                 batch_size, batch_op, compile_op, jit_compile, slide_batch_size,
+                 checkpoint_dir=None, checkpoint_epochs=1, checkpoint_minutes=0,
+                 num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None, bag_cache_bytes=0):
+        self.c_model = c_model
+        self.train_path = train_path
+        self.val_path = val_path
+        self.imf_norm_op = imf_norm_op
+        self.mut_ex = mut_ex
+        self.n_class = n_class
+        self.c1 = c1
+        self.c2 = c2
+        self.top_k_percent = top_k_percent
+        self.batch_size = batch_size
+        self.batch_op = batch_op
+        self.compile_op = compile_op
+        self.jit_compile = jit_compile
+        self.slide_batch_size = slide_batch_size
+        self.num_parallel_reads = num_parallel_reads
+        self.prefetch_slides = prefetch_slides
+        self.feature_cache_dir = feature_cache_dir
+
+        # one bag cache for the training and the validation slides, its budget be shared between both
+        self.bag_cache = None
+        if bag_cache_bytes > 0:
+            self.bag_cache = BagCache(budget_bytes=bag_cache_bytes, feature_cache_dir=feature_cache_dir)
+
+        self.i_optimizer, self.b_optimizer, self.a_optimizer = load_optimizers(i_wd_op_name=i_wd_op_name,
+                                                                               b_wd_op_name=b_wd_op_name,
+                                                                               a_wd_op_name=a_wd_op_name,
+                                                                               i_optimizer_name=i_optimizer_name,
+                                                                               b_optimizer_name=b_optimizer_name,
+                                                                               a_optimizer_name=a_optimizer_name,
+                                                                               i_learn_rate=i_learn_rate,
+                                                                               b_learn_rate=b_learn_rate,
+                                                                               a_learn_rate=a_learn_rate,
+                                                                               i_l2_decay=i_l2_decay,
+                                                                               b_l2_decay=b_l2_decay,
+                                                                               a_l2_decay=a_l2_decay)
+        # the one loss scale of all three optimizers under the mixed_float16 policy, None under any other policy
+        self.loss_scale = load_loss_scale()
+
+        self.i_loss_func, self.b_loss_func = load_loss_func(i_loss_func_name=i_loss_name,
+                                                            b_loss_func_name=b_loss_name)
+
+        self.c_optimize = None
+        if compile_op or jit_compile:
+            self.c_optimize = compiled_optimize(c_model=c_model,
+                                                i_optimizer=self.i_optimizer,
+                                                b_optimizer=self.b_optimizer,
+                                                a_optimizer=self.a_optimizer,
+                                                loss_scale=self.loss_scale,
+                                                i_loss_func=self.i_loss_func,
+                                                b_loss_func=self.b_loss_func,
+                                                n_class=n_class,
+                                                c1=c1, c2=c2,
+                                                mut_ex=mut_ex,
+                                                jit_compile=jit_compile,
+                                                slide_batch=slide_batch_size > 1)
+
+        self.c_val = None
+        if jit_compile:
+            self.c_val = compiled_val(c_model=c_model,
+                                      i_loss_func=self.i_loss_func,
+                                      b_loss_func=self.b_loss_func,
+                                      n_class=n_class,
+                                      c1=c1, c2=c2,
+                                      mut_ex=mut_ex)
+
+        # the slide lists get scanned once, train_step and val_step shuffle their own copy every epoch
+        self.train_sample_list = list_slides(data_path=train_path)
+        self.val_sample_list = list_slides(data_path=val_path)
+
+        # completed epochs and the step of the next TensorBoard summaries
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.tb_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.rng = tf.random.Generator.from_non_deterministic_state()
+
+        self.checkpoint_epochs = checkpoint_epochs
+        self.checkpoint_minutes = checkpoint_minutes
+        self.checkpoint_time = time.time()
+        self.checkpoint_manager = None
+        if checkpoint_dir is not None:
+            checkpoint_objects = dict(c_model=c_model,
+                                      i_optimizer=self.i_optimizer,
+                                      b_optimizer=self.b_optimizer,
+                                      a_optimizer=self.a_optimizer,
+                                      epoch=self.epoch,
+                                      tb_step=self.tb_step,
+                                      rng=self.rng)
+            if self.loss_scale is not None:
+                checkpoint_objects['loss_scale'] = self.loss_scale
+            checkpoint = tf.train.Checkpoint(**checkpoint_objects)
+            self.checkpoint_manager = tf.train.CheckpointManager(checkpoint=checkpoint,
+                                                                 directory=checkpoint_dir,
+                                                                 max_to_keep=3)
+
+    def restore(self):
+        """
+        Restore the latest checkpoint of checkpoint_dir, if there be one, and return the number of completed epochs.
+        The model and optimizer slot variables get created on the first train step, their values get filled in
+        from the checkpoint at that point.
+        """
+        if self.checkpoint_manager is None or self.checkpoint_manager.latest_checkpoint is None:
+            return 0
+
+        self.checkpoint_manager.checkpoint.restore(self.checkpoint_manager.latest_checkpoint)
+        print('\n Resumed from {} after epoch {}'.format(self.checkpoint_manager.latest_checkpoint, int(self.epoch)))
+
+        return int(self.epoch)
+
+    def end_epoch(self, force_checkpoint=False):
+        """
+        Count the epoch as completed and write a checkpoint when checkpoint_epochs epochs or checkpoint_minutes
+        minutes have passed since the last one (0 turns either off), or with force_checkpoint. Checkpoints only get
+        written between epochs, a run resumes from the start of the epoch after its latest checkpoint.
+        """
+        self.epoch.assign_add(1)
+        self.tb_step.assign_add(1)
+
+        if self.checkpoint_manager is None:
+            return
+
+        epochs_due = self.checkpoint_epochs > 0 and int(self.epoch) % self.checkpoint_epochs == 0
+        minutes_due = self.checkpoint_minutes > 0 and \
+                      time.time() - self.checkpoint_time >= self.checkpoint_minutes * 60
+        if force_checkpoint or epochs_due or minutes_due:
+            self.checkpoint_manager.save(checkpoint_number=int(self.epoch))
+            self.checkpoint_time = time.time()
+
+    def train_epoch(self):
+        # the slide shuffles of the epoch follow the checkpointed generator, a resumed run replays them
+        random.seed(int(self.rng.uniform_full_int(shape=(), dtype=tf.int64)))
+
+        return train_step(c_model=self.c_model,
+                          train_path=self.train_path,
+                          imf_norm_op=self.imf_norm_op,
+                          i_optimizer=self.i_optimizer,
+                          b_optimizer=self.b_optimizer,
+                          a_optimizer=self.a_optimizer,
+                          loss_scale=self.loss_scale,
+                          i_loss_func=self.i_loss_func,
+                          b_loss_func=self.b_loss_func,
+                          mut_ex=self.mut_ex,
+                          n_class=self.n_class,
+                          c1=self.c1,
+                          c2=self.c2,
+                          top_k_percent=self.top_k_percent,
+                          batch_size=self.batch_size,
+                          batch_op=self.batch_op,
+                          c_optimize=self.c_optimize,
+                          compile_op=self.compile_op,
+                          jit_compile=self.jit_compile,
+                          slide_batch_size=self.slide_batch_size,
+                          train_sample_list=self.train_sample_list,
+                          num_parallel_reads=self.num_parallel_reads,
+                          prefetch_slides=self.prefetch_slides,
+                          feature_cache_dir=self.feature_cache_dir,
+                          bag_cache=self.bag_cache)
+
+    def val_epoch(self):
+        return val_step(c_model=self.c_model,
+                        val_path=self.val_path,
+                        imf_norm_op=self.imf_norm_op,
+                        i_loss_func=self.i_loss_func,
+                        b_loss_func=self.b_loss_func,
+                        mut_ex=self.mut_ex,
+                        n_class=self.n_class,
+                        c1=self.c1,
+                        c2=self.c2,
+                        top_k_percent=self.top_k_percent,
+                        batch_size=self.batch_size,
+                        batch_op=self.batch_op,
+                        c_val=self.c_val,
+                        jit_compile=self.jit_compile,
+                        slide_batch_size=self.slide_batch_size,
+                        val_sample_list=self.val_sample_list,
+                        num_parallel_reads=self.num_parallel_reads,
+                        prefetch_slides=self.prefetch_slides,
+                        feature_cache_dir=self.feature_cache_dir,
+                        bag_cache=self.bag_cache)
@@ -5,16 +5,45 @@ import os
 import random
 import time
 
-from UTILITY.util import get_data_from_tf, s_clam_call, most_frequent, m_clam_call
+from UTILITY.util import slide_dataset, list_slides, schedule_slides, s_clam_call, most_frequent, m_clam_call, \
+    BucketedJitFunction
+
+
+def compiled_test(n_class, top_k_percent, att_gate, att_only, m_clam_op, mil_ins, mut_ex,
+                  c_model, dim_compress_features):
+    """
+    XLA compiled slide prediction of the restored model, running on bags padded to bucketed lengths, see
+    BucketedJitFunction in UTILITY/util.py.
+    """
+
+    def c_test(img_features, slide_label, bag_mask=None):
+        if m_clam_op:
+            clam_outputs = m_clam_call(att_net=c_model[0], ins_net=c_model[1], bag_net=c_model[2],
+                                       img_features=img_features, slide_label=slide_label, n_class=n_class,
+                                       dim_compress_features=dim_compress_features, top_k_percent=top_k_percent,
+                                       att_gate=att_gate, att_only=att_only, mil_ins=mil_ins, mut_ex=mut_ex,
+                                       bag_mask=bag_mask)
+        else:
+            clam_outputs = s_clam_call(att_net=c_model[0], ins_net=c_model[1], bag_net=c_model[2],
+                                       img_features=img_features, slide_label=slide_label, n_class=n_class,
+                                       top_k_percent=top_k_percent, att_gate=att_gate, att_only=att_only,
+                                       mil_ins=mil_ins, mut_ex=mut_ex, bag_mask=bag_mask)
+
+        # only the predicted slide label leaves the compiled function
+        return clam_outputs[-1]
+
+    return BucketedJitFunction(func=c_test, name='Test Step')
 
 
 def m_test_per_sample(n_class, top_k_percent, att_gate, att_only, m_clam_op, mil_ins, mut_ex,
-                      c_model, dim_compress_features, img_features, slide_label, n_test_steps):
+                      c_model, dim_compress_features, img_features, slide_label, n_test_steps, c_test=None):
 
     slide_pred_per_sample = list()
 
     for i in range(n_test_steps):
-        if m_clam_op:
+        if c_test is not None:
+            predict_label = c_test(img_features, slide_label)
+        elif m_clam_op:
             att_score, A, h, ins_labels, ins_logits_unnorm, \
             ins_logits, slide_score_unnorm, \
             Y_prob, Y_hat, Y_true, predict_label = m_clam_call(att_net=c_model[0],
@@ -44,7 +73,7 @@ def m_test_per_sample(n_class, top_k_percent, att_gate, att_only, m_clam_op, mil
                                                                mil_ins=mil_ins,
                                                                mut_ex=mut_ex)
 
-        slide_pred_per_sample.append(predict_label)
+        slide_pred_per_sample.append(int(predict_label))
         predict_slide_label = most_frequent(slide_pred_per_sample)
 
         return predict_slide_label
@@ -52,21 +81,42 @@ def m_test_per_sample(n_class, top_k_percent, att_gate, att_only, m_clam_op, mil
 
 def test_step(n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex,
               m_clam_op, imf_norm_op, c_model, dim_compress_features,
-              test_path, result_path, result_file_name, n_test_steps):
+              test_path, result_path, result_file_name, n_test_steps, jit_compile=False,
+              num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None):
 
     start_time = time.time()
 
+    c_test = None
+    if jit_compile:
+        c_test = compiled_test(n_class=n_class,
+                               top_k_percent=top_k_percent,
+                               att_gate=att_gate,
+                               att_only=att_only,
+                               m_clam_op=m_clam_op,
+                               mil_ins=mil_ins,
+                               mut_ex=mut_ex,
+                               c_model=c_model,
+                               dim_compress_features=dim_compress_features)
+
     slide_true_label = list()
     slide_predict_label = list()
     sample_names = list()
 
-    test_sample_list = os.listdir(test_path)
+    test_sample_list = list_slides(data_path=test_path)
     test_sample_list = random.sample(test_sample_list, len(test_sample_list))
+    # with a slide manifest, the largest slides get read first, see val_step
+    test_sample_list = schedule_slides(data_path=test_path, sample_names=test_sample_list, largest_first=True)
 
-    for i in test_sample_list:
+    test_dataset = slide_dataset(data_path=test_path,
+                                 sample_names=test_sample_list,
+                                 imf_norm_op=imf_norm_op,
+                                 num_parallel_reads=num_parallel_reads,
+                                 prefetch_slides=prefetch_slides,
+                                 feature_cache_dir=feature_cache_dir)
+
+    for img_features, bag_mask, slide_label, sample_name in test_dataset:
         print('>', end="")
-        single_test_data = test_path + i
-        img_features, slide_label = get_data_from_tf(single_test_data, imf_norm_op=imf_norm_op)
+        slide_label = int(slide_label)
 
         predict_slide_label = m_test_per_sample(n_class=n_class,
                                                 top_k_percent=top_k_percent,
@@ -79,16 +129,20 @@ def test_step(n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex,
                                                 dim_compress_features=dim_compress_features,
                                                 img_features=img_features,
                                                 slide_label=slide_label,
-                                                n_test_steps=n_test_steps)
+                                                n_test_steps=n_test_steps,
+                                                c_test=c_test)
 
         slide_true_label.append(slide_label)
         slide_predict_label.append(predict_slide_label)
-        sample_names.append(i)
+        sample_names.append(sample_name.numpy().decode())
 
         test_results = pd.DataFrame(list(zip(sample_names, slide_true_label, slide_predict_label)),
                                     columns=['Sample Names', 'Slide True Label', 'Slide Predict Label'])
         test_results.to_csv(os.path.join(result_path, result_file_name), sep='\t', index=False)
 
+    if jit_compile:
+        c_test.report()
+
     tn, fp, fn, tp = sklearn.metrics.confusion_matrix(slide_true_label, slide_predict_label).ravel()
     test_tn = int(tn)
     test_fp = int(fp)
@@ -5,48 +5,113 @@ import os
 import random
 import statistics
 
-from UTILITY.util import most_frequent, get_data_from_tf, load_optimizers, load_loss_func
+from UTILITY.util import most_frequent, slide_dataset, list_slides, schedule_slides, compute_ins_loss, \
+    compute_bag_loss, BucketedJitFunction, scale_loss, unscale_gradients, compute_network_gradients, \
+    apply_network_gradients
 
 
 def nb_optimize(img_features, slide_label, c_model, i_optimizer, b_optimizer, a_optimizer,
-                i_loss_func, b_loss_func, n_class, c1, c2, mut_ex):
+                i_loss_func, b_loss_func, n_class, c1, c2, mut_ex, c_optimize=None, bag_mask=None, loss_scale=None):
 
-    with tf.GradientTape() as i_tape, tf.GradientTape() as b_tape, tf.GradientTape() as a_tape:
+    if c_optimize is not None:
+        if bag_mask is None:
+            return c_optimize(img_features, slide_label)
+        return c_optimize(img_features, slide_label, bag_mask)
+
+    # one tape and one backward pass serve all three networks, see compute_network_gradients in UTILITY/util.py
+    with tf.GradientTape(persistent=(c1 == 0 or c2 == 0)) as tape:
         att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-        Y_prob, Y_hat, Y_true, predict_slide_label = c_model.call(img_features, slide_label)
+        Y_prob, Y_hat, Y_true, predict_slide_label = c_model.call(img_features, slide_label, bag_mask)
 
         a_net = c_model.networks()[0]
         i_net = c_model.networks()[1]
         b_net = c_model.networks()[2]
 
-        ins_loss = list()
-        for j in range(len(ins_logits)):
-            i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-            ins_loss.append(i_loss)
-        if mut_ex:
-            I_Loss = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-        else:
-            I_Loss = tf.math.add_n(ins_loss) / len(ins_loss)
+        I_Loss = compute_ins_loss(i_loss_func=i_loss_func, ins_labels=ins_labels, ins_logits=ins_logits,
+                                  n_class=n_class, mut_ex=mut_ex)
 
-        B_Loss = b_loss_func(Y_true, Y_prob)
+        B_Loss = compute_bag_loss(b_loss_func=b_loss_func, Y_true=Y_true, Y_prob=Y_prob)
 
         T_Loss = c1 * B_Loss + c2 * I_Loss
 
-    i_grad = i_tape.gradient(I_Loss, i_net.trainable_weights)
-    i_optimizer.apply_gradients(zip(i_grad, i_net.trainable_weights))
+        # no-ops unless there be a loss_scale under the mixed_float16 policy, the single backward pass runs under
+        # the one loss scale of all three networks, see DynamicLossScale in UTILITY/util.py
+        I_Loss_Scaled = scale_loss(loss_scale=loss_scale, loss=I_Loss)
+        B_Loss_Scaled = scale_loss(loss_scale=loss_scale, loss=B_Loss)
+        T_Loss_Scaled = scale_loss(loss_scale=loss_scale, loss=T_Loss)
+
+    a_grad, i_grad, b_grad = compute_network_gradients(tape=tape,
+                                                       I_Loss=I_Loss_Scaled,
+                                                       B_Loss=B_Loss_Scaled,
+                                                       T_Loss=T_Loss_Scaled,
+                                                       c1=c1, c2=c2,
+                                                       a_net=a_net,
+                                                       i_net=i_net,
+                                                       b_net=b_net)
+
+    a_grad = unscale_gradients(loss_scale=loss_scale, grads=a_grad)
+    i_grad = unscale_gradients(loss_scale=loss_scale, grads=i_grad)
+    b_grad = unscale_gradients(loss_scale=loss_scale, grads=b_grad)
+
+    apply_network_gradients(a_optimizer=a_optimizer,
+                            i_optimizer=i_optimizer,
+                            b_optimizer=b_optimizer,
+                            a_grad=a_grad,
+                            i_grad=i_grad,
+                            b_grad=b_grad,
+                            a_net=a_net,
+                            i_net=i_net,
+                            b_net=b_net,
+                            loss_scale=loss_scale)
 
-    b_grad = b_tape.gradient(B_Loss, b_net.trainable_weights)
-    b_optimizer.apply_gradients(zip(b_grad, b_net.trainable_weights))
+    return I_Loss, B_Loss, T_Loss, predict_slide_label
 
-    a_grad = a_tape.gradient(T_Loss, a_net.trainable_weights)
-    a_optimizer.apply_gradients(zip(a_grad, a_net.trainable_weights))
 
-    return I_Loss, B_Loss, T_Loss, predict_slide_label
+def compiled_optimize(c_model, i_optimizer, b_optimizer, a_optimizer, i_loss_func, b_loss_func,
+                      n_class, c1, c2, mut_ex, jit_compile=False, slide_batch=False, loss_scale=None):
+    """
+    Wrap nb_optimize into a tf.function whose input signature leaves the number of instances open, so that bags
+    of any length, including the batch slices from b_optimize, run through one trace. The function expects the
+    stacked (N, 1024) bag and reports its number of traces through experimental_get_tracing_count().
+    With slide_batch, it expects padded (B, N, 1024) multi-slide batches, their (B,) labels and (B, N) bag_mask.
+    With jit_compile, nb_optimize gets XLA compiled instead, on bags padded to bucketed lengths, see
+    BucketedJitFunction in UTILITY/util.py.
+    """
+
+    def c_optimize(img_features, slide_label, bag_mask=None):
+        return nb_optimize(img_features=img_features,
+                           slide_label=slide_label,
+                           c_model=c_model,
+                           i_optimizer=i_optimizer,
+                           b_optimizer=b_optimizer,
+                           a_optimizer=a_optimizer,
+                           loss_scale=loss_scale,
+                           i_loss_func=i_loss_func,
+                           b_loss_func=b_loss_func,
+                           n_class=n_class,
+                           c1=c1, c2=c2,
+                           mut_ex=mut_ex,
+                           bag_mask=bag_mask)
+
+    if jit_compile:
+        return BucketedJitFunction(func=c_optimize, name='Train Step')
+
+    # slide_dataset hands over the bag in the compute dtype of the mixed precision policy
+    feature_dtype = tf.keras.mixed_precision.global_policy().compute_dtype
+    if slide_batch:
+        input_signature = [tf.TensorSpec(shape=(None, None, c_model.net_shape[0]), dtype=feature_dtype),
+                           tf.TensorSpec(shape=(None,), dtype=tf.int32),
+                           tf.TensorSpec(shape=(None, None), dtype=tf.float32)]
+    else:
+        input_signature = [tf.TensorSpec(shape=(None, c_model.net_shape[0]), dtype=feature_dtype),
+                           tf.TensorSpec(shape=(), dtype=tf.int32)]
+
+    return tf.function(c_optimize, input_signature=input_signature)
 
 
 def b_optimize(batch_size, top_k_percent, n_samples, img_features, slide_label, c_model,
                i_optimizer, b_optimizer, a_optimizer, i_loss_func, b_loss_func,
-               n_class, c1, c2, mut_ex):
+               n_class, c1, c2, mut_ex, c_optimize=None, loss_scale=None):
 
     step_size = 0
 
@@ -59,74 +124,31 @@ def b_optimize(batch_size, top_k_percent, n_samples, img_features, slide_label,
     n_ins = top_k_percent * batch_size
     n_ins = int(n_ins)
 
-    a_net = c_model.networks()[0]
-    i_net = c_model.networks()[1]
-    b_net = c_model.networks()[2]
-
     for n_step in range(0, (n_samples // batch_size + 1)):
         if step_size < (n_samples - batch_size):
-            with tf.GradientTape() as i_tape, tf.GradientTape() as b_tape, tf.GradientTape() as a_tape:
-
-                att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-                Y_prob, Y_hat, Y_true, predict_label = c_model.call(img_features[step_size:(step_size + batch_size)],
-                                                                    slide_label)
-
-                ins_loss = list()
-                for j in range(len(ins_logits)):
-                    i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-                    ins_loss.append(i_loss)
-                if mut_ex:
-                    Loss_I = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-                else:
-                    Loss_I = tf.math.add_n(ins_loss) / len(ins_loss)
-
-                Loss_B = b_loss_func(Y_true, Y_prob)
-
-                Loss_T = c1 * Loss_B + c2 * Loss_I
-
-            i_grad = i_tape.gradient(Loss_I, i_net.trainable_weights)
-            i_optimizer.apply_gradients(zip(i_grad, i_net.trainable_weights))
-
-            b_grad = b_tape.gradient(Loss_B, b_net.trainable_weights)
-            b_optimizer.apply_gradients(zip(b_grad, b_net.trainable_weights))
-
-            a_grad = a_tape.gradient(Loss_T, a_net.trainable_weights)
-            a_optimizer.apply_gradients(zip(a_grad, a_net.trainable_weights))
-
+            batch_img_features = img_features[step_size:(step_size + batch_size)]
         else:
-            with tf.GradientTape() as i_tape, tf.GradientTape() as b_tape, tf.GradientTape() as a_tape:
-
-                att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-                Y_prob, Y_hat, Y_true, predict_label = c_model.call(img_features[(step_size - n_ins):],
-                                                                    slide_label)
-
-                ins_loss = list()
-                for j in range(len(ins_logits)):
-                    i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-                    ins_loss.append(i_loss)
-                if mut_ex:
-                    Loss_I = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-                else:
-                    Loss_I = tf.math.add_n(ins_loss) / len(ins_loss)
-
-                Loss_B = b_loss_func(Y_true, Y_prob)
-
-                Loss_T = c1 * Loss_B + c2 * Loss_I
-
-            i_grad = i_tape.gradient(Loss_I, i_net.trainable_weights)
-            i_optimizer.apply_gradients(zip(i_grad, i_net.trainable_weights))
-
-            b_grad = b_tape.gradient(Loss_B, b_net.trainable_weights)
-            b_optimizer.apply_gradients(zip(b_grad, b_net.trainable_weights))
-
-            a_grad = a_tape.gradient(Loss_T, a_net.trainable_weights)
-            a_optimizer.apply_gradients(zip(a_grad, a_net.trainable_weights))
+            batch_img_features = img_features[(step_size - n_ins):]
+
+        Loss_I, Loss_B, Loss_T, predict_label = nb_optimize(img_features=batch_img_features,
+                                                            slide_label=slide_label,
+                                                            c_model=c_model,
+                                                            i_optimizer=i_optimizer,
+                                                            b_optimizer=b_optimizer,
+                                                            a_optimizer=a_optimizer,
+                                                            loss_scale=loss_scale,
+                                                            i_loss_func=i_loss_func,
+                                                            b_loss_func=b_loss_func,
+                                                            n_class=n_class,
+                                                            c1=c1, c2=c2,
+                                                            mut_ex=mut_ex,
+                                                            c_optimize=c_optimize)
 
         Ins_Loss.append(float(Loss_I))
         Bag_Loss.append(float(Loss_B))
         Total_Loss.append(float(Loss_T))
 
-        label_predict.append(predict_label)
+        label_predict.append(int(predict_label))
 
         step_size += batch_size
 
@@ -138,29 +160,18 @@ def b_optimize(batch_size, top_k_percent, n_samples, img_features, slide_label,
 
     return I_Loss, B_Loss, T_Loss, predict_slide_label
 
-def train_step(c_model, train_path, imf_norm_op,
-               i_wd_op_name, b_wd_op_name, a_wd_op_name,
-               i_optimizer_name, b_optimizer_name, a_optimizer_name,
-               i_loss_name, b_loss_name, mut_ex, n_class, c1, c2,
-               i_learn_rate, b_learn_rate, a_learn_rate,
-               i_l2_decay, b_l2_decay, a_l2_decay,
-               top_k_percent, batch_size, batch_op):
-
-    i_optimizer, b_optimizer, a_optimizer = load_optimizers(i_wd_op_name=i_wd_op_name,
-                                                            b_wd_op_name=b_wd_op_name,
-                                                            a_wd_op_name=a_wd_op_name,
-                                                            i_optimizer_name=i_optimizer_name,
-                                                            b_optimizer_name=b_optimizer_name,
-                                                            a_optimizer_name=a_optimizer_name,
-                                                            i_learn_rate=i_learn_rate,
-                                                            b_learn_rate=b_learn_rate,
-                                                            a_learn_rate=a_learn_rate,
-                                                            i_l2_decay=i_l2_decay,
-                                                            b_l2_decay=b_l2_decay,
-                                                            a_l2_decay=a_l2_decay)
-
-    i_loss_func, b_loss_func = load_loss_func(i_loss_func_name=i_loss_name,
-                                              b_loss_func_name=b_loss_name)
+def train_step(c_model, train_path, imf_norm_op, i_optimizer, b_optimizer, a_optimizer, i_loss_func, b_loss_func,
+               mut_ex, n_class, c1, c2, top_k_percent, batch_size, batch_op, c_optimize=None, compile_op=False,
+               jit_compile=False, slide_batch_size=1, train_sample_list=None, num_parallel_reads=4, prefetch_slides=2,
+               feature_cache_dir=None, bag_cache=None, loss_scale=None):
+    """
+    One training epoch. The optimizers, their loss scale, the loss functions and the compiled train step (c_optimize,
+    from compiled_optimize, required with compile_op or jit_compile) come from a TrainingSession, see
+    UTILITY/model_session.py, and live across epochs. The slides come through slide_dataset in UTILITY/util.py.
+    """
+
+    if compile_op and not jit_compile:
+        start_traces = c_optimize.experimental_get_tracing_count()
 
     loss_total = list()
     loss_ins = list()
@@ -169,31 +180,87 @@ def train_step(c_model, train_path, imf_norm_op,
     slide_true_label = list()
     slide_predict_label = list()
 
-    train_sample_list = os.listdir(train_path)
+    if train_sample_list is None:
+        train_sample_list = list_slides(data_path=train_path)
     train_sample_list = random.sample(train_sample_list, len(train_sample_list))
-    for i in train_sample_list:
-        print('=', end="")
-        single_train_data = train_path + i
-        img_features, slide_label = get_data_from_tf(tf_path=single_train_data, imf_norm_op=imf_norm_op)
-        # shuffle the order of img features list in order to reduce the side effects of randomly drop potential
-        # number of patches' feature vectors during training when enable batch training option
-        img_features = random.sample(img_features, len(img_features))
-
-        if batch_op:
-            if batch_size < len(img_features):
-                I_Loss, B_Loss, T_Loss, predict_slide_label = b_optimize(batch_size=batch_size,
-                                                                         top_k_percent=top_k_percent,
-                                                                         n_samples=len(img_features),
-                                                                         img_features=img_features,
-                                                                         slide_label=slide_label,
-                                                                         c_model=c_model,
-                                                                         i_optimizer=i_optimizer,
-                                                                         b_optimizer=b_optimizer,
-                                                                         a_optimizer=a_optimizer,
-                                                                         i_loss_func=i_loss_func,
-                                                                         b_loss_func=b_loss_func,
-                                                                         n_class=n_class,
-                                                                         c1=c1, c2=c2, mut_ex=mut_ex)
+    # with a slide manifest, the multi-slide batches get made up of slides of similar size
+    train_sample_list = schedule_slides(data_path=train_path,
+                                        sample_names=train_sample_list,
+                                        slide_batch_size=slide_batch_size)
+
+    # shuffle the patch order of every slide in order to reduce the side effects of randomly drop potential number of
+    # patches' feature vectors during training when enable batch training option, seeded anew every epoch
+    train_dataset = slide_dataset(data_path=train_path,
+                                  sample_names=train_sample_list,
+                                  imf_norm_op=imf_norm_op,
+                                  shuffle_seed=random.getrandbits(31),
+                                  slide_batch_size=slide_batch_size,
+                                  num_parallel_reads=num_parallel_reads,
+                                  prefetch_slides=prefetch_slides,
+                                  feature_cache_dir=feature_cache_dir,
+                                  bag_cache=bag_cache)
+
+    for img_features, bag_mask, slide_label, sample_name in train_dataset:
+        if slide_batch_size > 1:
+            # multi-slide minibatching, one zero-padded batch of slide_batch_size slides per optimizer update
+            print('=' * len(slide_label), end="")
+            I_Loss, B_Loss, T_Loss, predict_slide_labels = nb_optimize(img_features=img_features,
+                                                                       slide_label=slide_label,
+                                                                       c_model=c_model,
+                                                                       i_optimizer=i_optimizer,
+                                                                       b_optimizer=b_optimizer,
+                                                                       a_optimizer=a_optimizer,
+                                                                       loss_scale=loss_scale,
+                                                                       i_loss_func=i_loss_func,
+                                                                       b_loss_func=b_loss_func,
+                                                                       n_class=n_class,
+                                                                       c1=c1, c2=c2,
+                                                                       mut_ex=mut_ex,
+                                                                       c_optimize=c_optimize,
+                                                                       bag_mask=bag_mask)
+
+            # the losses be averaged over the slides of the batch, weight them per slide for the epoch averages
+            loss_total.extend([float(T_Loss)] * len(slide_label))
+            loss_ins.extend([float(I_Loss)] * len(slide_label))
+            loss_bag.extend([float(B_Loss)] * len(slide_label))
+
+            slide_true_label.extend([int(i) for i in slide_label])
+            slide_predict_label.extend([int(predict_slide_label) for predict_slide_label in predict_slide_labels])
+        else:
+            print('=', end="")
+            slide_label = int(slide_label)
+
+            if batch_op:
+                if batch_size < len(img_features):
+                    I_Loss, B_Loss, T_Loss, predict_slide_label = b_optimize(batch_size=batch_size,
+                                                                             top_k_percent=top_k_percent,
+                                                                             n_samples=len(img_features),
+                                                                             img_features=img_features,
+                                                                             slide_label=slide_label,
+                                                                             c_model=c_model,
+                                                                             i_optimizer=i_optimizer,
+                                                                             b_optimizer=b_optimizer,
+                                                                             a_optimizer=a_optimizer,
+                                                                             loss_scale=loss_scale,
+                                                                             i_loss_func=i_loss_func,
+                                                                             b_loss_func=b_loss_func,
+                                                                             n_class=n_class,
+                                                                             c1=c1, c2=c2, mut_ex=mut_ex,
+                                                                             c_optimize=c_optimize)
+                else:
+                    I_Loss, B_Loss, T_Loss, predict_slide_label = nb_optimize(img_features=img_features,
+                                                                              slide_label=slide_label,
+                                                                              c_model=c_model,
+                                                                              i_optimizer=i_optimizer,
+                                                                              b_optimizer=b_optimizer,
+                                                                              a_optimizer=a_optimizer,
+                                                                              loss_scale=loss_scale,
+                                                                              i_loss_func=i_loss_func,
+                                                                              b_loss_func=b_loss_func,
+                                                                              n_class=n_class,
+                                                                              c1=c1, c2=c2,
+                                                                              mut_ex=mut_ex,
+                                                                              c_optimize=c_optimize)
             else:
                 I_Loss, B_Loss, T_Loss, predict_slide_label = nb_optimize(img_features=img_features,
                                                                           slide_label=slide_label,
@@ -201,30 +268,30 @@ def train_step(c_model, train_path, imf_norm_op,
                                                                           i_optimizer=i_optimizer,
                                                                           b_optimizer=b_optimizer,
                                                                           a_optimizer=a_optimizer,
+                                                                          loss_scale=loss_scale,
                                                                           i_loss_func=i_loss_func,
                                                                           b_loss_func=b_loss_func,
                                                                           n_class=n_class,
                                                                           c1=c1, c2=c2,
-                                                                          mut_ex=mut_ex)
-        else:
-            I_Loss, B_Loss, T_Loss, predict_slide_label = nb_optimize(img_features=img_features,
-                                                                      slide_label=slide_label,
-                                                                      c_model=c_model,
-                                                                      i_optimizer=i_optimizer,
-                                                                      b_optimizer=b_optimizer,
-                                                                      a_optimizer=a_optimizer,
-                                                                      i_loss_func=i_loss_func,
-                                                                      b_loss_func=b_loss_func,
-                                                                      n_class=n_class,
-                                                                      c1=c1, c2=c2,
-                                                                      mut_ex=mut_ex)
-
-        loss_total.append(float(T_Loss))
-        loss_ins.append(float(I_Loss))
-        loss_bag.append(float(B_Loss))
-
-        slide_true_label.append(slide_label)
-        slide_predict_label.append(predict_slide_label)
+                                                                          mut_ex=mut_ex,
+                                                                          c_optimize=c_optimize)
+
+            loss_total.append(float(T_Loss))
+            loss_ins.append(float(I_Loss))
+            loss_bag.append(float(B_Loss))
+
+            slide_true_label.append(slide_label)
+            slide_predict_label.append(int(predict_slide_label))
+
+    if jit_compile:
+        c_optimize.report()
+    elif compile_op:
+        # c_optimize lives across the epochs of a TrainingSession, so its tracing count covers the whole run. The first
+        # slide of the run traces it twice, the optimizer slot variables get created on that call, any trace after
+        # that be a retrace
+        template = '\n Compiled Train Step Traces: {} in this epoch, {} since the start of the run'
+        print(template.format(c_optimize.experimental_get_tracing_count() - start_traces,
+                              c_optimize.experimental_get_tracing_count()))
 
     tn, fp, fn, tp = sklearn.metrics.confusion_matrix(slide_true_label, slide_predict_label).ravel()
     train_tn = int(tn)
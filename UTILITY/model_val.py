@@ -5,32 +5,53 @@ import os
 import random
 import statistics
 
-from UTILITY.util import get_data_from_tf, most_frequent, load_loss_func
+from UTILITY.util import slide_dataset, list_slides, schedule_slides, most_frequent, compute_ins_loss, \
+    compute_bag_loss, BucketedJitFunction
 
 
-def nb_val(img_features, slide_label, c_model, i_loss_func, b_loss_func, n_class, c1, c2, mut_ex):
+def nb_val(img_features, slide_label, c_model, i_loss_func, b_loss_func, n_class, c1, c2, mut_ex,
+           c_val=None, bag_mask=None):
+
+    if c_val is not None:
+        if bag_mask is None:
+            return c_val(img_features, slide_label)
+        return c_val(img_features, slide_label, bag_mask)
 
     att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-    Y_prob, Y_hat, Y_true, predict_slide_label = c_model.call(img_features, slide_label)
+    Y_prob, Y_hat, Y_true, predict_slide_label = c_model.call(img_features, slide_label, bag_mask)
 
-    ins_loss = list()
-    for j in range(len(ins_logits)):
-        i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-        ins_loss.append(i_loss)
-    if mut_ex:
-        I_Loss = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-    else:
-        I_Loss = tf.math.add_n(ins_loss) / len(ins_loss)
+    I_Loss = compute_ins_loss(i_loss_func=i_loss_func, ins_labels=ins_labels, ins_logits=ins_logits,
+                              n_class=n_class, mut_ex=mut_ex)
 
-    B_Loss = b_loss_func(Y_true, Y_prob)
+    B_Loss = compute_bag_loss(b_loss_func=b_loss_func, Y_true=Y_true, Y_prob=Y_prob)
 
     T_Loss = c1 * B_Loss + c2 * I_Loss
 
     return I_Loss, B_Loss, T_Loss, predict_slide_label
 
 
+def compiled_val(c_model, i_loss_func, b_loss_func, n_class, c1, c2, mut_ex):
+    """
+    Wrap nb_val into an XLA compiled function running on bags padded to bucketed lengths, see BucketedJitFunction
+    in UTILITY/util.py.
+    """
+
+    def c_val(img_features, slide_label, bag_mask=None):
+        return nb_val(img_features=img_features,
+                      slide_label=slide_label,
+                      c_model=c_model,
+                      i_loss_func=i_loss_func,
+                      b_loss_func=b_loss_func,
+                      n_class=n_class,
+                      c1=c1, c2=c2,
+                      mut_ex=mut_ex,
+                      bag_mask=bag_mask)
+
+    return BucketedJitFunction(func=c_val, name='Val Step')
+
+
 def b_val(batch_size, top_k_percent, n_samples, img_features, slide_label, c_model,
-          i_loss_func, b_loss_func, n_class, c1, c2, mut_ex):
+          i_loss_func, b_loss_func, n_class, c1, c2, mut_ex, c_val=None):
 
     step_size = 0
 
@@ -45,45 +66,25 @@ def b_val(batch_size, top_k_percent, n_samples, img_features, slide_label, c_mod
 
     for n_step in range(0, (n_samples // batch_size + 1)):
         if step_size < (n_samples - batch_size):
-            att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-            Y_prob, Y_hat, Y_true, predict_label = c_model.call(img_features[step_size:(step_size + batch_size)],
-                                                                slide_label)
-
-            ins_loss = list()
-            for j in range(len(ins_logits)):
-                i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-                ins_loss.append(i_loss)
-            if mut_ex:
-                Loss_I = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-            else:
-                Loss_I = tf.math.add_n(ins_loss) / len(ins_loss)
-
-            Loss_B = b_loss_func(Y_true, Y_prob)
-            Loss_T = c1 * Loss_B + c2 * Loss_I
-
+            batch_img_features = img_features[step_size:(step_size + batch_size)]
         else:
-            att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, slide_score_unnorm, \
-            Y_prob, Y_hat, Y_true, predict_label = c_model.call(img_features[(step_size - n_ins):],
-                                                                slide_label)
-
-            ins_loss = list()
-            for j in range(len(ins_logits)):
-                i_loss = i_loss_func(tf.one_hot(ins_labels[j], 2), ins_logits[j])
-                ins_loss.append(i_loss)
-            if mut_ex:
-                Loss_I = (tf.math.add_n(ins_loss) / len(ins_loss)) / n_class
-            else:
-                Loss_I = tf.math.add_n(ins_loss) / len(ins_loss)
-
-            Loss_B = b_loss_func(Y_true, Y_prob)
-
-            Loss_T = c1 * Loss_B + c2 * Loss_I
+            batch_img_features = img_features[(step_size - n_ins):]
+
+        Loss_I, Loss_B, Loss_T, predict_label = nb_val(img_features=batch_img_features,
+                                                       slide_label=slide_label,
+                                                       c_model=c_model,
+                                                       i_loss_func=i_loss_func,
+                                                       b_loss_func=b_loss_func,
+                                                       n_class=n_class,
+                                                       c1=c1, c2=c2,
+                                                       mut_ex=mut_ex,
+                                                       c_val=c_val)
 
         Ins_Loss.append(float(Loss_I))
         Bag_Loss.append(float(Loss_B))
         Total_Loss.append(float(Loss_T))
 
-        label_predict.append(predict_label)
+        label_predict.append(int(predict_label))
 
         step_size += batch_size
 
@@ -96,10 +97,14 @@ def b_val(batch_size, top_k_percent, n_samples, img_features, slide_label, c_mod
     return I_Loss, B_Loss, T_Loss, predict_slide_label
 
 
-def val_step(c_model, val_path, imf_norm_op, i_loss_name, b_loss_name, mut_ex, n_class,
-             c1, c2, top_k_percent, batch_size, batch_op):
-
-    i_loss_func, b_loss_func = load_loss_func(i_loss_func_name=i_loss_name, b_loss_func_name=b_loss_name)
+def val_step(c_model, val_path, imf_norm_op, i_loss_func, b_loss_func, mut_ex, n_class, c1, c2, top_k_percent,
+             batch_size, batch_op, c_val=None, jit_compile=False, slide_batch_size=1, val_sample_list=None,
+             num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None, bag_cache=None):
+    """
+    One validation epoch, the loss functions and the XLA compiled val step (c_val, from compiled_val, required with
+    jit_compile) come from a TrainingSession, see UTILITY/model_session.py. The slides come through slide_dataset in
+    UTILITY/util.py.
+    """
 
     loss_t = list()
     loss_i = list()
@@ -108,27 +113,69 @@ def val_step(c_model, val_path, imf_norm_op, i_loss_name, b_loss_name, mut_ex, n
     slide_true_label = list()
     slide_predict_label = list()
 
-    val_sample_list = os.listdir(val_path)
+    if val_sample_list is None:
+        val_sample_list = list_slides(data_path=val_path)
     val_sample_list = random.sample(val_sample_list, len(val_sample_list))
-
-    for i in val_sample_list:
-        print('=', end="")
-        single_val_data = val_path + i
-        img_features, slide_label = get_data_from_tf(tf_path=single_val_data, imf_norm_op=imf_norm_op)
-        img_features = random.sample(img_features, len(img_features))  # follow the training loop, see details there
-
-        if batch_op:
-            if batch_size < len(img_features):
-                I_Loss, B_Loss, T_Loss, predict_slide_label = b_val(batch_size=batch_size,
-                                                                    top_k_percent=top_k_percent,
-                                                                    n_samples=len(img_features),
-                                                                    img_features=img_features,
-                                                                    slide_label=slide_label,
-                                                                    c_model=c_model,
-                                                                    i_loss_func=i_loss_func,
-                                                                    b_loss_func=b_loss_func,
-                                                                    n_class=n_class, c1=c1, c2=c2,
-                                                                    mut_ex=mut_ex)
+    # with a slide manifest, the largest slides get read first, the order does not matter to the validation metrics
+    val_sample_list = schedule_slides(data_path=val_path, sample_names=val_sample_list, largest_first=True)
+
+    # patch orders get shuffled the same way as in the training loop, see details there
+    val_dataset = slide_dataset(data_path=val_path,
+                                sample_names=val_sample_list,
+                                imf_norm_op=imf_norm_op,
+                                shuffle_seed=random.getrandbits(31),
+                                slide_batch_size=slide_batch_size,
+                                num_parallel_reads=num_parallel_reads,
+                                prefetch_slides=prefetch_slides,
+                                feature_cache_dir=feature_cache_dir,
+                                bag_cache=bag_cache)
+
+    for img_features, bag_mask, slide_label, sample_name in val_dataset:
+        if slide_batch_size > 1:
+            # multi-slide minibatching, see train_step
+            print('=' * len(slide_label), end="")
+            I_Loss, B_Loss, T_Loss, predict_slide_labels = nb_val(img_features=img_features,
+                                                                  slide_label=slide_label,
+                                                                  c_model=c_model,
+                                                                  i_loss_func=i_loss_func,
+                                                                  b_loss_func=b_loss_func,
+                                                                  n_class=n_class, c1=c1, c2=c2,
+                                                                  mut_ex=mut_ex,
+                                                                  c_val=c_val,
+                                                                  bag_mask=bag_mask)
+
+            loss_t.extend([float(T_Loss)] * len(slide_label))
+            loss_i.extend([float(I_Loss)] * len(slide_label))
+            loss_b.extend([float(B_Loss)] * len(slide_label))
+
+            slide_true_label.extend([int(i) for i in slide_label])
+            slide_predict_label.extend([int(predict_slide_label) for predict_slide_label in predict_slide_labels])
+        else:
+            print('=', end="")
+            slide_label = int(slide_label)
+
+            if batch_op:
+                if batch_size < len(img_features):
+                    I_Loss, B_Loss, T_Loss, predict_slide_label = b_val(batch_size=batch_size,
+                                                                        top_k_percent=top_k_percent,
+                                                                        n_samples=len(img_features),
+                                                                        img_features=img_features,
+                                                                        slide_label=slide_label,
+                                                                        c_model=c_model,
+                                                                        i_loss_func=i_loss_func,
+                                                                        b_loss_func=b_loss_func,
+                                                                        n_class=n_class, c1=c1, c2=c2,
+                                                                        mut_ex=mut_ex,
+                                                                        c_val=c_val)
+                else:
+                    I_Loss, B_Loss, T_Loss, predict_slide_label = nb_val(img_features=img_features,
+                                                                         slide_label=slide_label,
+                                                                         c_model=c_model,
+                                                                         i_loss_func=i_loss_func,
+                                                                         b_loss_func=b_loss_func,
+                                                                         n_class=n_class, c1=c1, c2=c2,
+                                                                         mut_ex=mut_ex,
+                                                                         c_val=c_val)
             else:
                 I_Loss, B_Loss, T_Loss, predict_slide_label = nb_val(img_features=img_features,
                                                                      slide_label=slide_label,
@@ -136,22 +183,18 @@ def val_step(c_model, val_path, imf_norm_op, i_loss_name, b_loss_name, mut_ex, n
                                                                      i_loss_func=i_loss_func,
                                                                      b_loss_func=b_loss_func,
                                                                      n_class=n_class, c1=c1, c2=c2,
-                                                                     mut_ex=mut_ex)
-        else:
-            I_Loss, B_Loss, T_Loss, predict_slide_label = nb_val(img_features=img_features,
-                                                                 slide_label=slide_label,
-                                                                 c_model=c_model,
-                                                                 i_loss_func=i_loss_func,
-                                                                 b_loss_func=b_loss_func,
-                                                                 n_class=n_class, c1=c1, c2=c2,
-                                                                 mut_ex=mut_ex)
-
-        loss_t.append(float(T_Loss))
-        loss_i.append(float(I_Loss))
-        loss_b.append(float(B_Loss))
-
-        slide_true_label.append(slide_label)
-        slide_predict_label.append(predict_slide_label)
+                                                                     mut_ex=mut_ex,
+                                                                     c_val=c_val)
+
+            loss_t.append(float(T_Loss))
+            loss_i.append(float(I_Loss))
+            loss_b.append(float(B_Loss))
+
+            slide_true_label.append(slide_label)
+            slide_predict_label.append(int(predict_slide_label))
+
+    if jit_compile:
+        c_val.report()
 
     tn, fp, fn, tp = sklearn.metrics.confusion_matrix(slide_true_label, slide_predict_label).ravel()
     val_tn = int(tn)
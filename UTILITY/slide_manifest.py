@@ -0,0 +1,37 @@
+import argparse
+import time
+
+from UTILITY.util import build_slide_manifest, slide_manifest_path
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='write the slide manifest of a data directory, one JSON line per '
+                                                 'tfrecord with its label, patch count, byte size, feature dim and '
+                                                 'checksum, read by the training, validation and test loops in place '
+                                                 'of scanning the directory')
+
+    parser.add_argument('-i', '--tf_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the slide tfrecords, rerun it after adding or rewriting tfrecords')
+
+    parser.add_argument('-w', '--n_workers',
+                        type=int,
+                        default=1,
+                        help='number of processes reading the tfrecords missing from the manifest')
+
+    return parser
+
+
+def main():
+    args = make_arg_parser().parse_args()
+
+    start_time = time.time()
+    n_slides, n_read = build_slide_manifest(data_path=args.tf_dir, n_workers=args.n_workers)
+
+    print('\n Manifest of {} slides written to {}, {} tfrecords read, --- {:.1f} s ---'.format(
+        n_slides, slide_manifest_path(data_path=args.tf_dir), n_read, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
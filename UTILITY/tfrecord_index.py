@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+
+from UTILITY.util import list_slides, tfrecord_index_path, write_tfrecord_index
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description='write the sidecar record index of every tfrecord of a data '
+                                                 'directory, for tfrecords written before the data preparation '
+                                                 'wrote them itself')
+
+    parser.add_argument('-i', '--tf_dir',
+                        type=str,
+                        required=True,
+                        help='directory of the slide tfrecords to index')
+
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='rewrite indexes that be up to date already')
+
+    return parser
+
+
+def index_tfrecords(tf_dir, force=False):
+    """
+    Write the sidecar index of every tfrecord of tf_dir, see write_tfrecord_index in UTILITY/util.py. Indexes newer
+    than their tfrecord get kept unless force. Returns the number of tfrecords indexed and of records they hold.
+    """
+    n_tfrecords = 0
+    n_records = 0
+    for sample_name in sorted(list_slides(data_path=tf_dir)):
+        tf_path = os.path.join(tf_dir, sample_name)
+        index_path = tfrecord_index_path(tf_path=tf_path)
+        if not force and os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(tf_path):
+            continue
+
+        write_tfrecord_index(tf_path=tf_path)
+        with open(index_path) as f:
+            n_records += sum(1 for line in f)
+        n_tfrecords += 1
+        print('>', end="", flush=True)
+
+    return n_tfrecords, n_records
+
+
+def main():
+    args = make_arg_parser().parse_args()
+
+    start_time = time.time()
+    n_tfrecords, n_records = index_tfrecords(tf_dir=args.tf_dir, force=args.force)
+
+    print('\n Indexed {} tfrecords, {} records in {}, --- {:.1f} s ---'.format(n_tfrecords, n_records, args.tf_dir,
+                                                                             time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
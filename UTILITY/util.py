@@ -1,43 +1,790 @@
+import collections
+import glob
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import random
+import re
 import shutil
+import struct
+import threading
+import time
+import zlib
 
 import numpy as np
+import pandas as pd
 import tensorflow as tf
 import tensorflow_addons as tfa
+from tensorflow.core.framework import tensor_pb2
 
 
-def get_data_from_tf(tf_path, imf_norm_op):
-    feature = {'height': tf.io.FixedLenFeature([], tf.int64),
-               'width': tf.io.FixedLenFeature([], tf.int64),
-               'depth': tf.io.FixedLenFeature([], tf.int64),
-               'label': tf.io.FixedLenFeature([], tf.int64),
-               'image/format': tf.io.FixedLenFeature([], tf.string),
-               'image_name': tf.io.FixedLenFeature([], tf.string),
-               'image/encoded': tf.io.FixedLenFeature([], tf.string),
-               'image_feature': tf.io.FixedLenFeature([], tf.string)}
+def tfrecord_feature_description():
+    # the only two features the model needs and the schema version of image_feature, height, width, depth,
+    # image/format, image_name and the heavy image/encoded patch bytes of a tfrecord be left unparsed. Old tfrecords
+    # come without feature_schema, they be schema 1
+    feature = {'label': tf.io.FixedLenFeature([], tf.int64),
+               'image_feature': tf.io.FixedLenFeature([], tf.string),
+               'feature_schema': tf.io.FixedLenFeature([], tf.int64, default_value=1)}
 
-    tfrecord_dataset = tf.data.TFRecordDataset(tf_path)
+    return feature
 
-    def _parse_image_function(key):
-        return tf.io.parse_single_example(key, feature)
 
-    CLAM_dataset = tfrecord_dataset.map(_parse_image_function)
+def parse_tfrecord_batch(serialized, feature_dtype, imf_norm_op):
+    """
+    Parse the (N,) serialized Examples of a slide with one parse_example call and decode their image_feature tensors
+    into one contiguous (N, 1024) float32 tensor, l2 normalized per patch with imf_norm_op. Returns the features and
+    the (N,) labels.
+    """
+    tfrecord_value = tf.io.parse_example(serialized, tfrecord_feature_description())
+
+    img_features = decode_image_features(image_feature=tfrecord_value['image_feature'],
+                                         feature_schema=tfrecord_value['feature_schema'],
+                                         feature_dtype=feature_dtype)
+    img_features = tf.cast(img_features, tf.float32)
+
+    if imf_norm_op:
+        img_features = tf.math.l2_normalize(img_features, axis=-1)
+
+    return img_features, tfrecord_value['label']
+
+
+def decode_image_features(image_feature, feature_schema, feature_dtype):
+    """
+    (N,) image_feature strings of a slide into one (N, 1024) tensor of the dtype they were stored in. Schema 2 records
+    hold raw little-endian bytes, decoded all at once by one decode_raw, schema 1 records a tf.io.serialize_tensor
+    TensorProto each, parsed one by one. The records of a tfrecord share their schema, the first one decides.
+    """
+    return tf.cond(feature_schema[0] >= 2,
+                   lambda: tf.io.decode_raw(image_feature, feature_dtype, little_endian=True),
+                   lambda: tf.map_fn(lambda x: tf.reshape(tf.io.parse_tensor(x, feature_dtype), [-1]),
+                                     image_feature,
+                                     fn_output_signature=tf.TensorSpec(shape=[None], dtype=feature_dtype)))
+
+
+def get_data_from_tf(tf_path, imf_norm_op, feature_cache_dir=None):
+    # the whole slide as one stacked (N, 1024) tensor in the compute dtype of the mixed precision policy, float32
+    # unless set otherwise, and its label
+    for img_features, bag_mask, slide_label, sample_name in slide_dataset(data_path='',
+                                                                         sample_names=[tf_path],
+                                                                         imf_norm_op=imf_norm_op,
+                                                                         num_parallel_reads=1,
+                                                                         prefetch_slides=1,
+                                                                         feature_cache_dir=feature_cache_dir):
+        return img_features, int(slide_label)
+
+
+# file name suffixes of compressed tfrecords, the data preparation writes .tfrecords.gz and .tfrecords.zz
+TFRECORD_COMPRESSION_SUFFIXES = {'.gz': 'GZIP', '.gzip': 'GZIP', '.zz': 'ZLIB', '.zlib': 'ZLIB'}
+
+
+def _crc32c_table():
+    table = list()
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def masked_crc32c(data):
+    # the masked crc32c of the tfrecord framing, only ever computed over the 8 length bytes of the first record
+    crc = 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    crc = crc ^ 0xFFFFFFFF
+
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord_compression(tf_path):
+    """
+    Compression type of a tfrecord, '', 'GZIP' or 'ZLIB', the compression_type of tf.data.TFRecordDataset. Taken
+    from the file name suffix, see TFRECORD_COMPRESSION_SUFFIXES, otherwise from the first bytes of the file: the
+    length crc of an uncompressed first record, the gzip magic number or a zlib stream header.
+    """
+    for suffix, compression in TFRECORD_COMPRESSION_SUFFIXES.items():
+        if tf_path.endswith(suffix):
+            return compression
+
+    with open(tf_path, 'rb') as f:
+        header = f.read(64)
+    if len(header) < 12 or struct.unpack('<I', header[8:12])[0] == masked_crc32c(header[:8]):
+        return ''
+    if header[:2] == b'\x1f\x8b':
+        return 'GZIP'
+    try:
+        zlib.decompressobj().decompress(header)
+        return 'ZLIB'
+    except zlib.error:
+        return ''
+
+
+def open_tfrecord(tf_path):
+    # binary file object of the uncompressed record stream of a tfrecord, whatever its compression
+    compression = tfrecord_compression(tf_path=tf_path)
+    if compression == 'GZIP':
+        return gzip.open(tf_path, 'rb')
+    if compression == 'ZLIB':
+        with open(tf_path, 'rb') as f:
+            return io.BytesIO(zlib.decompress(f.read()))
+
+    return open(tf_path, 'rb')
+
+
+def read_tfrecord_records(tf_path):
+    # serialized records of a tfrecord, read off its framing of 8 byte length, 4 byte length crc, record and 4 byte
+    # record crc, the crcs be not checked
+    with open_tfrecord(tf_path=tf_path) as f:
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                return
+            record_len, = struct.unpack('<Q', header[:8])
+            yield f.read(record_len)
+            f.read(4)
+
+
+def tfrecord_index_path(tf_path):
+    # sidecar record index of a tfrecord, written next to it by the data preparation or UTILITY/tfrecord_index.py
+    return tf_path + '.index'
+
+
+def is_tfrecord_index(file_name):
+    return file_name.endswith('.index')
+
+
+def scan_tfrecord_offsets(tf_path):
+    """
+    (N, 2) int64 byte offset and size of every record of a tfrecord, size counting the 16 bytes of length, crcs and
+    framing along with the serialized Example. Only the 12 byte record headers get read, the records themselves get
+    seeked over. The offsets of a compressed tfrecord be offsets into its uncompressed record stream.
+    """
+    offsets = list()
+    with open_tfrecord(tf_path=tf_path) as f:
+        offset = 0
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                break
+            record_len, = struct.unpack('<Q', header[:8])
+            offsets.append([offset, record_len + 16])
+            offset = f.seek(record_len + 4, os.SEEK_CUR)
+
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+
+def write_tfrecord_index(tf_path, offsets=None):
+    """
+    Write the sidecar index of a tfrecord, one 'offset size' text line per record, the layout the DALI tfrecord
+    reader takes as well. offsets be the (N, 2) offsets and sizes, scanned off the tfrecord when not given.
+    """
+    if offsets is None:
+        offsets = scan_tfrecord_offsets(tf_path=tf_path)
+    index_path = tfrecord_index_path(tf_path=tf_path)
+    with open(index_path + '.tmp', 'w') as f:
+        f.writelines('{} {}\n'.format(offset, size) for offset, size in offsets)
+    os.replace(index_path + '.tmp', index_path)
+
+    return index_path
+
+
+def load_tfrecord_index(tf_path):
+    """
+    (N, 2) int64 offsets and sizes of the records of a tfrecord, out of its sidecar index. An index missing or older
+    than its tfrecord gets rebuilt first.
+    """
+    index_path = tfrecord_index_path(tf_path=tf_path)
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(tf_path):
+        write_tfrecord_index(tf_path=tf_path)
+
+    with open(index_path) as f:
+        return np.array(f.read().split(), dtype=np.int64).reshape(-1, 2)
+
+
+def read_tfrecord_records_at(tf_path, record_ids, offsets=None):
+    """
+    Serialized records record_ids of a tfrecord, in the order asked for. Every record gets one seek and one read
+    through the sidecar index, so reading k records costs k reads whatever the length of the tfrecord. offsets be the
+    load_tfrecord_index of the tfrecord, loaded when not given. A compressed tfrecord has to be decompressed up to
+    every record it seeks to, the k reads only pay off on uncompressed ones.
+    """
+    if offsets is None:
+        offsets = load_tfrecord_index(tf_path=tf_path)
+
+    records = list()
+    with open_tfrecord(tf_path=tf_path) as f:
+        for record_id in record_ids:
+            offset, size = offsets[record_id]
+            f.seek(offset)
+            records.append(f.read(size)[12:-4])
+
+    return records
+
+
+def read_tfrecord_patches(tf_path, record_ids):
+    """
+    Numpy (k, 1024) features and (k, 4) level 0 coordinates of the patches record_ids of a tfrecord, and the slide
+    label, without reading the other patches of the slide, e.g. to subsample a slide or to look at its top attended
+    patches. The features come in the dtype they were stored in, without imf_norm_op.
+    """
+    img_features = list()
+    coords = list()
+    slide_label = None
+    for record in read_tfrecord_records_at(tf_path=tf_path, record_ids=record_ids):
+        feature = tf.train.Example.FromString(record).features.feature
+        img_features.append(decode_image_feature(feature=feature))
+        coords.append(record_coords(feature=feature))
+        slide_label = feature['label'].int64_list.value[0]
+
+    return np.stack(img_features), np.array(coords, dtype=np.int64).reshape(-1, 4), slide_label
+
+
+def read_tfrecord_features(tf_path):
+    """
+    Decode the whole tfrecord of a slide into a numpy (N, 1024) feature matrix, in the float32 or float16 dtype the
+    features were stored in and without imf_norm_op, and return it with the slide label. Plain python and protobuf,
+    no TensorFlow op runs, so it be safe to call from inside a tf.numpy_function of a tf.data pipeline.
+    """
+    img_features = list()
+    slide_label = None
+    feature_dtype = None
+    for record in read_tfrecord_records(tf_path=tf_path):
+        feature = tf.train.Example.FromString(record).features.feature
+        if record_feature_schema(feature=feature) >= 2:
+            # the raw bytes of all records get decoded in bulk below
+            feature_dtype = raw_feature_dtype(feature=feature)
+            img_features.append(feature['image_feature'].bytes_list.value[0])
+        else:
+            img_features.append(decode_image_feature(feature=feature))
+        slide_label = feature['label'].int64_list.value[0]
+
+    if feature_dtype is not None:
+        img_features = np.frombuffer(b''.join(img_features), dtype=feature_dtype).reshape(len(img_features), -1)
+        return img_features.astype(feature_dtype.newbyteorder('=')), slide_label
+
+    return np.stack(img_features), slide_label
+
+
+def raw_feature_dtype(feature):
+    # little-endian numpy dtype of the raw image_feature bytes of a parsed schema 2 Example
+    return np.dtype(feature['feature_dtype'].bytes_list.value[0].decode()).newbyteorder('<')
+
+
+def decode_image_feature(feature):
+    # numpy (1024,) image_feature of a parsed Example, raw little-endian bytes with schema 2, a TensorProto before
+    if record_feature_schema(feature=feature) >= 2:
+        feature_dtype = raw_feature_dtype(feature=feature)
+        return np.frombuffer(feature['image_feature'].bytes_list.value[0], dtype=feature_dtype).astype(
+            feature_dtype.newbyteorder('='))
+
+    img_feature = tensor_pb2.TensorProto.FromString(feature['image_feature'].bytes_list.value[0])
+    return tf.make_ndarray(img_feature).reshape(-1)
+
+
+def record_feature_schema(feature):
+    # schema version of the image_feature of a parsed Example, 1 for old tfrecords without feature_schema
+    if 'feature_schema' in feature:
+        return feature['feature_schema'].int64_list.value[0]
+    return 1
+
+
+def feature_cache_paths(tf_path, feature_cache_dir):
+    """
+    Paths of the .npy feature matrix and the .json label file caching the decoded features of a tfrecord in
+    feature_cache_dir. The cache key be the absolute path, the modification time and the size of the tfrecord, so a
+    rewritten tfrecord misses the cache instead of reading stale features.
+    """
+    tf_stat = os.stat(tf_path)
+    path_key = hashlib.sha1(os.path.abspath(tf_path).encode()).hexdigest()[:16]
+    cache_name = '{}.{}.{}_{}'.format(os.path.basename(tf_path), path_key, tf_stat.st_mtime_ns, tf_stat.st_size)
+
+    return os.path.join(feature_cache_dir, cache_name + '.npy'), os.path.join(feature_cache_dir, cache_name + '.json')
+
+
+def build_feature_cache(tf_path, feature_cache_dir):
+    """
+    Cache entry of a tfrecord, written on the first read: the decoded (N, 1024) feature matrix as .npy and its label,
+    patch count and dtype as .json. Entries of older versions of the same tfrecord get removed. Both files get
+    written under a temporary name and renamed into place, the .json last, so concurrent readers and the processes
+    of warm_feature_cache never see half written entries. Returns the .npy path, the label and the feature dtype.
+    """
+    feature_path, label_path = feature_cache_paths(tf_path=tf_path, feature_cache_dir=feature_cache_dir)
+
+    if not os.path.exists(label_path):
+        img_features, slide_label = read_tfrecord_features(tf_path=tf_path)
+
+        os.makedirs(feature_cache_dir, exist_ok=True)
+        cache_stem = label_path[:-len('.json')]
+        for stale_path in glob.glob(glob.escape(cache_stem.rsplit('.', 1)[0]) + '.*'):
+            if not stale_path.startswith(cache_stem + '.'):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(feature_path + tmp_suffix, 'wb') as f:
+            np.save(f, img_features)
+        os.replace(feature_path + tmp_suffix, feature_path)
+
+        with open(label_path + tmp_suffix, 'w') as f:
+            json.dump({'tf_path': os.path.abspath(tf_path),
+                       'label': slide_label,
+                       'n_patches': int(img_features.shape[0]),
+                       'dtype': img_features.dtype.name}, f)
+        os.replace(label_path + tmp_suffix, label_path)
+
+    with open(label_path) as f:
+        cache_entry = json.load(f)
+
+    return feature_path, cache_entry['label'], tf.dtypes.as_dtype(cache_entry['dtype'])
+
+
+def load_cached_features(feature_path):
+    # memory-mapped, the pages of the feature matrix come straight from the page cache without any parsing
+    return np.load(feature_path.decode(), mmap_mode='r')
+
+
+class BagCache(object):
+    """
+    Process-wide LRU cache of decoded slides, shared by the slide_dataset pipelines of train_step and val_step for
+    the whole run, so that the slides fitting into budget_bytes of RAM get read from disk only once. A slide gets
+    cached as its numpy (N, 1024) feature matrix in the dtype it was stored in, before imf_norm_op and the patch
+    shuffle. On a miss, the slide comes from the feature cache of feature_cache_dir when there be one, otherwise
+    from its tfrecord. The least recently used slides get evicted until the new one fits, a slide larger than the
+    whole budget never gets cached, so the cache never holds more than budget_bytes whatever the slide sizes.
+    hits, misses and evictions count since the start of the run.
+    """
+
+    def __init__(self, budget_bytes, feature_cache_dir=None):
+        self.budget_bytes = budget_bytes
+        self.feature_cache_dir = feature_cache_dir
+        self.bags = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # slide_dataset loads num_parallel_reads slides at the same time
+        self.lock = threading.Lock()
+
+    def load(self, tf_path):
+        # numpy_function entry point of slide_dataset, tf_path comes as bytes
+        tf_path = tf_path.decode()
+        with self.lock:
+            if tf_path in self.bags:
+                self.bags.move_to_end(tf_path)
+                self.hits += 1
+                return self.bags[tf_path]
+            self.misses += 1
+
+        if self.feature_cache_dir is None:
+            img_features, slide_label = read_tfrecord_features(tf_path=tf_path)
+        else:
+            feature_path, slide_label, _ = build_feature_cache(tf_path=tf_path,
+                                                               feature_cache_dir=self.feature_cache_dir)
+            img_features = np.load(feature_path)
+        bag = (img_features, np.int64(slide_label))
+
+        with self.lock:
+            if img_features.nbytes <= self.budget_bytes and tf_path not in self.bags:
+                while self.n_bytes + img_features.nbytes > self.budget_bytes:
+                    evicted_features, evicted_label = self.bags.popitem(last=False)[1]
+                    self.n_bytes -= evicted_features.nbytes
+                    self.evictions += 1
+                self.bags[tf_path] = bag
+                self.n_bytes += img_features.nbytes
+
+        return bag
+
+
+def read_tfrecord_coords(tf_path):
+    """
+    (N, 4) int64 level 0 patch coordinates (x1, y1, x2, y2) of a tfrecord, the coords feature of feature-only
+    tfrecords, otherwise parsed off the image_name the wsi data preparation gives every patch,
+    samp_x_x1_x2_y_y1_y2_mean_std_bytes.jpg, -1 for patches without coordinates.
+    """
+    coords = [record_coords(feature=tf.train.Example.FromString(record).features.feature)
+              for record in read_tfrecord_records(tf_path=tf_path)]
+
+    return np.array(coords, dtype=np.int64).reshape(-1, 4)
+
+
+def record_coords(feature):
+    # [x1, y1, x2, y2] of a parsed Example, see read_tfrecord_coords
+    if 'coords' in feature:
+        return list(feature['coords'].int64_list.value)
+    image_name = feature['image_name'].bytes_list.value[0].decode() if 'image_name' in feature else ''
+    xy = re.findall(r'_x_(\d+)_(\d+)_y_(\d+)_(\d+)_', image_name)
+    if len(xy) > 0:
+        x1, x2, y1, y2 = [int(i) for i in xy[-1]]
+        return [x1, y1, x2, y2]
+
+    return [-1, -1, -1, -1]
+
+
+def feature_corpus_paths(corpus_path):
+    # contiguous feature matrix, patch coordinates and slide index of a feature corpus directory
+    return os.path.join(corpus_path, 'corpus_features.npy'), os.path.join(corpus_path, 'corpus_coords.npy'), \
+           os.path.join(corpus_path, 'corpus_index.tsv')
+
+
+def is_feature_corpus(data_path):
+    return os.path.exists(feature_corpus_paths(corpus_path=data_path)[2])
+
+
+def list_slides(data_path):
+    # sample names of a data directory, out of its slide manifest when it has one, otherwise the tfrecord file names
+    # without their sidecar indexes, or the slide ids of a feature corpus
+    if is_feature_corpus(data_path=data_path):
+        return FeatureCorpus(corpus_path=data_path).slide_ids
+    slide_manifest = load_slide_manifest(data_path=data_path)
+    if slide_manifest is not None:
+        return list(slide_manifest)
+    return [file_name for file_name in os.listdir(data_path)
+            if not is_tfrecord_index(file_name=file_name) and not file_name.startswith(SLIDE_MANIFEST_NAME)]
+
+
+class FeatureCorpus(object):
+    """
+    Reader of a feature corpus packed by UTILITY/feature_corpus.py: the (N_total, 1024) features of all slides of a
+    data directory in one contiguous .npy file, their (N_total, 4) patch coordinates in another, and an index with
+    one (slide_id, label, offset, n_patches, coords_offset) row per slide. Both .npy files get memory-mapped, bag()
+    and coords() return numpy views into the mappings, no copy and no file opened per slide.
+    """
+
+    def __init__(self, corpus_path):
+        feature_path, coords_path, index_path = feature_corpus_paths(corpus_path=corpus_path)
+        self.features = np.load(feature_path, mmap_mode='r')
+        self.patch_coords = np.load(coords_path, mmap_mode='r')
+
+        corpus_index = pd.read_csv(index_path, sep='\t', dtype={'slide_id': str})
+        self.slide_ids = list(corpus_index['slide_id'])
+        self.slides = {row.slide_id: (row.label, row.offset, row.n_patches, row.coords_offset)
+                       for row in corpus_index.itertuples()}
+
+    def bag(self, slide_id):
+        # (n_patches, 1024) features and label of a slide, slide_id may come as bytes out of a numpy_function
+        slide_id = slide_id.decode() if isinstance(slide_id, bytes) else slide_id
+        label, offset, n_patches, coords_offset = self.slides[slide_id]
+
+        return self.features[offset:offset + n_patches], np.int64(label)
+
+    def coords(self, slide_id):
+        label, offset, n_patches, coords_offset = self.slides[slide_id]
+
+        return self.patch_coords[coords_offset:coords_offset + n_patches]
+
+
+SLIDE_MANIFEST_NAME = 'slide_manifest.jsonl'
+
+
+def slide_manifest_path(data_path):
+    return os.path.join(data_path, SLIDE_MANIFEST_NAME)
+
 
-    image_features = list()
+def slide_manifest_entry(tf_path):
+    """
+    Manifest row of a tfrecord: its file name, label, patch count, byte size, feature dim and dtype, compression,
+    sha1 checksum and modification time. The patches get counted off the record headers, only the first record gets
+    parsed.
+    """
+    feature = tf.train.Example.FromString(next(read_tfrecord_records(tf_path=tf_path))).features.feature
+    img_feature = decode_image_feature(feature=feature)
+    checksum = hashlib.sha1()
+    with open(tf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 22), b''):
+            checksum.update(chunk)
+    tf_stat = os.stat(tf_path)
+
+    return {'sample_name': os.path.basename(tf_path),
+            'label': feature['label'].int64_list.value[0],
+            'n_patches': len(scan_tfrecord_offsets(tf_path=tf_path)),
+            'n_bytes': tf_stat.st_size,
+            'feature_dim': int(img_feature.shape[-1]),
+            'feature_dtype': img_feature.dtype.name,
+            'compression': tfrecord_compression(tf_path=tf_path),
+            'sha1': checksum.hexdigest(),
+            'mtime_ns': tf_stat.st_mtime_ns}
+
+
+def build_slide_manifest(data_path, n_workers=1):
+    """
+    Write the slide manifest of a data directory, one JSON line per tfrecord, see slide_manifest_entry. Rows of an
+    existing manifest get kept for tfrecords of unchanged size and modification time, the other tfrecords get read
+    by a pool of n_workers processes. The manifest gets written under a temporary name and renamed into place.
+    Returns the number of slides and of newly read tfrecords.
+    """
+    slide_manifest = load_slide_manifest(data_path=data_path) or dict()
+    sample_names = sorted(file_name for file_name in os.listdir(data_path)
+                          if not is_tfrecord_index(file_name=file_name) and
+                          not file_name.startswith(SLIDE_MANIFEST_NAME))
+
+    entries = dict()
+    for sample_name in sample_names:
+        tf_stat = os.stat(os.path.join(data_path, sample_name))
+        entry = slide_manifest.get(sample_name)
+        if entry is not None and entry['n_bytes'] == tf_stat.st_size and entry['mtime_ns'] == tf_stat.st_mtime_ns:
+            entries[sample_name] = entry
+    missing_paths = [os.path.join(data_path, sample_name) for sample_name in sample_names
+                     if sample_name not in entries]
+
+    if n_workers > 1 and len(missing_paths) > 1:
+        with multiprocessing.get_context('spawn').Pool(processes=n_workers, initializer=_hide_gpus) as pool:
+            new_entries = pool.map(slide_manifest_entry, missing_paths, chunksize=1)
+    else:
+        new_entries = [slide_manifest_entry(tf_path=tf_path) for tf_path in missing_paths]
+    entries.update((entry['sample_name'], entry) for entry in new_entries)
+
+    write_slide_manifest(data_path=data_path, entries=[entries[sample_name] for sample_name in sample_names])
+
+    return len(sample_names), len(missing_paths)
+
+
+def write_slide_manifest(data_path, entries):
+    manifest_path = slide_manifest_path(data_path=data_path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load_slide_manifest(data_path):
+    # manifest rows of a data directory by sample name, in manifest order, None for a directory without manifest
+    if not data_path or not os.path.exists(slide_manifest_path(data_path=data_path)):
+        return None
+
+    with open(slide_manifest_path(data_path=data_path)) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    return collections.OrderedDict((entry['sample_name'], entry) for entry in entries)
+
+
+def slide_patch_counts(data_path):
+    # patch count of every slide of a data directory, out of its slide manifest or its feature corpus index, None
+    # for a plain directory of tfrecords, whose patches could only be counted by reading them
+    if is_feature_corpus(data_path=data_path):
+        return {slide_id: slide[2] for slide_id, slide in FeatureCorpus(corpus_path=data_path).slides.items()}
+    slide_manifest = load_slide_manifest(data_path=data_path)
+    if slide_manifest is not None:
+        return {sample_name: entry['n_patches'] for sample_name, entry in slide_manifest.items()}
+
+    return None
+
+
+def schedule_slides(data_path, sample_names, slide_batch_size=1, largest_first=False, sort_window=8):
+    """
+    Order sample_names for slide_dataset by the patch counts of slide_patch_counts, no tfrecord gets opened.
+    With largest_first, the largest slides come first, their long reads and forward passes start while the small
+    slides fill in behind them, instead of one large slide holding up the end of the epoch.
+    Otherwise, with slide_batch_size above 1, every sort_window batches worth of sample_names get sorted by size and
+    cut into batches, and the full batches get shuffled, so that the slides of a zero-padded batch be of similar
+    size and little of the batch be padding. The slides of an epoch stay the same, only their grouping changes.
+    Without patch counts, sample_names come back as they be.
+    """
+    n_patches = slide_patch_counts(data_path=data_path)
+    sample_names = list(sample_names)
+    if n_patches is None:
+        return sample_names
+
+    if largest_first:
+        return sorted(sample_names, key=lambda sample_name: -n_patches[sample_name])
+
+    if slide_batch_size > 1:
+        window = slide_batch_size * sort_window
+        batches = list()
+        for i in range(0, len(sample_names), window):
+            window_names = sorted(sample_names[i:i + window], key=lambda sample_name: n_patches[sample_name])
+            batches.extend(window_names[j:j + slide_batch_size] for j in range(0, len(window_names), slide_batch_size))
+        # a last batch short of slide_batch_size slides has to stay last, padded_batch cuts the batches in order
+        last_batch = batches.pop() if len(batches) > 0 and len(batches[-1]) < slide_batch_size else []
+        random.shuffle(batches)
+        return [sample_name for batch in batches + [last_batch] for sample_name in batch]
+
+    return sample_names
+
+
+def _hide_gpus():
+    # the warm up processes only decode on the CPU and must not take GPU memory away from training
+    tf.config.set_visible_devices([], 'GPU')
+
+
+def warm_feature_cache(data_paths, feature_cache_dir, n_workers):
+    """
+    Build the feature cache of every tfrecord in the data_paths directories with a pool of n_workers processes,
+    ahead of the first epoch. Tfrecords already in the cache get skipped.
+    """
+    # feature corpora be memory-mapped already and have nothing to cache
+    tf_paths = [os.path.join(data_path, sample_name) for data_path in data_paths
+                if data_path is not None and not is_feature_corpus(data_path=data_path)
+                for sample_name in sorted(list_slides(data_path=data_path))]
+    missing_paths = [tf_path for tf_path in tf_paths
+                     if not os.path.exists(feature_cache_paths(tf_path=tf_path, feature_cache_dir=feature_cache_dir)[1])]
+
+    start_time = time.time()
+    if len(missing_paths) > 0:
+        # spawned, forking a process that already runs TensorFlow can dead-lock its thread pools
+        with multiprocessing.get_context('spawn').Pool(processes=n_workers, initializer=_hide_gpus) as pool:
+            pool.starmap(build_feature_cache, [(tf_path, feature_cache_dir) for tf_path in missing_paths],
+                         chunksize=1)
+
+    template = '\n Feature cache of {} slides ready in {}, {} newly decoded, --- {:.1f} s ---'
+    print(template.format(len(tf_paths), feature_cache_dir, len(missing_paths), time.time() - start_time))
+
+
+def tfrecord_feature_dtype(tf_path):
+    # dtype of the image_feature tensors of a tfrecord, read off the schema metadata or the TensorProto of its first
+    # record
+    for record in read_tfrecord_records(tf_path=tf_path):
+        feature = tf.train.Example.FromString(record).features.feature
+        if record_feature_schema(feature=feature) >= 2:
+            return tf.dtypes.as_dtype(feature['feature_dtype'].bytes_list.value[0].decode())
+        return serialized_tensor_dtype(feature['image_feature'].bytes_list.value[0])
+
+
+def slide_dataset(data_path, sample_names, imf_norm_op, shuffle_seed=None, slide_batch_size=1,
+                  num_parallel_reads=4, prefetch_slides=2, feature_cache_dir=None, bag_cache=None):
+    """
+    tf.data pipeline over the slides sample_names of data_path, in the given order. Every element be one whole bag,
+    (img_features, bag_mask, slide_label, sample_name), img_features be (N, 1024) in the compute dtype of the mixed
+    precision policy and bag_mask be (N,) ones. num_parallel_reads slides get read and parsed at the same time,
+    interleaved across their tfrecord files, the records of a slide in one batched parse, see parse_tfrecord_batch,
+    and prefetch_slides bags wait ready ahead of the train, val or test step, so the I/O of the next slides overlaps
+    with the compute of the current one.
+    With shuffle_seed, the patch order of every slide gets shuffled, seeded by shuffle_seed and the slide position.
+    With slide_batch_size above 1, the bags come zero-padded into (B, N_max, 1024) batches with (B, N_max) bag_mask,
+    the multi-slide minibatches of train_step and val_step.
+    All tfrecords of data_path have to hold features of the same dtype, see tfrecord_feature_dtype. GZIP and ZLIB
+    compressed tfrecords get read as well, see tfrecord_compression. With a slide manifest in data_path, see
+    build_slide_manifest, the feature dtype and the compressions come out of it instead of the tfrecords themselves.
+    With feature_cache_dir, the slides get decoded once into the .npy feature cache of build_feature_cache, the
+    first time the pipeline reads them, num_parallel_reads at a time, and every later read memory-maps the cached
+    matrix instead of parsing the tfrecord.
+    With a BagCache, the slides come out of its RAM cache and only its misses go to disk.
+    A data_path holding a feature corpus, see FeatureCorpus, gets served from its memory mapping instead, sample_names
+    be slide ids of its index then, and neither the feature cache nor the bag cache get used.
+    """
+    compute_dtype = tf.keras.mixed_precision.global_policy().compute_dtype
+    slide_manifest = load_slide_manifest(data_path=data_path)
+
+    def _feature_dtype():
+        if slide_manifest is not None:
+            return tf.dtypes.as_dtype(slide_manifest[sample_names[0]]['feature_dtype'])
+        return tfrecord_feature_dtype(tf_path=data_path + sample_names[0])
+
+    def _bag(slide_index, sample_name, img_features, slide_label):
+        if shuffle_seed is not None:
+            seed = tf.stack([tf.constant(shuffle_seed, dtype=tf.int64), slide_index])
+            patch_order = tf.argsort(tf.random.stateless_uniform([tf.shape(img_features)[0]], seed=seed))
+            img_features = tf.gather(img_features, patch_order)
+        bag_mask = tf.ones([tf.shape(img_features)[0]], dtype=tf.float32)
 
-    for tfrecord_value in CLAM_dataset:
-        img_feature = tf.io.parse_tensor(tfrecord_value['image_feature'], 'float32')
+        return tf.cast(img_features, compute_dtype), bag_mask, tf.cast(slide_label, tf.int32), sample_name
+
+    def _cached_features(img_features):
+        # numpy loaded matrix of the feature or bag cache into a (N, 1024) float32 tensor, normalized by imf_norm_op
+        img_features = tf.reshape(tf.cast(img_features, tf.float32), [-1, tf.shape(img_features)[-1]])
 
         if imf_norm_op:
-            img_feature = tf.math.l2_normalize(img_feature)
+            img_features = tf.math.l2_normalize(img_features, axis=-1)
+
+        return img_features
+
+    if is_feature_corpus(data_path=data_path):
+        corpus = FeatureCorpus(corpus_path=data_path)
+
+        def _load_corpus_bag(slide_index, sample_name):
+            img_features, slide_label = tf.numpy_function(corpus.bag, [sample_name],
+                                                          [tf.as_dtype(corpus.features.dtype), tf.int64])
+            slide_label = tf.ensure_shape(slide_label, [])
+
+            return _bag(slide_index, sample_name, _cached_features(img_features), slide_label)
+
+        CLAM_dataset = tf.data.Dataset.from_tensor_slices(sample_names).enumerate()
+        CLAM_dataset = CLAM_dataset.map(_load_corpus_bag,
+                                        num_parallel_calls=num_parallel_reads,
+                                        deterministic=True)
+    elif bag_cache is not None:
+        feature_dtype = _feature_dtype()
+
+        def _load_bag(slide_index, sample_name):
+            img_features, slide_label = tf.numpy_function(bag_cache.load,
+                                                          [tf.strings.join([data_path, sample_name])],
+                                                          [feature_dtype, tf.int64])
+            # numpy_function outputs come without a shape, padded_batch needs at least the rank
+            slide_label = tf.ensure_shape(slide_label, [])
+
+            return _bag(slide_index, sample_name, _cached_features(img_features), slide_label)
+
+        CLAM_dataset = tf.data.Dataset.from_tensor_slices(sample_names).enumerate()
+        CLAM_dataset = CLAM_dataset.map(_load_bag,
+                                        num_parallel_calls=num_parallel_reads,
+                                        deterministic=True)
+    elif feature_cache_dir is None:
+        feature_dtype = _feature_dtype()
+
+        def _parse_bag(slide_index, sample_name, serialized):
+            img_features, labels = parse_tfrecord_batch(serialized=serialized,
+                                                        feature_dtype=feature_dtype,
+                                                        imf_norm_op=imf_norm_op)
+
+            return _bag(slide_index, sample_name, img_features, labels[0])
+
+        def _load_slide(slide_index, slide):
+            sample_name, compression = slide
+            tfrecord_dataset = tf.data.TFRecordDataset(tf.strings.join([data_path, sample_name]),
+                                                       compression_type=compression)
+            # one batch holding every serialized record of the tfrecord, the whole bag of the slide
+            tfrecord_dataset = tfrecord_dataset.batch(2 ** 31 - 1)
+
+            return tfrecord_dataset.map(lambda serialized: _parse_bag(slide_index, sample_name, serialized))
+
+        # compressed and uncompressed tfrecords may be mixed in one data_path
+        if slide_manifest is not None:
+            compressions = [slide_manifest[sample_name]['compression'] for sample_name in sample_names]
+        else:
+            compressions = [tfrecord_compression(tf_path=data_path + sample_name) for sample_name in sample_names]
+        CLAM_dataset = tf.data.Dataset.from_tensor_slices((list(sample_names), compressions)).enumerate()
+        CLAM_dataset = CLAM_dataset.interleave(_load_slide,
+                                               cycle_length=num_parallel_reads,
+                                               num_parallel_calls=num_parallel_reads,
+                                               deterministic=True)
+    else:
+        feature_dtype = _feature_dtype()
+
+        def _cached_bag(tf_path):
+            # decodes the slide into the cache on its first read, every later read only memory-maps the cache entry
+            feature_path, slide_label, _ = build_feature_cache(tf_path=tf_path.decode(),
+                                                               feature_cache_dir=feature_cache_dir)
 
-        slide_labels = tfrecord_value['label']
-        slide_label = int(slide_labels)
+            return load_cached_features(feature_path=feature_path.encode()), np.int64(slide_label)
 
-        image_features.append(img_feature)
+        def _load_cached_slide(slide_index, sample_name):
+            img_features, slide_label = tf.numpy_function(_cached_bag, [tf.strings.join([data_path, sample_name])],
+                                                          [feature_dtype, tf.int64])
+            slide_label = tf.ensure_shape(slide_label, [])
 
-    return image_features, slide_label
+            return _bag(slide_index, sample_name, _cached_features(img_features), slide_label)
+
+        CLAM_dataset = tf.data.Dataset.from_tensor_slices(sample_names).enumerate()
+        CLAM_dataset = CLAM_dataset.map(_load_cached_slide,
+                                        num_parallel_calls=num_parallel_reads,
+                                        deterministic=True)
+
+    if slide_batch_size > 1:
+        CLAM_dataset = CLAM_dataset.padded_batch(slide_batch_size)
+
+    return CLAM_dataset.prefetch(prefetch_slides)
+
+
+def serialized_tensor_dtype(serialized_tensor):
+    # dtype a tf.io.serialize_tensor output was written with, float32 or float16 for the image_feature of a tfrecord
+    return tf.dtypes.as_dtype(tensor_pb2.TensorProto.FromString(serialized_tensor).dtype)
 
 
 def most_frequent(List):
@@ -149,6 +896,14 @@ def load_optimizers(i_wd_op_name, b_wd_op_name, a_wd_op_name,
     return i_optimizer, b_optimizer, c_optimizer
 
 
+def load_loss_scale():
+    # float16 gradients underflow without loss scaling, bfloat16 keeps the float32 exponent range and needs none
+    if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
+        return DynamicLossScale()
+
+    return None
+
+
 def load_loss_func(i_loss_func_name, b_loss_func_name):
 
     tf_func_dic = loss_func_options()
@@ -158,6 +913,133 @@ def load_loss_func(i_loss_func_name, b_loss_func_name):
 
     return i_loss_func, b_loss_func
 
+def compute_ins_loss(i_loss_func, ins_labels, ins_logits, n_class, mut_ex):
+    # instance-level loss averaged over all selected instances of a slide in one call, ins_logits be (n_ins, n_class),
+    # or (B, n_ins, n_class) for a multi-slide batch whose per-slide losses get averaged; label -1 marks a padding
+    # candidate of a padded bag and gets left out of the average
+    ins_valid = tf.cast(tf.math.greater_equal(ins_labels, 0), ins_logits.dtype)
+    ins_loss = i_loss_func(tf.one_hot(ins_labels, 2), ins_logits)
+    ins_loss = tf.math.reduce_sum(ins_loss * ins_valid, axis=-1) / tf.math.reduce_sum(ins_valid, axis=-1)
+    ins_loss = tf.math.reduce_mean(ins_loss)
+    if mut_ex:
+        I_Loss = ins_loss / n_class
+    else:
+        I_Loss = ins_loss
+
+    return I_Loss
+
+def compute_bag_loss(b_loss_func, Y_true, Y_prob):
+    # bag-level loss of every slide, Y_prob be (B, n_class) with B = 1 for a single slide, averaged over the slides
+    return tf.math.reduce_mean(b_loss_func(Y_true, Y_prob))
+
+class DynamicLossScale(tf.Module):
+    """
+    The one loss scale of the attention network, instance classifier and bag classifier optimizers under the
+    mixed_float16 policy, see load_loss_scale. The single backward pass of nb_optimize runs under it, so all three
+    networks share it. It follows the schedule of tf.keras.mixed_precision.LossScaleOptimizer: it starts at 2 ** 15,
+    halves after a step with non-finite gradients in any of the three networks and doubles after growth_steps finite
+    steps in a row. Its variables get checkpointed next to the optimizers, see UTILITY/model_session.py.
+    """
+
+    def __init__(self, initial_scale=2 ** 15, growth_steps=2000):
+        super(DynamicLossScale, self).__init__(name='dynamic_loss_scale')
+        self.growth_steps = growth_steps
+        self.loss_scale = tf.Variable(float(initial_scale), dtype=tf.float32, trainable=False, name='loss_scale')
+        self.good_steps = tf.Variable(0, dtype=tf.int64, trainable=False, name='good_steps')
+
+    def update(self, grads_finite):
+        good_steps = tf.where(grads_finite, self.good_steps + 1, tf.zeros_like(self.good_steps))
+        grow = good_steps >= self.growth_steps
+        loss_scale = tf.where(grads_finite,
+                              tf.where(grow, self.loss_scale * 2, self.loss_scale),
+                              tf.math.maximum(self.loss_scale / 2, 1))
+        self.loss_scale.assign(loss_scale)
+        self.good_steps.assign(tf.where(grow, tf.zeros_like(good_steps), good_steps))
+
+def scale_loss(loss_scale, loss):
+    # a DynamicLossScale (mixed_float16 policy, see load_loss_scale) needs the loss scaled inside the tape
+    if loss_scale is not None:
+        return loss * tf.cast(loss_scale.loss_scale, loss.dtype)
+
+    return loss
+
+def unscale_gradients(loss_scale, grads):
+    if loss_scale is not None:
+        reciprocal = 1 / loss_scale.loss_scale
+        return [None if grad is None else grad * tf.cast(reciprocal, grad.dtype) for grad in grads]
+
+    return grads
+
+def compute_network_gradients(tape, I_Loss, B_Loss, T_Loss, c1, c2, a_net, i_net, b_net):
+    """
+    Gradients of the attention network from T_Loss, of the instance classifier from I_Loss and of the bag classifier
+    from B_Loss, out of one backward pass of T_Loss = c1 * B_Loss + c2 * I_Loss. I_Loss be the only term reaching
+    the instance classifier and B_Loss the only term reaching the bag classifier, so their T_Loss gradients be the
+    I_Loss and B_Loss gradients times c2 and c1. With c1 or c2 be 0 that factor cannot be divided out, the network
+    then gets its own backward pass and the tape has to be persistent.
+    The losses come in scaled by the same loss scale under the mixed_float16 policy, see scale_loss.
+    """
+    a_vars = a_net.trainable_weights
+    i_vars = i_net.trainable_weights
+    b_vars = b_net.trainable_weights
+
+    t_grad = tape.gradient(T_Loss, a_vars + i_vars + b_vars)
+    a_grad = t_grad[:len(a_vars)]
+
+    if c2 != 0:
+        i_grad = [None if grad is None else grad / c2 for grad in t_grad[len(a_vars):(len(a_vars) + len(i_vars))]]
+    else:
+        i_grad = tape.gradient(I_Loss, i_vars)
+
+    if c1 != 0:
+        b_grad = [None if grad is None else grad / c1 for grad in t_grad[(len(a_vars) + len(i_vars)):]]
+    else:
+        b_grad = tape.gradient(B_Loss, b_vars)
+
+    return a_grad, i_grad, b_grad
+
+def build_optimizer_weights(optimizer, var_list):
+    """
+    Create the slot variables of the optimizer ahead of the tf.cond of apply_network_gradients, a tf.function must not
+    create variables inside one of its branches. Optimizers of TensorFlow 2.11 on have build() for that, the legacy
+    Keras and tensorflow-addons optimizers have none and create their slot variables inside the branch just fine.
+    """
+    if hasattr(optimizer, 'build'):
+        optimizer.build(var_list)
+
+def apply_network_gradients(a_optimizer, i_optimizer, b_optimizer, a_grad, i_grad, b_grad, a_net, i_net, b_net,
+                            loss_scale=None):
+    """
+    One update step of all three networks, inside a tf.function the three optimizers land in the same graph.
+    Under the mixed_float16 policy the gradients come in already unscaled by the one loss_scale of all three
+    networks, see DynamicLossScale. Gradients that overflow in any of the three networks skip the step of all three
+    and lower that loss scale, the skipped step still counts in the iterations of every optimizer, the same way a
+    LossScaleOptimizer skips its own step.
+    """
+    networks = [(i_optimizer, i_grad, i_net), (b_optimizer, b_grad, b_net), (a_optimizer, a_grad, a_net)]
+
+    if loss_scale is None:
+        for optimizer, grads, net in networks:
+            optimizer.apply_gradients(zip(grads, net.trainable_weights))
+        return
+
+    grads_finite = tf.math.reduce_all([tf.math.reduce_all(tf.math.is_finite(grad))
+                                       for grad in list(a_grad) + list(i_grad) + list(b_grad) if grad is not None])
+
+    for optimizer, grads, net in networks:
+        build_optimizer_weights(optimizer=optimizer, var_list=net.trainable_weights)
+
+    def apply_fn():
+        for optimizer, grads, net in networks:
+            optimizer.apply_gradients(zip(grads, net.trainable_weights))
+
+    def skip_fn():
+        for optimizer, grads, net in networks:
+            optimizer.iterations.assign_add(1, read_value=False)
+
+    tf.cond(grads_finite, apply_fn, skip_fn)
+    loss_scale.update(grads_finite=grads_finite)
+
 def str_to_bool():
     str_bool_dic = {'True': True,
                     'False': False}
@@ -186,54 +1068,64 @@ def dataset_shuffle(dataset, path, percent):
     if not os.path.exists(test):
         os.mkdir(os.path.join(path, 'test'))
 
-    total_num_data = len(os.listdir(dataset))
+    dataset_names = list_slides(data_path=dataset)
+    total_num_data = len(dataset_names)
 
     # only shuffle the data when train, validation, and test directory are all empty
     if len(os.listdir(train)) == 0 & len(os.listdir(valid)) == 0 & len(os.listdir(test)) == 0:
-        train_names = random.sample(os.listdir(dataset), int(total_num_data * percent[0]))
+        train_names = random.sample(dataset_names, int(total_num_data * percent[0]))
         for i in train_names:
-            train_srcpath = os.path.join(dataset, i)
-            shutil.copy(train_srcpath, train)
+            copy_slide(data_path=dataset, sample_name=i, dst_path=train)
 
-        valid_names = random.sample(list(set(os.listdir(dataset)) - set(os.listdir(train))),
+        valid_names = random.sample(list(set(dataset_names) - set(train_names)),
                                     int(total_num_data * percent[1]))
         for j in valid_names:
-            valid_srcpath = os.path.join(dataset, j)
-            shutil.copy(valid_srcpath, valid)
+            copy_slide(data_path=dataset, sample_name=j, dst_path=valid)
 
-        test_names = list(set(os.listdir(dataset)) - set(os.listdir(train)) - set(os.listdir(valid)))
+        test_names = list(set(dataset_names) - set(train_names) - set(valid_names))
         for k in test_names:
-            test_srcpath = os.path.join(dataset, k)
-            shutil.copy(test_srcpath, test)
+            copy_slide(data_path=dataset, sample_name=k, dst_path=test)
+
+        # the split directories get their rows of the dataset manifest, no tfrecord gets read again
+        slide_manifest = load_slide_manifest(data_path=dataset)
+        if slide_manifest is not None:
+            for split_path, split_names in [(train, train_names), (valid, valid_names), (test, test_names)]:
+                write_slide_manifest(data_path=split_path,
+                                     entries=[slide_manifest[sample_name] for sample_name in sorted(split_names)])
+
+
+def copy_slide(data_path, sample_name, dst_path):
+    # a tfrecord and its sidecar index, with their modification times, so that the manifest rows stay valid
+    tf_path = os.path.join(data_path, sample_name)
+    shutil.copy2(tf_path, dst_path)
+    if os.path.exists(tfrecord_index_path(tf_path=tf_path)):
+        shutil.copy2(tfrecord_index_path(tf_path=tf_path), dst_path)
+
 
 def ng_att_call(ng_att_net, img_features):
-    h = list()
-    A = list()
+    # img_features be the stacked (N, 1024) bag, a list of (1, 1024) feature vectors returns lists as before
+    if isinstance(img_features, (list, tuple)):
+        h, A = ng_att_call(ng_att_net=ng_att_net, img_features=tf.concat(img_features, axis=0))
+        return tf.split(h, len(img_features)), tf.split(A, len(img_features))
 
-    for i in img_features:
-        c_imf = ng_att_net[0](i)
-        h.append(c_imf)
+    h = ng_att_net[0](img_features)  # shape be (N, 512)
+    A = ng_att_net[1](h)  # shape be (N, n_class)
 
-    for j in h:
-        a = ng_att_net[1](j)
-        A.append(a)
     return h, A
 
 
 def g_att_call(g_att_net, img_features):
-    h = list()
-    A = list()
+    # img_features be the stacked (N, 1024) bag, a list of (1, 1024) feature vectors returns lists as before
+    if isinstance(img_features, (list, tuple)):
+        h, A = g_att_call(g_att_net=g_att_net, img_features=tf.concat(img_features, axis=0))
+        return tf.split(h, len(img_features)), tf.split(A, len(img_features))
 
-    for i in img_features:
-        c_imf = g_att_net[0](i)
-        h.append(c_imf)
+    h = g_att_net[0](img_features)  # shape be (N, 512)
 
-    for j in h:
-        att_v_output = g_att_net[1](j)
-        att_u_output = g_att_net[2](j)
-        att_input = tf.math.multiply(att_v_output, att_u_output)
-        a = g_att_net[3](att_input)
-        A.append(a)
+    att_v_output = g_att_net[1](h)
+    att_u_output = g_att_net[2](h)
+    att_input = tf.math.multiply(att_v_output, att_u_output)
+    A = g_att_net[3](att_input)  # shape be (N, n_class)
 
     return h, A
 
@@ -246,110 +1138,108 @@ def generate_neg_labels(n_neg_sample):
     return tf.fill(dims=[n_neg_sample, ], value=0)
 
 
-def ins_in_call(ins_classifier, h, A_I, top_k_percent, n_class):
-    n_ins = top_k_percent * len(h)
-    n_ins = int(n_ins)
+def ins_top_k_count(h, top_k_percent, bag_mask=None):
+    # number of top k instances n_ins, computed with tensor ops so that it also works inside a tf.function, plus the
+    # number of selected candidates, which only differs from n_ins for a padded bag, where it follows the padded
+    # length so that it stays a constant for XLA
+    n_samples = h.shape[0] if h.shape[0] is not None else tf.shape(h)[0]
+    n_cand = tf.cast(top_k_percent * tf.cast(n_samples, tf.float64), tf.int32)
 
-    pos_label = generate_pos_labels(n_pos_sample=n_ins)
-    neg_label = generate_neg_labels(n_neg_sample=n_ins)
-    ins_label_in = tf.concat(values=[pos_label, neg_label], axis=0)
+    if bag_mask is None:
+        return n_cand, n_cand
+
+    n_valid = tf.cast(tf.math.reduce_sum(bag_mask), tf.int32)
+    n_ins = tf.cast(top_k_percent * tf.cast(n_valid, tf.float64), tf.int32)
+    n_ins = tf.math.minimum(n_ins, n_valid)
+
+    return n_ins, n_cand
 
-    A_I = tf.reshape(tf.convert_to_tensor(A_I), (1, len(A_I)))
 
-    top_pos_ids = tf.math.top_k(A_I, n_ins)[1][-1]
-    pos_index = list()
-    for i in top_pos_ids:
-        pos_index.append(i)
+def ignore_ins_labels(ins_label, n_ins):
+    # candidates ranked past n_ins only pad the fixed-size selection of a padded bag, label -1 makes the instance
+    # loss ignore them
+    return tf.where(tf.range(tf.shape(ins_label)[0]) < n_ins, ins_label, -1)
 
-    pos_index = tf.convert_to_tensor(pos_index)
-    top_pos = list()
-    for i in pos_index:
-        top_pos.append(h[i])
 
-    top_neg_ids = tf.math.top_k(-A_I, n_ins)[1][-1]
-    neg_index = list()
-    for i in top_neg_ids:
-        neg_index.append(i)
+def ins_in_call(ins_classifier, h, A_I, top_k_percent, n_class, bag_mask=None):
+    n_ins, n_cand = ins_top_k_count(h=h, top_k_percent=top_k_percent, bag_mask=bag_mask)
 
-    neg_index = tf.convert_to_tensor(neg_index)
-    top_neg = list()
-    for i in neg_index:
-        top_neg.append(h[i])
+    pos_label = generate_pos_labels(n_pos_sample=n_cand)
+    neg_label = generate_neg_labels(n_neg_sample=n_cand)
+    if bag_mask is None:
+        pos_score = A_I
+        neg_score = -A_I
+    else:
+        # padded instances rank below every real one for both the highest and the lowest attention scores
+        pos_score = tf.where(bag_mask > 0, A_I, float('-inf'))
+        neg_score = tf.where(bag_mask > 0, -A_I, float('-inf'))
+        pos_label = ignore_ins_labels(ins_label=pos_label, n_ins=n_ins)
+        neg_label = ignore_ins_labels(ins_label=neg_label, n_ins=n_ins)
+    ins_label_in = tf.concat(values=[pos_label, neg_label], axis=0)
 
-    ins_in = tf.concat(values=[top_pos, top_neg], axis=0)
-    logits_unnorm_in = list()
-    logits_in = list()
+    # top k instances w/ highest and lowest attention scores, gathered from the stacked h in one go
+    top_pos_ids = tf.math.top_k(pos_score, n_cand)[1]
+    top_neg_ids = tf.math.top_k(neg_score, n_cand)[1]
+    ins_in = tf.gather(h, tf.concat(values=[top_pos_ids, top_neg_ids], axis=0))  # shape be (2k, 512)
 
-    for i in range(n_class * n_ins):
-        ins_score_unnorm_in = ins_classifier(ins_in[i])
-        logit_in = tf.math.softmax(ins_score_unnorm_in)
-        logits_unnorm_in.append(ins_score_unnorm_in)
-        logits_in.append(logit_in)
+    logits_unnorm_in = tf.cast(ins_classifier(ins_in), tf.float32)  # shape be (2k, n_class)
+    logits_in = tf.math.softmax(logits_unnorm_in)
 
     return ins_label_in, logits_unnorm_in, logits_in
 
 
-def ins_out_call(ins_classifier, h, A_O, top_k_percent):
-    n_ins = top_k_percent * len(h)
-    n_ins = int(n_ins)
-
-    # get compressed 512-dimensional instance-level feature vectors for following use, denoted by h
-    A_O = tf.reshape(tf.convert_to_tensor(A_O), (1, len(A_O)))
+def ins_out_call(ins_classifier, h, A_O, top_k_percent, bag_mask=None):
+    n_ins, n_cand = ins_top_k_count(h=h, top_k_percent=top_k_percent, bag_mask=bag_mask)
 
-    top_pos_ids = tf.math.top_k(A_O, n_ins)[1][-1]
-    pos_index = list()
-    for i in top_pos_ids:
-        pos_index.append(i)
+    if bag_mask is None:
+        pos_score = A_O
+    else:
+        pos_score = tf.where(bag_mask > 0, A_O, float('-inf'))
 
-    pos_index = tf.convert_to_tensor(pos_index)
-    top_pos = list()
-    for i in pos_index:
-        top_pos.append(h[i])
+    # get compressed 512-dimensional instance-level feature vectors for following use, denoted by h
+    top_pos_ids = tf.math.top_k(pos_score, n_cand)[1]
+    top_pos = tf.gather(h, top_pos_ids)  # shape be (k, 512)
 
     # mutually-exclusive -> top k instances w/ highest attention scores ==> false pos = neg
-    pos_ins_labels_out = generate_neg_labels(n_neg_sample=n_ins)
+    pos_ins_labels_out = generate_neg_labels(n_neg_sample=n_cand)
+    if bag_mask is not None:
+        pos_ins_labels_out = ignore_ins_labels(ins_label=pos_ins_labels_out, n_ins=n_ins)
     ins_label_out = pos_ins_labels_out
 
-    logits_unnorm_out = list()
-    logits_out = list()
-
-    for i in range(n_ins):
-        ins_score_unnorm_out = ins_classifier(top_pos[i])
-        logit_out = tf.math.softmax(ins_score_unnorm_out)
-        logits_unnorm_out.append(ins_score_unnorm_out)
-        logits_out.append(logit_out)
+    logits_unnorm_out = tf.cast(ins_classifier(top_pos), tf.float32)  # shape be (k, n_class)
+    logits_out = tf.math.softmax(logits_unnorm_out)
 
     return ins_label_out, logits_unnorm_out, logits_out
 
 
-def ins_call(m_ins_classifier, bag_label, h, A, n_class, top_k_percent, mut_ex):
-    for i in range(n_class):
-        ins_classifier = m_ins_classifier[i]
-        if i == bag_label:
-            A_I = list()
-            for j in range(len(A)):
-                a_i = A[j][0][i]
-                A_I.append(a_i)
-            ins_label_in, logits_unnorm_in, logits_in = ins_in_call(ins_classifier=ins_classifier,
-                                                                    h=h, A_I=A_I,
-                                                                    top_k_percent=top_k_percent,
-                                                                    n_class=n_class)
-        else:
-            if mut_ex:
-                A_O = list()
-                for j in range(len(A)):
-                    a_o = A[j][0][i]
-                    A_O.append(a_o)
-                ins_label_out, logits_unnorm_out, logits_out = ins_out_call(ins_classifier=ins_classifier,
-                                                                            h=h, A_O=A_O,
-                                                                            top_k_percent=top_k_percent)
-            else:
-                continue
+def ins_call(m_ins_classifier, bag_label, h, A, n_class, top_k_percent, mut_ex, bag_mask=None):
+    # h and A be the stacked (N, 512) and (N, n_class) tensors, lists of per-instance tensors get stacked here
+    h = tf.reshape(h, (len(h), -1))
+    A = tf.reshape(A, (-1, n_class))
+
+    # every class shares one instance classifier, the per-class copies restored from disk carry the same weights,
+    # and the class branches be picked with tensor ops so that bag_label may be a tensor inside a tf.function
+    ins_classifier = m_ins_classifier[0]
+
+    A_I = tf.gather(A, bag_label, axis=1)
+    ins_label_in, logits_unnorm_in, logits_in = ins_in_call(ins_classifier=ins_classifier,
+                                                            h=h, A_I=A_I,
+                                                            top_k_percent=top_k_percent,
+                                                            n_class=n_class,
+                                                            bag_mask=bag_mask)
 
     if mut_ex:
+        # the out-of-class branch be the last class other than bag_label
+        out_class = tf.where(tf.math.equal(bag_label, n_class - 1), n_class - 2, n_class - 1)
+        A_O = tf.gather(A, out_class, axis=1)
+        ins_label_out, logits_unnorm_out, logits_out = ins_out_call(ins_classifier=ins_classifier,
+                                                                    h=h, A_O=A_O,
+                                                                    top_k_percent=top_k_percent,
+                                                                    bag_mask=bag_mask)
+
         ins_labels = tf.concat(values=[ins_label_in, ins_label_out], axis=0)
-        ins_logits_unnorm = logits_unnorm_in + logits_unnorm_out
-        ins_logits = logits_in + logits_out
+        ins_logits_unnorm = tf.concat(values=[logits_unnorm_in, logits_unnorm_out], axis=0)
+        ins_logits = tf.concat(values=[logits_in, logits_out], axis=0)
     else:
         ins_labels = ins_label_in
         ins_logits_unnorm = logits_unnorm_in
@@ -357,22 +1247,23 @@ def ins_call(m_ins_classifier, bag_label, h, A, n_class, top_k_percent, mut_ex):
 
     return ins_labels, ins_logits_unnorm, ins_logits
 
-def s_bag_h_slide(A, h):
+def s_bag_h_slide(A, h, bag_mask=None):
     # compute the slide-level representation aggregated per the attention score distribution for the mth class
-    SAR = list()
-    for i in range(len(A)):
-        sar = tf.linalg.matmul(tf.transpose(A[i]), h[i])  # shape be (2,512)
-        SAR.append(sar)
+    A = tf.reshape(A, (len(A), -1))  # shape be (N,2)
+    h = tf.reshape(h, (len(h), -1))  # shape be (N,512)
+    h = tf.cast(h, A.dtype)  # aggregate in float32, a float16 sum over a whole slide may overflow
+    if bag_mask is not None:
+        A = A * tf.expand_dims(bag_mask, axis=-1)  # padded instances of a padded bag add nothing
 
-    slide_agg_rep = tf.math.add_n(SAR)  # return h_[slide,m], shape be (2,512)
+    slide_agg_rep = tf.linalg.matmul(A, h, transpose_a=True)  # return h_[slide,m], shape be (2,512)
 
     return slide_agg_rep
 
 
-def s_bag_call(bag_classifier, bag_label, A, h, n_class):
-    slide_agg_rep = s_bag_h_slide(A=A, h=h)
+def s_bag_call(bag_classifier, bag_label, A, h, n_class, bag_mask=None):
+    slide_agg_rep = s_bag_h_slide(A=A, h=h, bag_mask=bag_mask)
 
-    slide_score_unnorm = bag_classifier(slide_agg_rep)
+    slide_score_unnorm = tf.cast(bag_classifier(slide_agg_rep), tf.float32)
     slide_score_unnorm = tf.reshape(slide_score_unnorm, (1, n_class))
 
     Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][-1]
@@ -380,61 +1271,55 @@ def s_bag_call(bag_classifier, bag_label, A, h, n_class):
     Y_prob = tf.math.softmax(tf.reshape(slide_score_unnorm,
                              (1, n_class)))  # shape be (1,2), predictions for each of the classes
 
-    predict_slide_label = np.argmax(Y_prob.numpy())
+    predict_slide_label = tf.math.argmax(Y_prob, axis=-1)[0]
 
     Y_true = tf.one_hot([bag_label], 2)
 
     return slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true
 
-def m_bag_h_slide(A, h, dim_compress_features, n_class):
-    SAR = list()
-    for i in range(len(A)):
-        sar = tf.linalg.matmul(tf.transpose(A[i]), h[i])  # shape be (2,512)
-        SAR.append(sar)
-
-    SAR_Branch = list()
-    for i in range(n_class):
-        sar_branch = list()
-        for j in range(len(SAR)):
-            sar_c = tf.reshape(SAR[j][i], (1, dim_compress_features))
-            sar_branch.append(sar_c)
-        SAR_Branch.append(sar_branch)
+def m_bag_h_slide(A, h, dim_compress_features, n_class, bag_mask=None):
+    # row m of the result be the slide-level representation fed into the mth bag classifier
+    A = tf.reshape(A, (-1, n_class))  # shape be (N,2)
+    h = tf.reshape(h, (-1, dim_compress_features))  # shape be (N,512)
+    h = tf.cast(h, A.dtype)  # aggregate in float32, a float16 sum over a whole slide may overflow
+    if bag_mask is not None:
+        A = A * tf.expand_dims(bag_mask, axis=-1)  # padded instances of a padded bag add nothing
 
-    slide_agg_rep = list()
-    for k in range(n_class):
-        slide_agg_rep.append(tf.math.add_n(SAR_Branch[k]))
+    slide_agg_rep = tf.linalg.matmul(A, h, transpose_a=True)  # shape be (2,512)
 
     return slide_agg_rep
 
-def m_bag_call(m_bag_classifier, bag_label, A, h, n_class, dim_compress_features):
-    slide_agg_rep = m_bag_h_slide(A=A, h=h, dim_compress_features=dim_compress_features, n_class=n_class)
-
-    ssus = list()
-    # return s_[slide,m] (slide-level prediction scores)
-    for i in range(n_class):
-        bag_classifier = m_bag_classifier[i]
-        ssu = bag_classifier(slide_agg_rep[i])
-        ssus.append(ssu[0][0])
+def m_bag_call(m_bag_classifier, bag_label, A, h, n_class, dim_compress_features, bag_mask=None):
+    slide_agg_rep = m_bag_h_slide(A=A, h=h, dim_compress_features=dim_compress_features, n_class=n_class,
+                                  bag_mask=bag_mask)
 
-    slide_score_unnorm = tf.convert_to_tensor(ssus)
+    # return s_[slide,m] (slide-level prediction scores), every linear class head scored in one batched einsum
+    bag_layers = [bag_classifier.layers[-1] for bag_classifier in m_bag_classifier]
+    bag_kernels = tf.stack([bag_layer.kernel for bag_layer in bag_layers])  # shape be (2,512,1)
+    bag_biases = tf.stack([bag_layer.bias for bag_layer in bag_layers])  # shape be (2,1)
+    slide_score_unnorm = tf.einsum('md,mdo->mo', slide_agg_rep, bag_kernels) + bag_biases
     slide_score_unnorm = tf.reshape(slide_score_unnorm, (1, n_class))
 
     Y_hat = tf.math.top_k(slide_score_unnorm, 1)[1][-1]
     Y_prob = tf.math.softmax(slide_score_unnorm)
-    predict_slide_label = np.argmax(Y_prob.numpy())
+    predict_slide_label = tf.math.argmax(Y_prob, axis=-1)[0]
 
     Y_true = tf.one_hot([bag_label], 2)
 
     return slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true
 
 def s_clam_call(att_net, ins_net, bag_net, img_features, slide_label,
-                n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex):
+                n_class, top_k_percent, att_gate, att_only, mil_ins, mut_ex, bag_mask=None):
+    # stack the bag once, every step below works on the (N, 1024) tensor
+    if isinstance(img_features, (list, tuple)):
+        img_features = tf.concat(img_features, axis=0)
+
     if att_gate:
         h, A = g_att_call(g_att_net=att_net, img_features=img_features)
     else:
         h, A = ng_att_call(ng_att_net=att_net, img_features=img_features)
     att_score = A  # output from attention network
-    A = tf.math.softmax(A)   # softmax on attention scores
+    A = tf.math.softmax(tf.cast(A, tf.float32))   # softmax on attention scores, kept in float32 under any policy
 
     if att_only:
         return att_score
@@ -445,23 +1330,29 @@ def s_clam_call(att_net, ins_net, bag_net, img_features, slide_label,
                                                              h=h, A=A,
                                                              n_class=n_class,
                                                              top_k_percent=top_k_percent,
-                                                             mut_ex=mut_ex)
+                                                             mut_ex=mut_ex,
+                                                             bag_mask=bag_mask)
 
     slide_score_unnorm, Y_hat, Y_prob, predict_slide_label, Y_true = s_bag_call(bag_classifier=bag_net,
                                                                                 bag_label=slide_label,
-                                                                                A=A, h=h, n_class=n_class)
+                                                                                A=A, h=h, n_class=n_class,
+                                                                                bag_mask=bag_mask)
 
     return att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, \
            slide_score_unnorm, Y_prob, Y_hat, Y_true, predict_slide_label
 
 def m_clam_call(att_net, ins_net, bag_net, img_features, slide_label,
-                n_class, dim_compress_features, top_k_percent, att_gate, att_only, mil_ins, mut_ex):
+                n_class, dim_compress_features, top_k_percent, att_gate, att_only, mil_ins, mut_ex, bag_mask=None):
+    # stack the bag once, every step below works on the (N, 1024) tensor
+    if isinstance(img_features, (list, tuple)):
+        img_features = tf.concat(img_features, axis=0)
+
     if att_gate:
         h, A = g_att_call(g_att_net=att_net, img_features=img_features)
     else:
         h, A = ng_att_call(ng_att_net=att_net, img_features=img_features)
     att_score = A  # output from attention network
-    A = tf.math.softmax(A)  # softmax on attention scores
+    A = tf.math.softmax(tf.cast(A, tf.float32))  # softmax on attention scores, kept in float32 under any policy
 
     if att_only:
         return att_score
@@ -472,16 +1363,99 @@ def m_clam_call(att_net, ins_net, bag_net, img_features, slide_label,
                                                              h=h, A=A,
                                                              n_class=n_class,
                                                              top_k_percent=top_k_percent,
-                                                             mut_ex=mut_ex)
+                                                             mut_ex=mut_ex,
+                                                             bag_mask=bag_mask)
 
     slide_score_unnorm, Y_hat, Y_prob, \
     predict_slide_label, Y_true = m_bag_call(m_bag_classifier=bag_net, bag_label=slide_label,
                                              A=A, h=h, n_class=n_class,
-                                             dim_compress_features=dim_compress_features)
+                                             dim_compress_features=dim_compress_features,
+                                             bag_mask=bag_mask)
 
     return att_score, A, h, ins_labels, ins_logits_unnorm, ins_logits, \
            slide_score_unnorm, Y_prob, Y_hat, Y_true, predict_slide_label
 
+def bag_bucket_len(n_samples, min_bucket_len=256):
+    # smallest power of two no shorter than the bag, so that padded bags only come in a bounded number of lengths
+    bucket_len = min_bucket_len
+    while bucket_len < n_samples:
+        bucket_len *= 2
+
+    return bucket_len
+
+
+def pad_bag(img_features, bucket_len):
+    # zero-pad the stacked (N, 1024) bag to (bucket_len, 1024), bag_mask be 1 for the N real instances, 0 for padding
+    img_features = tf.concat(img_features, axis=0) if isinstance(img_features, (list, tuple)) else img_features
+    n_samples = int(img_features.shape[0])
+
+    img_features = tf.pad(img_features, paddings=[[0, bucket_len - n_samples], [0, 0]])
+    bag_mask = tf.concat(values=[tf.ones(n_samples), tf.zeros(bucket_len - n_samples)], axis=0)
+
+    return img_features, bag_mask
+
+
+class BucketedJitFunction(object):
+    """
+    Run func(img_features, slide_label, bag_mask) as an XLA compiled tf.function on bags zero-padded to bucketed
+    lengths, so that XLA compiles one program per bucket instead of one per bag size. A bucket whose compilation
+    fails falls back to the same function compiled without XLA. The first call of every bucket pays for tracing and
+    compiling, report() prints that time next to the steady-state time of the calls after it.
+    A padded (B, N, 1024) multi-slide batch comes with its (B, N) bag_mask and gets padded further along N, its
+    buckets be keyed by (B, bucket length).
+    """
+
+    def __init__(self, func, name, min_bucket_len=256):
+        self.name = name
+        self.min_bucket_len = min_bucket_len
+        self.jit_func = tf.function(func, jit_compile=True)
+        self.no_jit_func = tf.function(func)
+        self.fallback_buckets = set()
+        self.bucket_times = dict()
+
+    def __call__(self, img_features, slide_label, bag_mask=None):
+        img_features = tf.concat(img_features, axis=0) if isinstance(img_features, (list, tuple)) else img_features
+        bucket_len = bag_bucket_len(n_samples=int(img_features.shape[-2]), min_bucket_len=self.min_bucket_len)
+        if bag_mask is None:
+            img_features, bag_mask = pad_bag(img_features=img_features, bucket_len=bucket_len)
+        else:
+            n_pad = bucket_len - int(img_features.shape[-2])
+            img_features = tf.pad(img_features, paddings=[[0, 0], [0, n_pad], [0, 0]])
+            bag_mask = tf.pad(bag_mask, paddings=[[0, 0], [0, n_pad]])
+        slide_label = tf.convert_to_tensor(slide_label, dtype=tf.int32)
+        bucket = tuple(img_features.shape[:-1])
+
+        start_time = time.time()
+
+        outputs = None
+        if bucket not in self.fallback_buckets:
+            try:
+                outputs = self.jit_func(img_features, slide_label, bag_mask)
+            except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError, tf.errors.InternalError) as e:
+                # XLA rejects the program before running it, so no variable has been updated at this point
+                print('\n {} XLA compilation failed for bucket {}, falling back to tf.function: {}'.format(
+                    self.name, 'x'.join(str(i) for i in bucket), str(e).splitlines()[0]))
+                self.fallback_buckets.add(bucket)
+
+        if outputs is None:
+            outputs = self.no_jit_func(img_features, slide_label, bag_mask)
+
+        # pull the results back to the host so that the recorded time covers the asynchronous kernels as well
+        outputs = tf.nest.map_structure(lambda x: x.numpy(), outputs)
+        self.bucket_times.setdefault(bucket, list()).append(time.time() - start_time)
+
+        return outputs
+
+    def report(self):
+        print('\n {} XLA Buckets:'.format(self.name))
+        template = ' Bucket {}: {} calls, first call (compile) {:.3f} s, steady state {} per call{}'
+        for bucket in sorted(self.bucket_times):
+            run_times = self.bucket_times[bucket]
+            steady_time = '{:.4f} s'.format(sum(run_times[1:]) / len(run_times[1:])) if len(run_times) > 1 else '-'
+            fallback = ' (tf.function fallback)' if bucket in self.fallback_buckets else ''
+            print(template.format('x'.join(str(i) for i in bucket), len(run_times), run_times[0], steady_time,
+                                  fallback))
+
 def model_save(c_model, c_model_dir, n_class, m_clam_op, att_gate):
 
     clam_model_names = ['_Att', '_Ins', '_Bag']
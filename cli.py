@@ -20,15 +20,18 @@ def make_arg_parser():
 
     parser.add_argument('-t', '--train_data_dir',
                         required=False,
-                        help='directory of training tfrecords')
+                        help='directory of training tfrecords, or of their feature corpus packed by '
+                             'UTILITY/feature_corpus.py')
 
     parser.add_argument('-v', '--val_data_dir',
                         required=False,
-                        help='directory of validation tfrecords')
+                        help='directory of validation tfrecords, or of their feature corpus packed by '
+                             'UTILITY/feature_corpus.py')
 
     parser.add_argument('-d', '--test_data_dir',
                         required=False,
-                        help='directory of testing tfrecords')
+                        help='directory of testing tfrecords, or of their feature corpus packed by '
+                             'UTILITY/feature_corpus.py')
 
     parser.add_argument('-r', '--test_result_dir',
                         required=False,
@@ -178,6 +181,96 @@ def make_arg_parser():
                         required=False,
                         help='number of batch size applied during model optimization process')
 
+    parser.add_argument('--compile_op_name',
+                        type=str,
+                        default='False',
+                        required=False,
+                        help='whether or not running the train step as one tf.function compiled graph')
+
+    parser.add_argument('--jit_compile',
+                        dest='jit_compile_name',
+                        type=str,
+                        default='False',
+                        required=False,
+                        help='whether or not XLA compiling the train, validation and test steps on bags padded to '
+                             'bucketed lengths, takes precedence over compile_op_name')
+
+    parser.add_argument('--slide_batch_size',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='number of slides packed into one padded batch per optimizer update during training and '
+                             'validation, 1 keeps one slide per update and the batch_op_name option')
+
+    parser.add_argument('--precision_policy',
+                        type=str,
+                        default='float32',
+                        choices=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                        required=False,
+                        help='keras mixed precision policy of the model computation, the attention softmax and the '
+                             'losses always stay in float32')
+
+    parser.add_argument('--num_parallel_reads',
+                        type=int,
+                        default=4,
+                        required=False,
+                        help='number of slide tfrecords read and parsed at the same time by the data pipeline')
+
+    parser.add_argument('--prefetch_slides',
+                        type=int,
+                        default=2,
+                        required=False,
+                        help='number of slides, or multi-slide batches, the data pipeline keeps ready ahead of the '
+                             'train, validation and test steps')
+
+    parser.add_argument('--feature_cache_dir',
+                        type=str,
+                        default=None,
+                        required=False,
+                        help='directory of the decoded feature cache, every tfrecord gets decoded into a .npy matrix '
+                             'on its first read and memory-mapped afterwards, no cache when not given')
+
+    parser.add_argument('--warm_cache_workers',
+                        type=int,
+                        default=0,
+                        required=False,
+                        help='number of processes building the feature cache of the train and validation, or '
+                             'testing, tfrecords before the run starts, 0 leaves it to the first read')
+
+    parser.add_argument('--bag_cache_gb',
+                        type=float,
+                        default=0,
+                        required=False,
+                        help='RAM budget in GB of the least recently used cache of decoded training and validation '
+                             'slides kept across epochs, 0 turns the cache off')
+
+    parser.add_argument('--checkpoint_dir',
+                        type=str,
+                        default=None,
+                        required=False,
+                        help='directory of the training checkpoints, default be the Checkpoint folder in c_model_dir')
+
+    parser.add_argument('--checkpoint_epochs',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='write a training checkpoint every this many epochs, 0 turns the epoch interval off')
+
+    parser.add_argument('--checkpoint_minutes',
+                        type=float,
+                        default=0,
+                        required=False,
+                        help='write a training checkpoint at the end of the first epoch this many minutes after the '
+                             'last one, 0 turns the time interval off')
+
+    parser.add_argument('--resume',
+                        dest='resume_op_name',
+                        type=str,
+                        default='False',
+                        required=False,
+                        help='whether or not resuming training from the latest checkpoint in checkpoint_dir, starts '
+                             'from scratch when there be none')
+
     parser.add_argument('-E', '--epochs',
                         type=int,
                         default=200,
@@ -286,6 +379,19 @@ def main():
               top_k_percent=args.top_k_percent,
               batch_size=args.batch_size,
               batch_op_name=args.batch_op_name,
+              compile_op_name=args.compile_op_name,
+              jit_compile_name=args.jit_compile_name,
+              slide_batch_size=args.slide_batch_size,
+              precision_policy=args.precision_policy,
+              checkpoint_dir=args.checkpoint_dir,
+              checkpoint_epochs=args.checkpoint_epochs,
+              checkpoint_minutes=args.checkpoint_minutes,
+              resume_op_name=args.resume_op_name,
+              num_parallel_reads=args.num_parallel_reads,
+              prefetch_slides=args.prefetch_slides,
+              feature_cache_dir=args.feature_cache_dir,
+              warm_cache_workers=args.warm_cache_workers,
+              bag_cache_gb=args.bag_cache_gb,
               c_model_dir=args.c_model_dir,
               att_only_name=args.att_only_name,
               mil_ins_name=args.mil_ins_name,